@@ -0,0 +1,150 @@
+# Benchmarks the pipeline against local stand-ins for spotdl, beets and Swing Music, without any network access.
+# Every scenario runs in a fresh workspace, the results are written as JSON to compare them between versions:
+#   python benchmarks/run.py --output before.json
+#   python benchmarks/run.py --output after.json --compare before.json
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPOSITORY_DIR = BENCHMARKS_DIR.parent
+
+QUEUE_SIZES = (10, 1000, 10000)
+
+
+def workspace_environment(workspace: Path, args: argparse.Namespace) -> dict[str, str]:
+    for directory in ('data', 'runtime', 'products'):
+        (workspace / directory).mkdir(parents=True)
+    (workspace / 'cookies.txt').touch()
+
+    return {
+        **os.environ,
+        'PATH': f'{BENCHMARKS_DIR / "stubs"}{os.pathsep}{os.environ.get("PATH", "")}',
+        'PYTHONPATH': str(BENCHMARKS_DIR),
+        'SPOTIFETCH_MAIN_DIR': str(workspace / 'data'),
+        'SPOTIFETCH_RUNTIME_DIR': str(workspace / 'runtime'),
+        'PRODUCTS_DIR': str(workspace / 'products'),
+        'COOKIES_FILE': str(workspace / 'cookies.txt'),
+        'SWING_ACCESS_TOKEN': 'benchmark',
+        'METRICS_PORT': '0',
+        # The stubs on the PATH are used instead of a toolchain installed from PyPI
+        'TOOLCHAIN_CHECK_INTERVAL_HOURS': '0',
+        'BENCH_ALBUMS': str(args.albums),
+        'BENCH_TRACKS': str(args.tracks),
+        'BENCH_TRACK_MB': str(args.track_mb),
+        'BENCH_DOWNLOAD_MBPS': str(args.download_mbps),
+    }
+
+
+def run_scenario(scenario: str, params: dict, args: argparse.Namespace) -> list[dict]:
+    with tempfile.TemporaryDirectory(prefix='spotifetch-bench-', dir=args.workdir) as workspace:
+        output = Path(workspace) / 'results.json'
+        completed = subprocess.run(
+            [sys.executable, str(BENCHMARKS_DIR / 'scenarios.py'), scenario, json.dumps(params), str(output)],
+            env=workspace_environment(Path(workspace), args),
+            stdout=subprocess.DEVNULL if not args.verbose else None,
+            stderr=subprocess.PIPE if not args.verbose else None,
+            text=True
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f'Scenario {scenario} {params} failed:\n{completed.stderr or ""}')
+        return json.loads(output.read_text())
+
+
+# Repeated runs are reduced to their median, alongside the fastest run
+def summarize(runs: list[list[dict]]) -> list[dict]:
+    summaries = []
+    for samples in zip(*runs):
+        seconds = [sample['seconds'] for sample in samples]
+        median = statistics.median(seconds)
+        summary = min(samples, key=lambda sample: abs(sample['seconds'] - median))
+        summaries.append({**summary, 'seconds': median, 'min_seconds': min(seconds), 'runs': len(seconds)})
+    return summaries
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=REPOSITORY_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: dict) -> str:
+    return f'{result["benchmark"]}[{result["size"]}]' if result.get('size') is not None else result['benchmark']
+
+
+def compare(results: list[dict], baseline_path: Path):
+    baseline = {result_key(result): result for result in json.loads(baseline_path.read_text())['results']}
+    print(f'{"benchmark":<40} {"baseline":>10} {"current":>10} {"change":>8}')
+    for result in results:
+        if (previous := baseline.get(result_key(result))) is None:
+            continue
+        change = result['seconds'] / previous['seconds'] - 1 if previous['seconds'] else 0
+        print(f'{result_key(result):<40} {previous["seconds"]:>9.3f}s {result["seconds"]:>9.3f}s {change:>+8.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark spotifetch with local stand-ins for its external tools')
+    parser.add_argument('--scenario', action='append', choices=['build_product', 'packer_job', 'queues', 'service'],
+                        help='Scenario to run, can be repeated (default: all)')
+    parser.add_argument('--albums', type=int, default=4, help='Albums per synthetic artist')
+    parser.add_argument('--tracks', type=int, default=10, help='Tracks per synthetic album')
+    parser.add_argument('--track-mb', type=float, default=4, help='Size of every synthetic track in MB')
+    parser.add_argument('--payload-mb', type=float, default=256, help='Size of the payload copied into a product in MB')
+    parser.add_argument('--queue-sizes', type=int, nargs='+', default=QUEUE_SIZES, help='Number of queued entries')
+    parser.add_argument('--artists', type=int, default=2, help='Artists fetched by the end-to-end service run')
+    parser.add_argument('--download-mbps', type=float, default=0, help='Simulated download bandwidth, 0 for unlimited')
+    parser.add_argument('--service-timeout', type=float, default=600, help='Seconds to wait for the service run')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every scenario, the median is reported')
+    parser.add_argument('--workdir', help='Directory for the temporary workspaces (default: system temp directory)')
+    parser.add_argument('--output', type=Path, help='File to write the JSON results to (default: stdout)')
+    parser.add_argument('--compare', type=Path, help='Previous results to compare against')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the scenarios')
+    args = parser.parse_args()
+
+    tree = {'albums': args.albums, 'tracks': args.tracks, 'track_mb': args.track_mb}
+    runs = {
+        'build_product': [{**tree, 'payload_mb': args.payload_mb}],
+        'packer_job': [tree],
+        'queues': [{'size': size} for size in args.queue_sizes],
+        # A single run, it's dominated by the service's scheduling rather than noise
+        'service': [{**tree, 'artists': args.artists, 'timeout': args.service_timeout}],
+    }
+
+    results = []
+    for scenario in args.scenario or list(runs):
+        for params in runs[scenario]:
+            print(f'Running {scenario} {params}', file=sys.stderr)
+            repeat = 1 if scenario == 'service' else args.repeat
+            results += summarize([run_scenario(scenario, params, args) for _ in range(repeat)])
+
+    report = {
+        'revision': git_revision(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'verbose')},
+        'results': results,
+    }
+    content = json.dumps(report, indent=2, default=str)
+    if args.output:
+        args.output.write_text(content)
+    else:
+        print(content)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# Runs a single benchmark scenario. Started by run.py in a fresh workspace, as the settings are read on import.
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARKS_DIR.parent / 'scripts'))
+
+from synthetic import MB, make_artist_tree  # noqa: E402
+
+
+def result(name: str, seconds: float, byte_count: int | None = None, operations: int | None = None, **extra) -> dict:
+    return {
+        'benchmark': name,
+        'seconds': seconds,
+        'bytes': byte_count,
+        'mb_per_s': byte_count / seconds / 1e6 if byte_count and seconds > 0 else None,
+        'operations': operations,
+        'ops_per_s': operations / seconds if operations and seconds > 0 else None,
+        **extra
+    }
+
+
+def timed(function, *args, **kwargs) -> tuple[float, object]:
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+
+def build_product_scenario(params: dict) -> list[dict]:
+    from consts import PRODUCTS_DIR, MUSIC_DIR
+    from packer import pack_songs
+    from manifest import walk_entries
+    from products import build_product
+    from synthetic import write_fake_mp3
+
+    payload = MUSIC_DIR / 'payload.bin'
+    payload_size = int(params['payload_mb'] * MB)
+    write_fake_mp3(payload, payload_size, 'payload')
+    seconds, _ = timed(build_product, payload, PRODUCTS_DIR / 'copy.tar', 'music')
+    results = [result('build_product.copy', seconds, payload_size)]
+
+    music_dir = MUSIC_DIR / 'bench' / 'music'
+    size = make_artist_tree(music_dir, 'Artist', params['albums'], params['tracks'], params['track_mb'])
+    seconds, _ = timed(pack_songs, 'stream.tar', {'artist': 'Artist'}, walk_entries(music_dir))
+    results.append(result('build_product.pack_songs', seconds, size, files=params['albums'] * params['tracks']))
+    return results
+
+
+def packer_job_scenario(params: dict) -> list[dict]:
+    from consts import OUT_DIR, DATETIME_FORMAT
+    from packer import PackerJob, execute_packer_job, queue_packer_job, get_packer_job
+
+    url_hash = 'benchartist'
+    size = make_artist_tree(OUT_DIR / url_hash, 'Artist', params['albums'], params['tracks'], params['track_mb'])
+    job = PackerJob(
+        url_hash=url_hash,
+        product_name='artist.tar',
+        time_to_pack=datetime.now().strftime(DATETIME_FORMAT),
+        attributes={'artist': 'Artist', 'url': 'https://open.spotify.com/artist/bench'}
+    )
+    queue_packer_job(job)
+    seconds, _ = timed(execute_packer_job, get_packer_job())
+    results = [result('packer_job.full', seconds, size, files=params['albums'] * params['tracks'])]
+
+    # A re-fetch with a single new album produces a delta on top of the full product
+    size = make_artist_tree(OUT_DIR / url_hash, 'Artist', params['albums'] + 1, params['tracks'], params['track_mb']) \
+        - size
+    queue_packer_job(job)
+    seconds, _ = timed(execute_packer_job, get_packer_job())
+    results.append(result('packer_job.delta', seconds, size, files=params['tracks']))
+    return results
+
+
+def queues_scenario(params: dict) -> list[dict]:
+    import store
+    from consts import DATETIME_FORMAT
+    from fetcher import ArtistFetch, update_artist_fetch, read_pending_artist_fetches, remove_artist_fetch
+    from packer import PackerJob, queue_packer_job, read_packer_queue, remove_packer_job
+
+    size = params['size']
+    fetches = [ArtistFetch(url=f'https://open.spotify.com/artist/bench{idx:06}', name=f'Artist {idx}') for idx in range(size)]
+    time_to_pack = (datetime.now() - timedelta(minutes=1)).strftime(DATETIME_FORMAT)
+    jobs = [
+        PackerJob(url_hash=f'bench{idx:06}', product_name=f'artist_{idx}.tar', time_to_pack=time_to_pack)
+        for idx in range(size)
+    ]
+
+    def claim_fetches():
+        while claimed := store.claim_artist_fetch('bench'):
+            remove_artist_fetch(ArtistFetch(**claimed))
+            store.release_artist_fetch(claimed['url'])
+
+    def claim_packer_jobs():
+        now = datetime.now().strftime(DATETIME_FORMAT)
+        while claimed := store.claim_due_packer_job('bench', now):
+            remove_packer_job(PackerJob(**claimed))
+
+    results = []
+    for name, function in [
+        ('queue.fetch.insert', lambda: [update_artist_fetch(fetch) for fetch in fetches]),
+        ('queue.fetch.read', read_pending_artist_fetches),
+        ('queue.fetch.claim', claim_fetches),
+        ('queue.pack.insert', lambda: [queue_packer_job(job) for job in jobs]),
+        ('queue.pack.read', read_packer_queue),
+        ('queue.pack.claim', claim_packer_jobs),
+    ]:
+        seconds, _ = timed(function)
+        operations = 1 if name.endswith('.read') else size
+        results.append(result(name, seconds, operations=operations, size=size))
+    return results
+
+
+def service_scenario(params: dict) -> list[dict]:
+    import os
+    import subprocess
+    from collections import defaultdict
+
+    from consts import PRODUCTS_DIR, SWING_IMAGES_DIR, SHOULD_STOP_FILE, TRACE_FILE, SCRIPTS_DIR
+    from fetcher import ArtistFetch, update_artist_fetch
+    from swing_stub import SwingStub
+
+    swing = SwingStub(SWING_IMAGES_DIR)
+    swing.start()
+
+    artists = params['artists']
+    for idx in range(artists):
+        update_artist_fetch(ArtistFetch(url=f'https://open.spotify.com/artist/bench{idx:06}', name=f'Bench Artist {idx}'))
+
+    environment = {**os.environ, 'SWING_URL': swing.url}
+    start = time.perf_counter()
+    service = subprocess.Popen(
+        [sys.executable, str(SCRIPTS_DIR / 'main.py')],
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+    deadline = start + params['timeout']
+    products = []
+    while time.perf_counter() < deadline and service.poll() is None:
+        products = [product for product in PRODUCTS_DIR.glob('*.tar') if not product.name.startswith('artist_images')]
+        if len(products) >= artists:
+            break
+        time.sleep(0.5)
+    seconds = time.perf_counter() - start
+
+    SHOULD_STOP_FILE.write_text('True\n')
+    try:
+        service.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        service.kill()
+    swing.stop()
+
+    stages = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'bytes': 0})
+    if TRACE_FILE.is_file():
+        for line in TRACE_FILE.read_text().splitlines():
+            span = json.loads(line)
+            stages[span['stage']]['count'] += 1
+            stages[span['stage']]['seconds'] += span['seconds']
+            stages[span['stage']]['bytes'] += span['bytes'] or 0
+
+    size = artists * params['albums'] * params['tracks'] * int(params['track_mb'] * MB)
+    return [result(
+        'service.end_to_end',
+        seconds,
+        size,
+        operations=len(products),
+        completed=len(products) >= artists,
+        swing_scans=swing.scans,
+        stages=dict(stages)
+    )]
+
+
+SCENARIOS = {
+    'build_product': build_product_scenario,
+    'packer_job': packer_job_scenario,
+    'queues': queues_scenario,
+    'service': service_scenario,
+}
+
+if __name__ == '__main__':
+    scenario, parameters, output = sys.argv[1], json.loads(sys.argv[2]), Path(sys.argv[3])
+    output.write_text(json.dumps(SCENARIOS[scenario](parameters)))
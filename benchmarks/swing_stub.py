@@ -0,0 +1,58 @@
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+
+# Stand-in for Swing Music's API: every searched artist is indexed, and its image is fetched right away
+class SwingStub:
+    def __init__(self, images_dir: Path):
+        self.images_dir = images_dir
+        self.scans = 0
+        self.searches = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith('/notsettings/trigger-scan'):
+                    stub.scans += 1
+                    body = {'msg': 'Scan triggered'}
+                elif url.path.startswith('/search'):
+                    stub.searches += 1
+                    body = {'results': [stub.artist(name) for name in parse_qs(url.query).get('q', [])], 'more': False}
+                else:
+                    self.send_error(404)
+                    return
+
+                content = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def artist(self, name: str) -> dict:
+        artist_hash = hashlib.md5(name.casefold().encode()).hexdigest()[:10]
+        image = self.images_dir / 'artists' / 'large' / f'{artist_hash}.webp'
+        image.parent.mkdir(parents=True, exist_ok=True)
+        image.write_bytes(artist_hash.encode() * 64)
+        return {'name': name, 'artisthash': artist_hash, 'image': image.name}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='swing-stub', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
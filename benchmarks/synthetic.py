@@ -0,0 +1,46 @@
+import hashlib
+import os
+from pathlib import Path
+
+MB = 1024 * 1024
+
+# Incompressible like real MP3s, one random block is shared by all files to keep generating large trees fast
+_RANDOM_BLOCK = os.urandom(MB)
+
+
+def _id3_header(tag_size: int) -> bytes:
+    syncsafe = bytes((tag_size >> shift) & 0x7f for shift in (21, 14, 7, 0))
+    return b'ID3\x04\x00\x00' + syncsafe
+
+
+def write_fake_mp3(path: Path, size: int, seed: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tag = f'TIT2{seed}'.encode().ljust(64, b'\x00')
+    # A unique prefix gives every file its own content hash
+    audio_prefix = hashlib.blake2b(seed.encode()).digest()
+
+    with open(path, 'wb') as file:
+        file.write(_id3_header(len(tag)) + tag + audio_prefix)
+        remaining = max(size - len(tag) - 10 - len(audio_prefix), 0)
+        while remaining > 0:
+            chunk = _RANDOM_BLOCK[:min(remaining, MB)]
+            file.write(chunk)
+            remaining -= len(chunk)
+
+
+def album_name(album: int) -> str:
+    return f'Album {album + 1:03}'
+
+
+def track_title(album: int, track: int) -> str:
+    return f'Track {album + 1:03}-{track + 1:03}'
+
+
+# Lays out an artist like spotdl does, `<album-artist>/<album>/<title>.mp3`, returns the number of bytes written
+def make_artist_tree(root: Path, artist: str, albums: int, tracks: int, track_mb: float) -> int:
+    size = int(track_mb * MB)
+    for album in range(albums):
+        for track in range(tracks):
+            title = track_title(album, track)
+            write_fake_mp3(root / artist / album_name(album) / f'{title}.mp3', size, f'{artist}/{title}')
+    return albums * tracks * size
@@ -10,3 +10,45 @@ export COOKIES_FILE=""
 
 # Acquired from the 'access_token_cookie' cookie in Swing Music
 export SWING_ACCESS_TOKEN=""
+
+# Number of artists fetched and packer jobs executed concurrently by the service
+export FETCH_WORKERS="1"
+export PACK_WORKERS="1"
+
+# Artists with the fewest tracks are fetched first, every this many hours of waiting counts like halving an artist's tracks
+export FETCH_AGING_HOURS="1"
+
+# Packing codec per product type: 'gzip' (multi-core, readable by gunzip), 'zstd' (requires the zstandard package) or 'store'
+export MUSIC_PACK_CODEC="gzip"
+export MUSIC_PACK_LEVEL="1"
+export IMAGES_PACK_CODEC="gzip"
+export IMAGES_PACK_LEVEL="9"
+
+# Number of albums imported by beets in parallel, all artists share a single library under state/beets
+export IMPORT_WORKERS="4"
+# Import and pack every album as soon as it's downloaded, while the rest of the artist is still downloading.
+# 0 imports and packs the whole artist after its fetch.
+export ALBUM_PIPELINE="1"
+
+# spotdl's Spotify lookups are cached under state/spotify_cache.db, shared by all artists and runs. Albums and tracks are
+# kept for this many days (0 disables the cache), the least recently used are evicted past the size limit.
+export SPOTIFY_CACHE_TTL_DAYS="30"
+export SPOTIFY_CACHE_MAX_MB="512"
+
+# Fetches and packer jobs only start once their estimated size fits on the disk with this many GB to spare.
+# Leftovers of artists that are no longer queued, and old error logs, are removed after this many days.
+export STORAGE_MIN_FREE_GB="5"
+export STORAGE_RETENTION_DAYS="7"
+
+# Swing Music's address, polled to pack artists as soon as it has indexed them and fetched their images
+export SWING_URL="http://localhost:1970"
+
+# The service packs new artist images into a product once at least this many have accumulated
+export IMAGES_PACK_MIN_NEW="50"
+
+# Port of the service's Prometheus metrics endpoint (queue depths, stage durations, bytes and failures), 0 disables it
+export METRICS_PORT="9464"
+
+# spotdl and yt-dlp are updated in a separate virtualenv under state/toolchain, checked for new releases every this many
+# hours and swapped in between fetches. 0 disables the updates, the tools in VENV_PATH are used until one was installed.
+export TOOLCHAIN_CHECK_INTERVAL_HOURS="6"
@@ -1,15 +1,18 @@
 import argparse
+import json
 import os
 import sys
-from pathlib import PosixPath
-from typing import Optional
 
-from rich import print
+import store
+from consts import SHOULD_STOP_FILE, FETCH_WORKERS, PACK_WORKERS, FETCH_THREADS_MIN, FETCH_THREADS_MAX, PACK_THREADS
 
-import main as spotifetch_main
-from consts import SHOULD_STOP_FILE
-from fetcher import ArtistFetch, update_artist_fetch, read_pending_artist_fetches
-from pack_artist_images import pack_artist_images
+# Commands import the modules they need when they run, scripts calling `show --raw` and `queue` in loops
+# shouldn't pay for loading the service
+
+
+def print(*args, **kwargs):
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
 
 
 def main():
@@ -25,7 +28,15 @@ def main():
 
     # Subcommand: queue
     queue = subparsers.add_parser('queue', aliases=['q'], help='Queue a spotify artist for fetching')
-    queue.add_argument('urls', help='One or more URLs to the artists\' pages on Spotify', type=str, nargs='+')
+    queue.add_argument('urls', type=str, nargs='*',
+                       help='URLs of artists on Spotify, or of albums and playlists to queue their artists. '
+                            'Labels are given as label:<name>')
+    queue.add_argument('--file', '-f', dest='files', action='append', default=[], type=argparse.FileType('r'),
+                       help='File with a URL per line, - for stdin. Can be repeated')
+    queue.add_argument('--priority', '-p', choices=list(store.FETCH_PRIORITIES), default='normal',
+                       help='Priority class of the fetches')
+    queue.add_argument('--requester', '-r', type=str, default=None,
+                       help='Who the fetches are for, the queue takes turns between requesters (default: current user)')
 
     # Subcommand: edit
     edit = subparsers.add_parser('edit', aliases=['e'], help='Edit details of a queued spotify fetch')
@@ -36,13 +47,54 @@ def main():
                       action='store_true')
     edit.add_argument('--failed', help='Forcibly mark a fetch as FAILED, disallowing it to run',
                       action='store_true')
+    edit.add_argument('--priority', '-p', help='Change the priority class of the fetch',
+                      choices=list(store.FETCH_PRIORITIES))
     # Subcommand: pack-images
-    pack_images = subparsers.add_parser('pack-images', help='Pack all artist images into a product')
+    pack_images = subparsers.add_parser('pack-images', help='Pack the artist images that were not shipped yet into a product')
+    pack_images.add_argument('--min-new', help='Only pack once at least this many new images have accumulated',
+                             type=int, default=1)
 
     # Subcommand: show
     show = subparsers.add_parser('show', aliases=['s', 'ls'], help='Show the status of one/all fetch(es)')
     show.add_argument('url_or_name', help='URL or part of the name of the artist', type=str, nargs='?')
+    show.add_argument('--search', help='Only show fetches whose name or URL contains this text', type=str)
+    show.add_argument('--state', help='Only show fetches in this state', choices=list(store.FETCH_STATES))
+    show.add_argument('--ignore-errors', help='Only show fetches that do (not) ignore failed tracks',
+                      action=argparse.BooleanOptionalAction)
+    show.add_argument('--error-log', help='Only show fetches that do (not) have an error log',
+                      action=argparse.BooleanOptionalAction)
+    show.add_argument('--limit', help='Show at most this many fetches', type=int)
+    show.add_argument('--offset', help='Skip this many fetches', type=int, default=0)
+    show.add_argument('--order', help='Show the fetches in the order they were queued, or will be run in',
+                      choices=['queue', 'schedule'], default='queue')
     show.add_argument('--raw', action='store_true', help='Display output in raw JSON')
+    show.add_argument('--ndjson', action='store_true', help='Stream output as a line of JSON per fetch')
+    show.add_argument('--disk-usage', action='store_true',
+                      help='Show the disk space used by each artist\'s files (always shown for a single artist)')
+
+    # Subcommand: status
+    status = subparsers.add_parser('status', aliases=['st'], help='Show what the running service is doing')
+    status.add_argument('--follow', '-f', action='store_true', help='Keep following the progress of the jobs')
+    status.add_argument('--raw', action='store_true', help='Display output in raw JSON')
+
+    # Subcommand: verify
+    verify = subparsers.add_parser('verify', help='Check products against their chunk manifests')
+    verify.add_argument('paths', type=str, nargs='*',
+                        help='Products, or directories of products (default: the products directory)')
+    verify.add_argument('--threads', help='Number of chunks to check concurrently', type=int, default=PACK_THREADS)
+    verify.add_argument('--raw', action='store_true', help='Display output as a line of JSON per product')
+
+    # Subcommand: toolchain
+    toolchain = subparsers.add_parser('toolchain', help='Show, update or roll back the spotdl and yt-dlp versions in use')
+    toolchain_action = toolchain.add_mutually_exclusive_group()
+    toolchain_action.add_argument('--update', action='store_true', help='Check for new releases and install them now')
+    toolchain_action.add_argument('--rollback', action='store_true', help='Go back to the previously installed versions')
+    toolchain.add_argument('--raw', action='store_true', help='Display output in raw JSON')
+
+    # Subcommand: gc
+    gc = subparsers.add_parser('gc', help='Remove the leftovers of artists that are no longer queued, and old error logs')
+    gc.add_argument('--dry-run', action='store_true', help='Only list what would be removed')
+    gc.add_argument('--raw', action='store_true', help='Display output in raw JSON')
 
     # Subcommand: show-errors
     show_errors = subparsers.add_parser('show-errors', aliases=['errors', 'se'],
@@ -51,6 +103,10 @@ def main():
 
     # Subcommand: run
     run = subparsers.add_parser('run', help='Run the Spotifetch service in the current terminal')
+    run.add_argument('--fetch-workers', help='Number of artists to fetch concurrently', type=int,
+                     default=FETCH_WORKERS)
+    run.add_argument('--pack-workers', help='Number of packer jobs to execute concurrently', type=int,
+                     default=PACK_WORKERS)
 
     # Subcommand: stop
     stop = subparsers.add_parser('stop', help='Queue safely stopping the service once possible')
@@ -63,6 +119,10 @@ def main():
         edit: handle_edit,
         pack_images: handle_pack_images,
         show: handle_show,
+        status: handle_status,
+        verify: handle_verify,
+        toolchain: handle_toolchain,
+        gc: handle_gc,
         show_errors: handle_show_errors,
         run: handle_run,
         stop: handle_stop,
@@ -77,62 +137,187 @@ def main():
     command_parsers[subparsers._name_parser_map[args.command]](args)
 
 
+# Listing every artist is only useful up to a point, large batches are summarized
+QUEUE_LISTING_LIMIT = 50
+
+
+def read_queue_references(args) -> list[str]:
+    references = list(args.urls)
+    for file in args.files:
+        with file:
+            references += [line.strip() for line in file if line.strip() and not line.lstrip().startswith('#')]
+    return references
+
+
+# Changes go through the running service when there is one, and straight to the store otherwise
 def handle_queue(args):
-    for url in args.urls:
-        print(f'Queuing URL \'{url}\' to be fetched')
-        update_artist_fetch(ArtistFetch(url=url))
+    import getpass
+
+    import control
+    from resolver import parse_spotify_reference, canonical_url, expand_to_artists, resolve_artist_names
+
+    if not (references := read_queue_references(args)):
+        print('No URLs given')
+        return
+
+    artist_urls, sources = [], []
+    for reference in references:
+        if not (parsed := parse_spotify_reference(reference)):
+            print(f'Skipping \'{reference}\', it\'s not a Spotify artist, album, playlist or label')
+        elif parsed[0] == 'artist':
+            artist_urls.append(canonical_url(*parsed))
+        else:
+            sources.append(parsed)
+    artist_urls = list(dict.fromkeys(artist_urls))
+    sources = list(dict.fromkeys(sources))
+
+    expanded = {}
+    if sources:
+        print(f'Expanding {len(sources)} album(s), playlist(s) and label(s) into their artists')
+        expanded, failed = expand_to_artists(sources)
+        for kind, source_id in failed:
+            print(f'Could not list all artists of {kind} \'{source_id}\'')
+        # Artists that were queued explicitly keep being requeued as before
+        expanded = {url: name for url, name in expanded.items() if url not in artist_urls}
+
+    print(f'Resolving the names of {len(artist_urls)} artist(s)')
+    names = resolve_artist_names(artist_urls)
+
+    queued = [(url, names.get(url)) for url in artist_urls] + list(expanded.items())
+    if len(queued) <= QUEUE_LISTING_LIMIT:
+        print('\n'.join(f'Queuing URL \'{url}\' ({name or "unknown name"}) to be fetched' for url, name in queued))
+    else:
+        print(f'Queuing {len(queued)} artist(s) to be fetched, {sum(name is None for _, name in queued)} without a name')
+
+    # Expanded artists that are queued already are left where they are
+    details = {'priority': args.priority, 'requester': args.requester or getpass.getuser()}
+    for fetches, replace in [
+        ([{'url': url, 'name': names.get(url), **details} for url in artist_urls], True),
+        ([{'url': url, 'name': name, **details} for url, name in expanded.items()], False),
+    ]:
+        if fetches and control.request('queue', fetches=fetches, replace=replace) is None:
+            control.queue_artist_fetches(fetches, replace)
 
 
 def handle_edit(args):
-    artist = find_artist_by_url_or_name(args.url_or_name, read_pending_artist_fetches())
-    if not artist:
+    import control
+
+    if not (fetch := store.find_artist_fetch(args.url_or_name)):
         print(f'Could not find artist identified with \'{args.url_or_name}\'')
         return
 
+    fields = {}
     if args.set_name:
-        artist.name = args.set_name
+        fields['name'] = args.set_name
     if args.ignore:
-        artist.ignore_errors = args.ignore
+        fields['ignore_errors'] = True
     if args.clear:
-        artist.status = None
+        fields['status'] = None
     if args.failed:
-        artist.status = 'FAILED'
+        fields['status'] = 'FAILED'
+    if args.priority:
+        fields['priority'] = args.priority
 
-    update_artist_fetch(artist)
+    if (artist := control.request('edit', url=fetch['url'], fields=fields)) is None:
+        artist = control.edit_artist_fetch(fetch['url'], fields)
     show_artist(artist)
 
 
 def handle_pack_images(args):
-    print('Packing artist images...')
-    product_name = pack_artist_images()
-    print(f'Product written to {product_name}')
+    from pack_artist_images import pack_artist_images
+
+    print('Packing new artist images...')
+    if product_name := pack_artist_images(min_new=args.min_new):
+        print(f'Product written to {product_name}')
+    else:
+        print('Not enough new artist images to pack')
+
+
+# Printed in chunks, rich is slow to print many short lines
+SHOW_CHUNK_SIZE = 500
 
 
+# Streams the queue straight from the store, without building a model per entry
 def handle_show(args):
-    artists = read_pending_artist_fetches()
     if args.url_or_name:
-        if artist := find_artist_by_url_or_name(args.url_or_name, artists):
-            artists = [artist]
-        else:
+        if not (artist := store.find_artist_fetch(args.url_or_name)):
             print(f'Could not find artist identified with \'{args.url_or_name}\'')
             return
+        artists = iter([artist])
+        args.disk_usage = True
+    else:
+        artists = store.iter_artist_fetches(
+            search=args.search,
+            state=args.state,
+            ignore_errors=args.ignore_errors,
+            has_error_log=args.error_log,
+            limit=args.limit,
+            offset=args.offset,
+            order=args.order
+        )
+
+    if args.disk_usage:
+        artists = with_disk_usage(artists)
+
+    if args.raw or args.ndjson:
+        write_json_fetches(artists, ndjson=args.ndjson, disk_usage=args.disk_usage)
+        return
 
-    if args.raw:
-        print([artist.model_dump() for artist in artists])
+    from more_itertools import chunked
+
+    if not args.url_or_name:
+        show_download_concurrency()
+
+    shown = 0
+    for chunk in chunked(artists, SHOW_CHUNK_SIZE):
+        lines = []
+        for artist in chunk:
+            shown += 1
+            first_line, *other_lines = artist_lines(artist)
+            lines += [f'{args.offset + shown}. {first_line}', *other_lines, '']
+        print('\n'.join(lines))
+
+    if args.limit is not None and shown == args.limit:
+        print(f'Showing {args.offset + 1}-{args.offset + shown}, continue with --offset {args.offset + shown}')
+
+
+def with_disk_usage(artists):
+    from products import calculate_md5
+    from storage import artist_disk_usage
+
+    for artist in artists:
+        yield {**artist, 'disk_usage': artist_disk_usage(calculate_md5(artist['url']))}
+
+
+def write_json_fetches(artists, ndjson: bool, disk_usage: bool = False):
+    fields = (*store.ARTIST_FETCH_COLUMNS, 'disk_usage') if disk_usage else store.ARTIST_FETCH_COLUMNS
+    lines = (json.dumps({field: artist.get(field) for field in fields}) for artist in artists)
+    if ndjson:
+        for line in lines:
+            sys.stdout.write(line + '\n')
         return
 
-    for idx, artist in enumerate(artists):
-        print(f'{idx + 1}. ', end='')
-        show_artist(artist)
-        print()
+    sys.stdout.write('[')
+    for idx, line in enumerate(lines):
+        sys.stdout.write(f'{", " if idx else ""}{line}')
+    sys.stdout.write(']\n')
 
 
 def handle_show_errors(args):
-    artists = read_pending_artist_fetches()
-    if not (artist := find_artist_by_url_or_name(args.url_or_name, artists)):
+    from models.artist_fetch import ArtistFetch
+
+    if not (fetch := store.find_artist_fetch(args.url_or_name)):
         print(f'Could not find artist identified with \'{args.url_or_name}\'')
         return
 
+    artist = ArtistFetch(**fetch)
+
+    if failures := store.read_track_failures(artist.url_hash):
+        print(f"{len(failures)} failed track(s) of '{artist.name}':")
+        for failure in failures:
+            print(f"  {failure['track_url']} ({failure['attempts']} attempt(s), last with "
+                  f"{failure['audio_providers']} at {failure['updated_at']}): {failure['last_error']}")
+
     if not (error_log := artist.get_latest_error_file()):
         print(f"Artist '{artist.name}' does not have an error log.")
         return
@@ -140,35 +325,214 @@ def handle_show_errors(args):
     os.system(f'editor {error_log}')
 
 
+def handle_status(args):
+    import control
+
+    if args.follow:
+        follow_status(args.raw)
+        return
+
+    status = control.request('status')
+    if args.raw:
+        sys.stdout.write(json.dumps(status) + '\n')
+        return
+
+    if status is None:
+        print('The Spotifetch service is not running')
+        return
+
+    lines = [
+        f"Service running as pid {status['pid']} since {status['started_at']}"
+        + (', stopping once its in-flight jobs are done' if status['stopping'] else ''),
+        f"Workers: {status['workers']['fetch']} fetch, {status['workers']['pack']} pack, "
+        f"{status['download_threads']} download thread(s)",
+        'Queues: ' + ', '.join(f'{queue.replace("_", " ")}: {depth}' for queue, depth in status['queues'].items()),
+        '',
+        *job_lines(status['jobs'])
+    ]
+    print('\n'.join(lines))
+
+
+def follow_status(raw: bool):
+    import control
+    from rich.live import Live
+
+    if (updates := control.follow_progress()) is None:
+        print('The Spotifetch service is not running')
+        return
+
+    try:
+        if raw:
+            # A line of JSON per update
+            for update in updates:
+                sys.stdout.write(json.dumps(update) + '\n')
+                sys.stdout.flush()
+            return
+
+        with Live(auto_refresh=False) as live:
+            for update in updates:
+                lines = job_lines(update['jobs'])
+                if update['stopping']:
+                    lines.append('Stopping once the in-flight jobs are done')
+                live.update('\n'.join(lines), refresh=True)
+    except (KeyboardInterrupt, ConnectionError):
+        return
+    print('The Spotifetch service stopped')
+
+
+def handle_verify(args):
+    from pathlib import Path
+
+    import consts
+    from products import verify_product
+
+    products = []
+    for path in map(Path, args.paths or [consts.PRODUCTS_DIR]):
+        products += sorted(path.glob('*.tar')) if path.is_dir() else [path]
+
+    all_ok = True
+    for product in products:
+        verification = verify_product(product, threads=args.threads)
+        all_ok &= verification.ok
+        if args.raw:
+            sys.stdout.write(verification.model_dump_json() + '\n')
+        else:
+            print(('[green]OK[/green] ' if verification.ok else '[red]FAILED[/red] ') + verification.summary())
+
+    if not all_ok:
+        sys.exit(1)
+
+
+def handle_toolchain(args):
+    import toolchain
+
+    if args.update:
+        print('Checking for new releases...')
+        if versions := toolchain.update_toolchain(force=True):
+            print('Installed ' + ', '.join(f'{package} {version}' for package, version in versions.items()))
+        else:
+            print('No new releases to install')
+    elif args.rollback:
+        if not toolchain.current_environment():
+            print('No toolchain is installed, the tools on the PATH are in use')
+            sys.exit(1)
+        previous = toolchain.roll_back()
+        print(f'Rolled back to {previous.name if previous else "the tools on the PATH"}')
+
+    status = toolchain.toolchain_status()
+    if args.raw:
+        sys.stdout.write(json.dumps(status) + '\n')
+        return
+
+    def versions_line(versions: dict | None) -> str:
+        return ', '.join(f'{package} {version}' for package, version in (versions or {}).items()) or '-'
+
+    lines = [
+        f"Current: {status['current'] or 'the tools on the PATH'}"
+        + (' (on probation until its first successful run)' if status['on_probation'] else ''),
+        f"  {versions_line(status['current_versions'])}",
+        f"Previous: {status['previous'] or '-'}",
+        f"  {versions_line(status['previous_versions'])}",
+        f"Latest releases: {versions_line(status['latest_versions'])}"
+        + (f" (checked {status['checked_at']})" if status['checked_at'] else ''),
+    ]
+    lines += [f'Rolled back: {versions_line(versions)}' for versions in status['rejected_versions']]
+    print('\n'.join(lines))
+
+
+def handle_gc(args):
+    from consts import OUT_DIR
+    from storage import collect_garbage, free_bytes
+
+    removed = collect_garbage(dry_run=args.dry_run)
+    total = sum(size for _, size in removed)
+    if args.raw:
+        sys.stdout.write(json.dumps({
+            'dry_run': args.dry_run,
+            'removed': [{'path': str(path), 'bytes': size} for path, size in removed],
+            'bytes': total,
+            'free_bytes': free_bytes(OUT_DIR),
+        }) + '\n')
+        return
+
+    for path, size in removed:
+        print(f'{"Would remove" if args.dry_run else "Removed"} {path} ({size / 1e6:.1f} MB)')
+    print(f'{"Would free" if args.dry_run else "Freed"} {total / 1e6:.1f} MB in {len(removed)} path(s), '
+          f'{free_bytes(OUT_DIR) / 1e9:.1f} GB free')
+
+
 def handle_run(args):
-    spotifetch_main.main()
+    import main as spotifetch_main
+
+    spotifetch_main.main(fetch_workers=args.fetch_workers, pack_workers=args.pack_workers)
 
 
 def handle_stop(args):
-    SHOULD_STOP_FILE.write_text('1')
-    print('Spotifetch service will stop once it\'s finished a job')
+    import control
+
+    if control.request('stop') is None:
+        SHOULD_STOP_FILE.write_text('1')
+    print('Spotifetch service will stop once it\'s finished its in-flight jobs')
 
 
 def handle_unstop(args):
-    SHOULD_STOP_FILE.unlink(missing_ok=True)
-    print('Cancelled stop command')
+    import control
 
+    if (result := control.request('unstop')) is None:
+        SHOULD_STOP_FILE.unlink(missing_ok=True)
+    elif not result['cancelled']:
+        print('The Spotifetch service has already finished its in-flight jobs and is stopping')
+        return
+    print('Cancelled stop command')
 
-def find_artist_by_url_or_name(url_or_name: str, artists: list[ArtistFetch]) -> Optional[ArtistFetch]:
-    for artist in sorted(artists, key=lambda a: a.name or ''):
-        if url_or_name == artist.url or (artist.name is not None and url_or_name.lower() in artist.name.lower()):
-            return artist
-    return None
 
+def show_download_concurrency():
+    from concurrency import read_controller_state
 
-def show_artist(artist: ArtistFetch):
-    if artist.name:
-        print(f'{artist.name} ( {artist.url} )')
-    else:
-        print(artist.url)
+    if not (state := read_controller_state()):
+        return
 
-    for key, value in artist.model_dump(exclude={'name', 'url'}, exclude_none=True).items():
-        print(f'      {key}: {value}')
+    print(f"Download concurrency: {state['threads']} thread(s) (bounds {FETCH_THREADS_MIN}-{FETCH_THREADS_MAX}), "
+          f"learned over {state['batches']} batch(es), last updated {state['updated_at']}")
+    if state['last_success_rate'] is not None:
+        print(f"      last batch: {state['last_success_rate']:.0%} succeeded, {state['last_throttled']} throttled")
+    if state['average_seconds_per_track'] is not None:
+        print(f"      average: {state['average_seconds_per_track']:.1f}s per track")
+    print()
+
+
+def job_lines(jobs: dict[str, dict]) -> list[str]:
+    if not jobs:
+        return ['No jobs in flight']
+
+    lines = []
+    for worker, job in sorted(jobs.items()):
+        line = f"{worker}: {job['stage']}"
+        if job.get('artist'):
+            line += f" of '{job['artist']}'"
+        if job.get('tracks_total') is not None:
+            line += f", {job['tracks_done']}/{job['tracks_total']} track(s)"
+        if job.get('bytes_downloaded'):
+            line += f", {job['bytes_downloaded'] / 1e6:.1f} MB"
+        lines.append(f"{line} (since {job['started_at']})")
+        if job.get('last_track'):
+            lines.append(f"      last track: {job['last_track']}")
+    return lines
+
+
+def artist_lines(artist: dict) -> list[str]:
+    lines = [f'{artist["name"]} ( {artist["url"]} )' if artist.get('name') else artist['url']]
+    for key in store.ARTIST_FETCH_COLUMNS:
+        # Most fetches have the default priority, it's only shown when it was changed
+        if key not in ('name', 'url') and artist.get(key) not in (None, 'normal'):
+            lines.append(f'      {key}: {artist[key]}')
+    if disk_usage := artist.get('disk_usage'):
+        lines.append('      disk: ' + ', '.join(f'{size / 1e6:.1f} MB {kind}' for kind, size in disk_usage.items()))
+    return lines
+
+
+def show_artist(artist: dict):
+    print('\n'.join(artist_lines(artist)))
 
 
 if __name__ == '__main__':
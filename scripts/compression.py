@@ -0,0 +1,117 @@
+import logging
+import tarfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Iterable
+
+from consts import FetcherException, PACK_THREADS, PACK_BLOCK_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extension appended to the tar payload's name for each codec
+CODEC_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'store': '',
+}
+
+
+def _compress_gzip_member(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    # Compresses fixed-size blocks on a thread pool, each into its own gzip member.
+    # Concatenated members are a valid gzip stream, so standard gunzip can still read the result.
+    def __init__(self, fileobj: BinaryIO, level: int, threads: int = PACK_THREADS, block_size: int = PACK_BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = block_size
+        self._max_pending = threads * 2
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='gzip')
+        self._pending: deque[Future] = deque()
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        # Bounded, so a slow destination doesn't make the whole payload pile up in memory
+        while len(self._pending) >= self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(_compress_gzip_member, block, self._level))
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+
+
+class StoreWriter:
+    def __init__(self, fileobj: BinaryIO):
+        self._fileobj = fileobj
+
+    def write(self, data: bytes) -> int:
+        return self._fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+# The returned writer's close() finishes the compressed stream but leaves `fileobj` open
+def open_compressor(fileobj: BinaryIO, codec: str, level: int):
+    if codec == 'gzip':
+        return ParallelGzipWriter(fileobj, level)
+    if codec == 'store':
+        return StoreWriter(fileobj)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise FetcherException('The zstd codec requires the \'zstandard\' package to be installed')
+        return zstandard.ZstdCompressor(level=level, threads=PACK_THREADS).stream_writer(fileobj, closefd=False)
+
+    raise FetcherException(f"Unknown packing codec '{codec}', expected one of {', '.join(CODEC_EXTENSIONS)}")
+
+
+def pack_entries(
+        entries: Iterable[tuple[Path, str]],
+        fileobj: BinaryIO,
+        codec: str,
+        level: int,
+        recursive: bool = True
+) -> int:
+    compressor = open_compressor(fileobj, codec, level)
+    count = 0
+    with tarfile.open(fileobj=compressor, mode='w|') as tar:
+        for path, arcname in entries:
+            tar.add(path, arcname=arcname, recursive=recursive)
+            count += 1
+    compressor.close()
+    return count
+
+
+# Equivalent of `tar cf - <name>/*` from the directory's parent, without the directory's own entry
+def directory_entries(directory: Path) -> list[tuple[Path, str]]:
+    return [
+        (child, f'{directory.name}/{child.name}')
+        for child in sorted(directory.iterdir())
+        if not child.name.startswith('.')
+    ]
+
+
+def pack_directory(directory: Path, fileobj: BinaryIO, codec: str, level: int):
+    logging.info(f'Packing {directory} ({codec}, level {level})')
+    count = pack_entries(directory_entries(directory), fileobj, codec, level)
+    logging.info(f'Packed {count} top-level entries from {directory}')
@@ -0,0 +1,107 @@
+import contextlib
+import json
+import re
+import threading
+from datetime import datetime
+
+import store
+from consts import FETCH_THREADS_MIN, FETCH_THREADS_MAX, FETCH_THREADS_INITIAL, DATETIME_FORMAT
+
+CONTROLLER_STATE_KEY = 'download_concurrency'
+
+# Errors meaning the providers are throttling us, rather than a song not being available
+THROTTLE_PATTERN = re.compile(r'\b(403|429)\b|Too Many Requests|rate.?limit|Sign in to confirm', re.IGNORECASE)
+
+SUCCESS_RATE_TO_INCREASE = 0.95
+DECREASE_FACTOR = 0.5
+# A batch this much slower per track than the running average counts as congestion
+LATENCY_TOLERANCE = 1.5
+LATENCY_SMOOTHING = 0.3
+# Smaller batches are dominated by spotdl's start-up time, their latency says little about the providers
+LATENCY_MIN_TRACKS = 10
+
+
+# Additive-increase/multiplicative-decrease of the total download threads, shared by all fetch workers.
+# The learned setting is persisted in the store, so it carries over between runs.
+class ConcurrencyController:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active_downloads = 0
+        self._state = {
+            'threads': FETCH_THREADS_INITIAL,
+            'average_seconds_per_track': None,
+            'last_success_rate': None,
+            'last_throttled': 0,
+            'batches': 0,
+            'updated_at': None,
+        }
+        if persisted := store.get_state(CONTROLLER_STATE_KEY):
+            self._state.update(json.loads(persisted))
+        self._state['threads'] = min(max(self._state['threads'], FETCH_THREADS_MIN), FETCH_THREADS_MAX)
+
+    # Splits the thread budget between the artists being downloaded at the same time
+    @contextlib.contextmanager
+    def download_slot(self):
+        with self._lock:
+            self._active_downloads += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active_downloads -= 1
+
+    def threads_per_download(self) -> int:
+        with self._lock:
+            return max(self._state['threads'] // max(self._active_downloads, 1), 1)
+
+    def record_batch(self, track_count: int, failures: dict[str, str], seconds: float):
+        if track_count == 0:
+            return
+
+        throttled = sum(1 for error in failures.values() if THROTTLE_PATTERN.search(error))
+        success_rate = 1 - len(failures) / track_count
+        seconds_per_track = seconds / track_count
+
+        with self._lock:
+            state = self._state
+            average = state['average_seconds_per_track']
+            latency_sample = track_count >= LATENCY_MIN_TRACKS
+            congested = latency_sample and average is not None and seconds_per_track > average * LATENCY_TOLERANCE
+
+            if throttled or congested:
+                state['threads'] = max(int(state['threads'] * DECREASE_FACTOR), FETCH_THREADS_MIN)
+            elif success_rate >= SUCCESS_RATE_TO_INCREASE:
+                state['threads'] = min(state['threads'] + 1, FETCH_THREADS_MAX)
+
+            if latency_sample:
+                state['average_seconds_per_track'] = seconds_per_track if average is None else \
+                    LATENCY_SMOOTHING * seconds_per_track + (1 - LATENCY_SMOOTHING) * average
+            state['last_success_rate'] = success_rate
+            state['last_throttled'] = throttled
+            state['batches'] += 1
+            state['updated_at'] = datetime.now().strftime(DATETIME_FORMAT)
+            persisted = json.dumps(state)
+
+        store.set_state(CONTROLLER_STATE_KEY, persisted)
+
+    def state(self) -> dict:
+        with self._lock:
+            return {**self._state, 'active_downloads': self._active_downloads}
+
+
+def read_controller_state() -> dict | None:
+    if persisted := store.get_state(CONTROLLER_STATE_KEY):
+        return json.loads(persisted)
+    return None
+
+
+_controller: ConcurrencyController | None = None
+_controller_lock = threading.Lock()
+
+
+def get_controller() -> ConcurrencyController:
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = ConcurrencyController()
+        return _controller
@@ -9,35 +9,178 @@ class FetcherException(Exception):
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
-MAIN_DIR = Path(__file__).parent.parent
 SCRIPTS_DIR = Path(__file__).parent
+ASSETS_DIR = SCRIPTS_DIR.parent / 'assets'
+# The data and runtime directories can be moved elsewhere, e.g. for the benchmarks
+MAIN_DIR = Path(os.environ.get('SPOTIFETCH_MAIN_DIR', SCRIPTS_DIR.parent))
+RUNTIME_DIR = Path(os.environ.get('SPOTIFETCH_RUNTIME_DIR', SCRIPTS_DIR))
 
 OUT_DIR = MAIN_DIR / 'out'
 MUSIC_DIR = MAIN_DIR / 'music'
 STATE_DIR = MAIN_DIR / 'state'
 
-IMPORT_SCRIPT = SCRIPTS_DIR / 'import'
-PACK_SCRIPT = SCRIPTS_DIR / 'pack'
-PACK_IMAGES_SCRIPT = SCRIPTS_DIR / 'pack_images'
+SWING_IMAGES_DIR = MAIN_DIR / 'swingmusic' / 'images'
 
-PRODUCTS_DIR = Path(os.environ['PRODUCTS_DIR'])
-
-COOKIES_FILE = Path(os.environ['COOKIES_FILE'])
+# Shared by the imports of all artists, so it doubles as an index of the albums that were imported
+BEETS_LIBRARY_FILE = STATE_DIR / 'beets' / 'library.db'
 
+# Polling interval, only used when the state files cannot be watched for changes
 SLEEP_IN_LOOP = 5
 
-FETCH_QUEUE_FILE = SCRIPTS_DIR / '.artist_queue.json'
+# Number of concurrent workers for each kind of job in the service
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 1))
+PACK_WORKERS = int(os.environ.get('PACK_WORKERS', 1))
+
+STORE_FILE = RUNTIME_DIR / '.spotifetch.db'
+
+# Legacy JSON queues, migrated into the store on first use
+FETCH_QUEUE_FILE = RUNTIME_DIR / '.artist_queue.json'
 FETCH_ATTEMPT_COUNT = 3
+# Audio providers passed to spotdl, rotated on every retry of the failed tracks
+FETCH_AUDIO_PROVIDERS = [
+    ('youtube-music', 'youtube'),
+    ('youtube', 'youtube-music'),
+    ('soundcloud', 'youtube-music', 'youtube'),
+]
+# The queue runs the artists with the fewest tracks first. Every FETCH_AGING_HOURS an artist waits counts like halving its
+# tracks, so large artists still get their turn between a stream of small ones.
+FETCH_AGING_HOURS = float(os.environ.get('FETCH_AGING_HOURS', 1))
+# Artists that were never fetched are assumed to have this many tracks
+FETCH_DEFAULT_TRACK_ESTIMATE = 200
+# Every priority class above normal counts like this many hours of waiting
+FETCH_PRIORITY_HOURS = 24
+# Every fetch a requester started recently counts like this many hours less waiting for the requester's other fetches,
+# it's halved every FETCH_FAIRNESS_HALF_LIFE
+FETCH_FAIRNESS_HOURS = 2
+FETCH_FAIRNESS_HALF_LIFE = timedelta(hours=6)
+# Doubled before every retry of the failed tracks
+FETCH_RETRY_BACKOFF = timedelta(seconds=30)
+# Tracks are downloaded in batches, the download threads are adjusted between batches within these bounds
+FETCH_BATCH_SIZE = 20
+FETCH_THREADS_INITIAL = 5
+FETCH_THREADS_MIN = int(os.environ.get('FETCH_THREADS_MIN', 1))
+FETCH_THREADS_MAX = int(os.environ.get('FETCH_THREADS_MAX', 12))
 FETCH_EXECUTION_TIMEOUT = timedelta(minutes=40)
-
-PACKER_QUEUE_FILE = SCRIPTS_DIR / '.packer_jobs.json'
+# A step that neither prints anything nor writes any files for this long is considered hung
+FETCH_STALL_TIMEOUT = timedelta(minutes=10)
+# Per album, albums are imported in parallel by this many beets processes
+IMPORT_EXECUTION_TIMEOUT = timedelta(minutes=30)
+IMPORT_STALL_TIMEOUT = timedelta(minutes=15)
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 4))
+# Albums are imported and packed while the rest of the artist is still downloading, 0 leaves it all to the packer job
+ALBUM_PIPELINE = os.environ.get('ALBUM_PIPELINE', '1') == '1'
+# Imported albums waiting to be packed, the imports pause once the packing falls this far behind
+PIPELINE_QUEUE_SIZE = 4
+# Seconds between checks whether Swing Music has picked up the artist, before its albums can be imported
+PIPELINE_POLL_INTERVAL = 5
+
+# spotdl and yt-dlp run from a virtualenv under state/toolchain, which is updated in the background and swapped in
+# between jobs. Until one was installed, the tools on the PATH are used.
+TOOLCHAIN_DIR = STATE_DIR / 'toolchain'
+TOOLCHAIN_PACKAGES = os.environ.get('TOOLCHAIN_PACKAGES', 'spotdl yt-dlp bgutil-ytdlp-pot-provider').split()
+# Hours between checks for new releases, 0 disables the updates
+TOOLCHAIN_CHECK_INTERVAL = timedelta(hours=float(os.environ.get('TOOLCHAIN_CHECK_INTERVAL_HOURS', 6)))
+TOOLCHAIN_INSTALL_TIMEOUT = timedelta(minutes=15)
+# An update is rolled back when this many of its first runs fail without a single one succeeding
+TOOLCHAIN_ROLLBACK_FAILURES = 3
+
+# Applied to every external job process, so jobs don't starve the rest of the host.
+# Limits are in prlimit's units (bytes of address space, seconds of CPU time), 0 disables them.
+JOB_NICENESS = int(os.environ.get('JOB_NICENESS', 10))
+JOB_IONICE_LEVEL = int(os.environ.get('JOB_IONICE_LEVEL', 7))
+JOB_MEMORY_LIMIT = int(os.environ.get('JOB_MEMORY_LIMIT', 0))
+JOB_CPU_TIME_LIMIT = int(os.environ.get('JOB_CPU_TIME_LIMIT', 0))
+
+PACKER_QUEUE_FILE = RUNTIME_DIR / '.packer_jobs.json'
 
 MUSIC_FILE_GLOB = '*.mp3'
 
-SHOULD_STOP_FILE = SCRIPTS_DIR / '.should_stop.txt'
-
-# Leeway to let Swing sync all songs before packing them, for fetching artist images
+# Packing codec ('gzip', 'zstd' or 'store') and level per product type.
+# MP3s barely compress, so music defaults to the fastest gzip level.
+PACK_CODECS = {
+    'music': (os.environ.get('MUSIC_PACK_CODEC', 'gzip'), int(os.environ.get('MUSIC_PACK_LEVEL', 1))),
+    'artist-images': (os.environ.get('IMAGES_PACK_CODEC', 'gzip'), int(os.environ.get('IMAGES_PACK_LEVEL', 9))),
+}
+# The service packs the new artist images into a product once at least this many have accumulated
+IMAGES_PACK_MIN_NEW = int(os.environ.get('IMAGES_PACK_MIN_NEW', 50))
+IMAGES_PACK_CHECK_INTERVAL = timedelta(minutes=10)
+PACK_THREADS = int(os.environ.get('PACK_THREADS', os.cpu_count() or 1))
+PACK_BLOCK_SIZE = 4 * 1024 * 1024
+
+SHOULD_STOP_FILE = RUNTIME_DIR / '.should_stop.txt'
+# The running service takes the CLI's commands on this socket, the files above remain the fallback without it
+CONTROL_SOCKET_FILE = RUNTIME_DIR / '.control.sock'
+CONTROL_TIMEOUT = 30
+
+# Every stage of every job is appended to the trace file, which is rotated once it grows past the limit
+TRACE_FILE = STATE_DIR / 'trace.jsonl'
+TRACE_MAX_BYTES = 64 * 1024 * 1024
+# Prometheus metrics of the service, a port of 0 disables the endpoint
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+
+# Songs are packed as soon as Swing has indexed the artist and fetched its images, or after this leeway at the latest
 PACKER_LEEWAY_SINCE_FETCH = timedelta(minutes=30)
-
-# Acquired from the cookie "access_token_cookie"
-SWING_ACCESS_TOKEN = os.environ['SWING_ACCESS_TOKEN']
+# Delay before re-checking a packer job whose artist had no music files yet
+PACKER_RETRY_DELAY = timedelta(minutes=5)
+
+# Jobs are only started once their estimated footprint fits on the disk, next to what the jobs in flight may still
+# write, leaving this much free
+STORAGE_MIN_FREE = int(float(os.environ.get('STORAGE_MIN_FREE_GB', 5)) * 1024 ** 3)
+# Size of a downloaded track, to estimate the footprint of a fetch
+STORAGE_TRACK_BYTES = 10 * 1024 * 1024
+# Seconds before fetches that didn't fit are tried again, unless a job finishes earlier
+STORAGE_RETRY_INTERVAL = 60
+# Leftovers of artists that are neither queued nor waiting to be packed are removed once they're this old.
+# Manifests are kept, they're needed for the artists' next delta products.
+STORAGE_RETENTION = timedelta(days=float(os.environ.get('STORAGE_RETENTION_DAYS', 7)))
+STORAGE_GC_INTERVAL = timedelta(hours=6)
+# Error logs kept per queued artist, older ones are removed along with the leftovers
+STORAGE_ERROR_LOGS_KEPT = 3
+# Products left half-written by a crash
+STORAGE_PARTIAL_RETENTION = timedelta(days=1)
+
+# Spotify Web API credentials, shared by spotdl and the artist name resolver
+SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID', '2f2a55464aed4ad19abf145795e65dfc')
+SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET', 'a3fb18b7b2a648a5bd32fa6f09f81b84')
+# spotdl's Spotify Web API responses are cached across artists and runs, by a hook loaded into spotdl's interpreter
+SPOTDL_HOOKS_DIR = SCRIPTS_DIR / 'spotdl_hooks'
+SPOTIFY_CACHE_FILE = STATE_DIR / 'spotify_cache.db'
+# Days albums and tracks are cached for, 0 disables the cache
+SPOTIFY_CACHE_TTL = timedelta(days=float(os.environ.get('SPOTIFY_CACHE_TTL_DAYS', 30)))
+# Discographies and searches change with every release, they are cached for a shorter time
+SPOTIFY_CACHE_LISTING_TTL = timedelta(hours=12)
+# The least recently used responses are evicted once the cache grows past this
+SPOTIFY_CACHE_MAX_BYTES = int(float(os.environ.get('SPOTIFY_CACHE_MAX_MB', 512)) * 1024 * 1024)
+
+ARTIST_NAME_CACHE_TTL = timedelta(days=30)
+RESOLVER_CONCURRENCY = 8
+
+SWING_URL = os.environ.get('SWING_URL', 'http://localhost:1970')
+SWING_READINESS_INTERVAL = 15
+# Artists finishing within this window of each other share a single rescan
+SWING_SCAN_DEBOUNCE = timedelta(seconds=20)
+# A rescan is not triggered again while the previous one is likely still running
+SWING_SCAN_MIN_INTERVAL = timedelta(minutes=2)
+
+# Settings only the service and the packing commands need, read from the environment on first use,
+# so the read-only commands work without them
+_REQUIRED_SETTINGS = {
+    'PRODUCTS_DIR': lambda: Path(os.environ['PRODUCTS_DIR']),
+    'COOKIES_FILE': lambda: Path(os.environ['COOKIES_FILE']),
+    # Acquired from the cookie "access_token_cookie"
+    'SWING_ACCESS_TOKEN': lambda: os.environ['SWING_ACCESS_TOKEN'],
+}
+
+
+def __getattr__(name: str):
+    if name not in _REQUIRED_SETTINGS:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+    try:
+        value = _REQUIRED_SETTINGS[name]()
+    except KeyError:
+        raise FetcherException(f'The environment variable {name} is required for this command') from None
+
+    globals()[name] = value
+    return value
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from datetime import datetime
+from typing import Iterator
+
+import progress
+import store
+from consts import CONTROL_SOCKET_FILE, CONTROL_TIMEOUT, DATETIME_FORMAT, FetcherException
+
+EDITABLE_FIELDS = {'name', 'status', 'ignore_errors', 'priority'}
+# Progress is streamed on every change, and at least this often so durations keep moving
+PROGRESS_STREAM_INTERVAL = 5
+
+
+def queue_artist_fetches(fetches: list[dict], replace: bool = True) -> int:
+    from models.artist_fetch import ArtistFetch
+    from resolver import canonicalize_artist_url
+
+    models = [ArtistFetch(**{**fetch, 'url': canonicalize_artist_url(fetch['url'])}) for fetch in fetches]
+    store.upsert_artist_fetches([model.model_dump() for model in models], replace=replace)
+    return len(models)
+
+
+# Only the edited columns are written, so the edit doesn't undo what a worker changed in the meantime
+def edit_artist_fetch(url: str, fields: dict) -> dict:
+    from models.artist_fetch import ArtistFetch
+
+    if unknown_fields := set(fields) - EDITABLE_FIELDS:
+        raise ValueError(f'Fields {", ".join(sorted(unknown_fields))} cannot be edited')
+    if not (fetch := store.get_artist_fetch(url)):
+        raise ValueError(f'No artist fetch queued for {url}')
+
+    edited = ArtistFetch(**{**fetch, **fields}).model_dump(include=set(fields))
+    store.update_artist_fetch_fields(url, edited)
+    return store.get_artist_fetch(url)
+
+
+# Requests and responses are single lines of JSON, a connection carries one request. Its response is either
+# {'ok': true, 'result': ...} or {'ok': false, 'error': ...}, a followed progress request is answered with a line per change.
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            arguments = json.loads(self.rfile.readline())
+            command = arguments.pop('command')
+            if command == 'progress' and arguments.get('follow'):
+                self.stream_progress()
+                return
+
+            response = {'ok': True, 'result': self.server.execute(command, arguments)}
+        except (ValueError, KeyError, TypeError) as ex:
+            response = {'ok': False, 'error': str(ex)}
+        except Exception as ex:
+            logging.exception('Exception occurred while handling a control request')
+            response = {'ok': False, 'error': f'{type(ex).__name__}: {ex}'}
+
+        self.send(response)
+
+    def send(self, response: dict):
+        self.wfile.write(json.dumps(response, default=str).encode() + b'\n')
+        self.wfile.flush()
+
+    def stream_progress(self):
+        version = -1
+        try:
+            while not self.server.scheduler.stopping:
+                version, jobs = progress.wait_for_change(version, timeout=PROGRESS_STREAM_INTERVAL)
+                self.send({'ok': True, 'result': {'jobs': jobs, 'stopping': self.server.scheduler.draining}})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, scheduler, workers: dict[str, int]):
+        self.scheduler = scheduler
+        self.workers = workers
+        self.started_at = datetime.now()
+        self.commands = {
+            'status': self.status,
+            'progress': lambda follow=False: {'jobs': progress.snapshot()[1], 'stopping': scheduler.draining},
+            'queue': self.queue,
+            'edit': self.edit,
+            'stop': self.stop,
+            'unstop': lambda: {'cancelled': scheduler.cancel_stop()},
+        }
+        super().__init__(str(CONTROL_SOCKET_FILE), ControlHandler)
+
+    def server_close(self):
+        super().server_close()
+        CONTROL_SOCKET_FILE.unlink(missing_ok=True)
+
+    def execute(self, command: str, arguments: dict):
+        if command not in self.commands:
+            raise ValueError(f'Unknown command \'{command}\'')
+        return self.commands[command](**arguments)
+
+    def status(self) -> dict:
+        from concurrency import get_controller
+
+        return {
+            'pid': os.getpid(),
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'stopping': self.scheduler.draining or self.scheduler.stopping,
+            'workers': self.workers,
+            'download_threads': get_controller().state()['threads'],
+            'queues': store.count_queues(datetime.now().strftime(DATETIME_FORMAT)),
+            'jobs': progress.snapshot()[1],
+        }
+
+    # Written by the service itself, so the workers pick the fetches up without waiting on the file watcher
+    def queue(self, fetches: list[dict], replace: bool = True) -> dict:
+        queued = queue_artist_fetches(fetches, replace)
+        self.scheduler.notify()
+        return {'queued': queued}
+
+    def edit(self, url: str, fields: dict) -> dict:
+        fetch = edit_artist_fetch(url, fields)
+        self.scheduler.notify()
+        return fetch
+
+    def stop(self) -> dict:
+        self.scheduler.request_stop()
+        return {'stopping': True}
+
+
+def _connect() -> socket.socket | None:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(CONTROL_TIMEOUT)
+    try:
+        connection.connect(str(CONTROL_SOCKET_FILE))
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def _responses(connection: socket.socket, command: str, arguments: dict) -> Iterator[dict]:
+    with connection, connection.makefile('rb') as responses:
+        connection.sendall(json.dumps({**arguments, 'command': command}).encode() + b'\n')
+        for line in responses:
+            response = json.loads(line)
+            if not response['ok']:
+                raise FetcherException(f'The service refused \'{command}\': {response["error"]}')
+            yield response['result']
+
+
+# Sends a command to the running service, returns None when no service is listening
+def request(command: str, **arguments) -> dict | None:
+    if not (connection := _connect()):
+        return None
+
+    for result in _responses(connection, command, arguments):
+        return result
+    raise FetcherException(f'The service closed the connection before answering \'{command}\'')
+
+
+# Follows the live progress of the running service, returns None when no service is listening
+def follow_progress() -> Iterator[dict] | None:
+    if not (connection := _connect()):
+        return None
+    # Progress is only sent on changes, the heartbeat keeps the connection from timing out
+    connection.settimeout(CONTROL_TIMEOUT + PROGRESS_STREAM_INTERVAL)
+    return _responses(connection, 'progress', {'follow': True})
+
+
+def serve_control_socket(scheduler, workers: dict[str, int]) -> ControlServer | None:
+    if connection := _connect():
+        connection.close()
+        logging.warning(f'Another service is listening on {CONTROL_SOCKET_FILE}, the CLI will talk to that one')
+        return None
+
+    try:
+        # Left behind by a service that didn't exit cleanly
+        CONTROL_SOCKET_FILE.unlink(missing_ok=True)
+        server = ControlServer(scheduler, workers)
+        os.chmod(CONTROL_SOCKET_FILE, 0o600)
+    except OSError:
+        logging.exception(f'Could not listen on {CONTROL_SOCKET_FILE}, the CLI falls back to the queue and stop files')
+        return None
+
+    threading.Thread(target=server.serve_forever, name='control', daemon=True).start()
+    logging.info(f'Listening for commands on {CONTROL_SOCKET_FILE}')
+    return server
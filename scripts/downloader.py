@@ -0,0 +1,275 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import importer
+import metrics
+import progress
+import store
+import toolchain
+from concurrency import get_controller
+from consts import FETCH_ATTEMPT_COUNT, FetcherException, COOKIES_FILE, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, \
+    FETCH_AUDIO_PROVIDERS, FETCH_RETRY_BACKOFF, FETCH_BATCH_SIZE, FETCH_EXECUTION_TIMEOUT, FETCH_STALL_TIMEOUT, \
+    SPOTDL_HOOKS_DIR, SPOTIFY_CACHE_FILE, SPOTIFY_CACHE_TTL, SPOTIFY_CACHE_LISTING_TTL, SPOTIFY_CACHE_MAX_BYTES
+from models.artist_fetch import ArtistFetch
+from processes import run_supervised
+
+# spotdl's --save-errors file has a line per failed song, starting with the song's URL
+ERROR_LINE_PATTERN = re.compile(r'(https://open\.spotify\.com/track/[A-Za-z0-9]+)\s*-?\s*(.*)')
+# spotdl prints a line for every song it's done with
+FINISHED_SONG_PATTERN = re.compile(r'^(?:Downloaded "(.+)": |Skipping (.+?) \()')
+
+SONG_LIST_FILE_NAME = 'cache.spotdl'
+BATCH_FILE_NAME = 'batch.spotdl'
+
+
+def parse_error_file(error_file: Path) -> dict[str, str]:
+    failures = {}
+    for line in error_file.read_text(errors='replace').splitlines():
+        if match := ERROR_LINE_PATTERN.search(line):
+            failures[match.group(1)] = match.group(2).strip()
+    return failures
+
+
+# spotdl's interpreter loads the hook caching its Spotify lookups from the PYTHONPATH
+def spotdl_environment() -> dict[str, str] | None:
+    if not SPOTIFY_CACHE_TTL:
+        return None
+
+    from spotdl_hooks import spotify_cache
+
+    python_path = os.pathsep.join(filter(None, [str(SPOTDL_HOOKS_DIR), os.environ.get('PYTHONPATH')]))
+    return {
+        **os.environ,
+        'PYTHONPATH': python_path,
+        spotify_cache.CACHE_FILE_VARIABLE: str(SPOTIFY_CACHE_FILE),
+        spotify_cache.TTL_VARIABLE: str(SPOTIFY_CACHE_TTL.total_seconds()),
+        spotify_cache.LISTING_TTL_VARIABLE: str(SPOTIFY_CACHE_LISTING_TTL.total_seconds()),
+        spotify_cache.MAX_BYTES_VARIABLE: str(SPOTIFY_CACHE_MAX_BYTES),
+    }
+
+
+# Fetches the metadata of every song in the artist's discography, without downloading anything
+def save_song_list(artist: ArtistFetch) -> list[dict]:
+    song_list_file = artist.state_dir / SONG_LIST_FILE_NAME
+    with metrics.span('spotdl_save') as save_span:
+        report = run_supervised(
+            'spotdl save',
+            f"'{toolchain.executable('spotdl')}' --save-file '{song_list_file}' --fetch-albums --log-level=DEBUG save {artist.url} --client-id '{SPOTIFY_CLIENT_ID}' --client-secret '{SPOTIFY_CLIENT_SECRET}'",
+            timeout=FETCH_EXECUTION_TIMEOUT,
+            stall_timeout=FETCH_STALL_TIMEOUT,
+            progress_paths=[artist.state_dir],
+            env=spotdl_environment()
+        )
+        save_span.failed = bool(report.killed_reason or report.return_code > 0)
+        toolchain.record_run(not save_span.failed)
+
+    if report.killed_reason or report.return_code > 0 or not song_list_file.is_file():
+        raise FetcherException(f'Fetching the artist\'s song list failed: {report.summary()}')
+
+    return json.loads(song_list_file.read_text())
+
+
+def run_spotdl(
+        artist: ArtistFetch,
+        queries: list[str],
+        audio_providers: tuple[str, ...],
+        threads: int,
+        on_output_line: Callable[[str], None] | None = None
+) -> dict[str, str]:
+    error_file = artist.generate_error_file()
+
+    report = run_supervised(
+        'spotdl download',
+        # f"spotdl --format mp3 --output '{out_dir}/{{album-artist}}/{{album}}/{{title}}.{{output-ext}}' --yt-dlp-args '-f bestaudio* --cookies {COOKIES_FILE} --extractor-args \"youtubepot-bgutilhttp:base_url=http://127.0.0.1:4416\"' --max-retries 1 --threads 6 --save-errors '{error_file}' --id3-separator ', ' --log-level=DEBUG download {artist.url} --audio youtube youtube-music soundcloud --generate-lrc --lyrics synced genius azlyrics musixmatch --genius-access-token 'V1cJYvWbhzkZ8saefsEwi_ZVI1ZmPUjnNRb3XTvtgTN9YLEYNm5IuFrPqYbebjQQ'",
+        f"'{toolchain.executable('spotdl')}' --format mp3 --output '{artist.out_dir}/{{album-artist}}/{{album}}/{{title}}.{{output-ext}}' --yt-dlp-args '--format-sort-force -S abr,acodec --format bestaudio* --cookies {COOKIES_FILE} --extractor-args=\"youtubepot-bgutilhttp:base_url=http://127.0.0.1:4416\"' --max-retries 1 --threads {threads} --save-errors '{error_file}' --id3-separator ', ' --log-level=DEBUG download {' '.join(queries)} --audio {' '.join(audio_providers)} --generate-lrc --lyrics synced genius azlyrics --genius-access-token 'V1cJYvWbhzkZ8saefsEwi_ZVI1ZmPUjnNRb3XTvtgTN9YLEYNm5IuFrPqYbebjQQ' --client-id '{SPOTIFY_CLIENT_ID}' --client-secret '{SPOTIFY_CLIENT_SECRET}'",
+        timeout=FETCH_EXECUTION_TIMEOUT,
+        stall_timeout=FETCH_STALL_TIMEOUT,
+        progress_paths=[artist.out_dir],
+        on_output_line=on_output_line,
+        env=spotdl_environment()
+    )
+    toolchain.record_run(not (report.killed_reason or report.return_code > 0))
+
+    if report.killed_reason or report.return_code > 0:
+        raise FetcherException(f'Fetch command failed: {report.summary()}')
+
+    if not error_file.is_file():
+        raise FetcherException('Error file was not created, fetch did not finish')
+
+    return parse_error_file(error_file)
+
+
+# Songs with known metadata are passed to spotdl through a .spotdl file, sparing a Spotify lookup per song
+def _batch_queries(artist: ArtistFetch, batch: list[dict | str]) -> list[str]:
+    songs = [song for song in batch if isinstance(song, dict)]
+    queries = [song for song in batch if isinstance(song, str)]
+    if songs:
+        batch_file = artist.state_dir / BATCH_FILE_NAME
+        batch_file.write_text(json.dumps(songs))
+        queries.append(f"'{batch_file}'")
+    return queries
+
+
+def _song_url(song: dict | str) -> str:
+    return song['url'] if isinstance(song, dict) else song
+
+
+def _album_key(song: dict | str) -> str:
+    return (song.get('album_id') or song.get('album_name') or '') if isinstance(song, dict) else ''
+
+
+# Album directories are named by spotdl after the album, minus the characters it doesn't allow in paths
+def _album_dir_key(name: str) -> str:
+    return ''.join(character for character in name.casefold() if character.isalnum())
+
+
+# Album directories that songs still to be downloaded may be written to, None when that can't be told
+def _upcoming_albums(songs: list[dict | str]) -> set[str] | None:
+    if not all(isinstance(song, dict) and song.get('album_name') for song in songs):
+        return None
+    return {_album_dir_key(song['album_name']) for song in songs}
+
+
+# Downloads songs in batches, so the number of download threads can follow how the providers are coping.
+# The songs are downloaded album by album, an album is complete once no more songs are coming for it, and is passed
+# to `on_albums_downloaded` right away.
+def download_songs(
+        artist: ArtistFetch,
+        songs: list[dict | str],
+        audio_providers: tuple[str, ...],
+        on_albums_downloaded: Callable[[dict[str, Path]], None] | None = None
+) -> dict[str, str]:
+    controller = get_controller()
+    failures = {}
+    songs = sorted(songs, key=_album_key)
+    albums = importer.find_albums(artist.out_dir) if on_albums_downloaded else {}
+    unfinished, passed_on = set(), set()
+
+    def pass_on(sources: set[str]):
+        if downloaded := {source: albums[source][0] for source in sorted(sources) if source in albums}:
+            passed_on.update(downloaded)
+            on_albums_downloaded(downloaded)
+
+    # Followed from the thread forwarding spotdl's output, so the job is named explicitly
+    job = threading.current_thread().name
+    size_at_start = metrics.directory_size(artist.out_dir)
+    tracks_done = 0
+    progress.update(tracks_total=len(songs), tracks_done=0, bytes_downloaded=0)
+
+    def on_output_line(line: str):
+        nonlocal tracks_done
+        if match := FINISHED_SONG_PATTERN.search(line):
+            tracks_done += 1
+            progress.update(
+                job,
+                tracks_done=tracks_done,
+                last_track=match.group(1) or match.group(2),
+                bytes_downloaded=metrics.directory_size(artist.out_dir) - size_at_start
+            )
+
+    with controller.download_slot():
+        for i in range(0, len(songs), FETCH_BATCH_SIZE):
+            batch = songs[i:i + FETCH_BATCH_SIZE]
+            threads = controller.threads_per_download()
+            logging.info(f'Downloading songs {i + 1}-{i + len(batch)}/{len(songs)} with {threads} thread(s)')
+
+            start = time.monotonic()
+            size_before = metrics.directory_size(artist.out_dir)
+            with metrics.span('spotdl_batch', tracks=len(batch), threads=threads) as batch_span:
+                try:
+                    batch_failures = run_spotdl(artist, _batch_queries(artist, batch), audio_providers, threads, on_output_line)
+                except FetcherException as ex:
+                    # The whole batch is retried as failed tracks, rather than losing the batches before it
+                    logging.exception('Exception occurred while downloading a batch of songs')
+                    batch_failures = {_song_url(song): str(ex) for song in batch}
+
+                batch_span.bytes = metrics.directory_size(artist.out_dir) - size_before
+                batch_span.attributes['failed_tracks'] = len(batch_failures)
+
+            controller.record_batch(len(batch), batch_failures, time.monotonic() - start)
+            failures.update(batch_failures)
+
+            if on_albums_downloaded:
+                previous, albums = albums, importer.find_albums(artist.out_dir)
+                written = {source for source, album in albums.items() if previous.get(source) != album}
+                candidates = unfinished | written
+                if (upcoming := _upcoming_albums(songs[i + FETCH_BATCH_SIZE:])) is None:
+                    # Without the albums of the songs, an album is complete once a batch went by without writing to it
+                    pending = written
+                else:
+                    pending = {source for source in candidates if _album_dir_key(Path(source).name) in upcoming}
+                pass_on(candidates - pending)
+                unfinished = pending
+
+    # Along with the albums left behind by an earlier fetch of the artist
+    if on_albums_downloaded:
+        albums = importer.find_albums(artist.out_dir)
+        pass_on(unfinished | (set(albums) - passed_on))
+
+    return failures
+
+
+# Downloads the artist's discography once, then retries only the tracks that failed, with backoff and a different
+# set of audio providers per attempt. Resumes from the persisted failed tracks if a previous run got that far.
+# Returns the tracks that still failed.
+def download_artist(
+        artist: ArtistFetch,
+        on_albums_downloaded: Callable[[dict[str, Path]], None] | None = None
+) -> dict[str, str]:
+    failed_tracks = {failure['track_url']: failure['last_error'] for failure in store.read_track_failures(artist.url_hash)}
+    discography_fetched = bool(failed_tracks)
+    if discography_fetched:
+        logging.info(f"Resuming '{artist.name}' from {len(failed_tracks)} failed track(s)")
+
+    song_list_file = artist.state_dir / SONG_LIST_FILE_NAME
+    songs_by_url = {song['url']: song for song in json.loads(song_list_file.read_text())} \
+        if discography_fetched and song_list_file.is_file() else {}
+
+    for attempt_count in range(FETCH_ATTEMPT_COUNT):
+        audio_providers = FETCH_AUDIO_PROVIDERS[attempt_count % len(FETCH_AUDIO_PROVIDERS)]
+        try:
+            if not discography_fetched:
+                songs = save_song_list(artist)
+                songs_by_url = {song['url']: song for song in songs}
+                store.set_artist_size(artist.url_hash, len(songs))
+                logging.info(f"Downloading {len(songs)} song(s) of '{artist.name}'")
+
+                failed_tracks = download_songs(artist, songs, audio_providers, on_albums_downloaded)
+                store.set_track_failures(artist.url_hash, None, failed_tracks, audio_providers)
+                discography_fetched = True
+            else:
+                backoff = FETCH_RETRY_BACKOFF * 2 ** attempt_count
+                logging.info(
+                    f'Retrying {len(failed_tracks)} failed track(s) with {", ".join(audio_providers)} '
+                    f'in {backoff.total_seconds():.0f}s'
+                )
+                time.sleep(backoff.total_seconds())
+
+                attempted = sorted(failed_tracks)
+                failed_tracks = download_songs(
+                    artist,
+                    [songs_by_url.get(track_url, track_url) for track_url in attempted],
+                    audio_providers,
+                    on_albums_downloaded
+                )
+                store.set_track_failures(artist.url_hash, attempted, failed_tracks, audio_providers)
+
+            if not failed_tracks or artist.ignore_errors:
+                break
+
+        except Exception:
+            logging.exception('Exception occurred while fetching artist')
+
+        if attempt_count < FETCH_ATTEMPT_COUNT - 1:
+            logging.info(f"Fetching '{artist.name}', attempt {attempt_count + 2}/{FETCH_ATTEMPT_COUNT}")
+
+    if not discography_fetched:
+        raise FetcherException(f"Could not fetch the discography of '{artist.name}'")
+
+    return failed_tracks
@@ -0,0 +1,143 @@
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from consts import ASSETS_DIR, STATE_DIR, BEETS_LIBRARY_FILE, MUSIC_FILE_GLOB, IMPORT_WORKERS, \
+    IMPORT_EXECUTION_TIMEOUT, IMPORT_STALL_TIMEOUT
+from models.step_report import StepReport
+from processes import run_supervised
+
+BEETS_CONFIG_TEMPLATE = ASSETS_DIR / 'beets.yaml'
+
+# Flexible attributes set on every imported album, so the library can be used as an index of what was imported
+ARTIST_FIELD = 'spotifetch_artist'
+SOURCE_FIELD = 'spotifetch_source'
+
+# Seconds a beets process waits for the library lock, while other shards are writing to it
+LIBRARY_LOCK_TIMEOUT = 300
+
+
+# spotdl writes every album to its own directory, each of them is imported as a separate shard
+def find_albums(out_dir: Path) -> dict[str, tuple[Path, int]]:
+    albums = {}
+    for album_dir in {song.parent for song in out_dir.rglob(MUSIC_FILE_GLOB)}:
+        albums[album_dir.relative_to(out_dir).as_posix()] = (album_dir, len(list(album_dir.glob(MUSIC_FILE_GLOB))))
+    return albums
+
+
+def _read_library(query: str, parameters: tuple) -> list[tuple]:
+    if not BEETS_LIBRARY_FILE.is_file():
+        return []
+
+    connection = sqlite3.connect(f'{BEETS_LIBRARY_FILE.as_uri()}?mode=ro', uri=True, timeout=LIBRARY_LOCK_TIMEOUT)
+    try:
+        return connection.execute(query, parameters).fetchall()
+    except sqlite3.OperationalError:
+        # The library was not initialized by beets yet
+        return []
+    finally:
+        connection.close()
+
+
+# Maps the source of every album of the artist in the library to the number of tracks imported from it
+def imported_albums(url_hash: str) -> dict[str, int]:
+    rows = _read_library(
+        '''SELECT source.value, COUNT(items.id) FROM albums
+        JOIN album_attributes artist ON artist.entity_id = albums.id AND artist.key = ? AND artist.value = ?
+        JOIN album_attributes source ON source.entity_id = albums.id AND source.key = ?
+        LEFT JOIN items ON items.album_id = albums.id
+        GROUP BY albums.id''',
+        (ARTIST_FIELD, url_hash, SOURCE_FIELD)
+    )
+
+    imported = {}
+    for source, track_count in rows:
+        imported[source] = max(imported.get(source, 0), track_count)
+    return imported
+
+
+# Albums with songs that are not in the library yet, either never imported or with tracks added since
+def pending_albums(url_hash: str, albums: dict[str, tuple[Path, int]]) -> dict[str, Path]:
+    imported = imported_albums(url_hash)
+    return {source: album_dir for source, (album_dir, song_count) in albums.items() if imported.get(source, 0) < song_count}
+
+
+# Whether the library has tracks of the artist that are still in its music directory, waiting to be packed
+def has_imported_music(url_hash: str) -> bool:
+    rows = _read_library(
+        '''SELECT items.path FROM items
+        JOIN album_attributes artist ON artist.entity_id = items.album_id AND artist.key = ? AND artist.value = ?''',
+        (ARTIST_FIELD, url_hash)
+    )
+    return any(os.path.exists(path) for path, in rows)
+
+
+# Directories the tracks imported from an album of the artist were moved to
+def imported_album_dirs(url_hash: str, source: str) -> list[Path]:
+    rows = _read_library(
+        '''SELECT DISTINCT items.path FROM items
+        JOIN album_attributes artist ON artist.entity_id = items.album_id AND artist.key = ? AND artist.value = ?
+        JOIN album_attributes source ON source.entity_id = items.album_id AND source.key = ? AND source.value = ?''',
+        (ARTIST_FIELD, url_hash, SOURCE_FIELD, source)
+    )
+    return sorted({Path(os.fsdecode(path)).parent for path, in rows if os.path.exists(path)})
+
+
+def write_config(url_hash: str, music_dir: Path) -> Path:
+    config_path = STATE_DIR / url_hash / 'beets.yaml'
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Every artist is imported into its own music directory, all of them share a single library
+    config = BEETS_CONFIG_TEMPLATE.read_text() \
+        .replace('REPLACE_DB_PATH', str(BEETS_LIBRARY_FILE)) \
+        .replace('REPLACE_MUSIC_DIR', str(music_dir))
+    config_path.write_text(f'{config}\ntimeout: {LIBRARY_LOCK_TIMEOUT}.0\n')
+    return config_path
+
+
+def prepare_library():
+    BEETS_LIBRARY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(BEETS_LIBRARY_FILE)
+    try:
+        # Lets the shards read the library while another one is writing to it, the setting persists in the file
+        connection.execute('PRAGMA journal_mode=WAL')
+    finally:
+        connection.close()
+
+
+def import_album(url_hash: str, config_path: Path, source: str, album_dir: Path, music_dir: Path) -> StepReport:
+    return run_supervised(
+        f'import {source}',
+        [
+            'beet', '-c', str(config_path), 'import',
+            '-ql', str(STATE_DIR / url_hash / 'import.log'),
+            '--quiet-fallback', 'asis',
+            '--set', f'{ARTIST_FIELD}={url_hash}',
+            '--set', f'{SOURCE_FIELD}={source}',
+            str(album_dir)
+        ],
+        timeout=IMPORT_EXECUTION_TIMEOUT,
+        stall_timeout=IMPORT_STALL_TIMEOUT,
+        progress_paths=[album_dir, music_dir]
+    )
+
+
+# Imports the albums in parallel, one beets process per album. Raises once all albums were attempted, if any failed,
+# the albums that were imported are skipped the next time.
+def import_albums(url_hash: str, albums: dict[str, Path], music_dir: Path):
+    prepare_library()
+    config_path = write_config(url_hash, music_dir)
+
+    logging.info(f'Importing {len(albums)} album(s) with {min(IMPORT_WORKERS, len(albums))} worker(s)')
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='import') as executor:
+        reports = list(executor.map(
+            lambda source: import_album(url_hash, config_path, source, albums[source], music_dir),
+            albums
+        ))
+
+    if failed := [report for report in reports if report.killed_reason or report.return_code != 0]:
+        raise ValueError(
+            f'Importing {len(failed)}/{len(albums)} album(s) failed: ' + '; '.join(report.summary() for report in failed)
+        )
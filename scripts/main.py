@@ -1,19 +1,38 @@
 import ast
 import logging
-import time
+import threading
+from datetime import datetime, timedelta
+from typing import Callable
 
 from rich.logging import RichHandler
 
-from consts import SHOULD_STOP_FILE, SLEEP_IN_LOOP
+import consts
+import metrics
+import storage
+import store
+from concurrency import get_controller
+from control import serve_control_socket
+from consts import SHOULD_STOP_FILE, SLEEP_IN_LOOP, FETCH_WORKERS, PACK_WORKERS, DATETIME_FORMAT, METRICS_HOST, \
+    METRICS_PORT, TOOLCHAIN_CHECK_INTERVAL, SPOTIFY_CACHE_FILE, STORAGE_RETRY_INTERVAL, OUT_DIR, MUSIC_DIR
 from fetcher import fetch_a_pending_artist
+from pack_artist_images import run_scheduled_image_packing
 from packer import execute_a_packer_job
+from scheduler import Scheduler
+from spotdl_hooks.spotify_cache import cache_stats
+from swing import ReadinessChecker
+from toolchain import run_toolchain_updates
 
 
 def should_stop_running() -> bool:
     if not SHOULD_STOP_FILE.is_file():
         return False
 
-    content = SHOULD_STOP_FILE.read_text().splitlines()[0].strip()
+    lines = SHOULD_STOP_FILE.read_text().splitlines()
+    if not lines:
+        # Only just created, its content follows with the next change
+        return False
+
+    content = lines[0].strip()
     should_stop = bool(ast.literal_eval(content))
     if should_stop:
         SHOULD_STOP_FILE.unlink()
@@ -21,7 +40,80 @@ def should_stop_running() -> bool:
     return should_stop
 
 
-def main():
+def run_worker(name: str, execute_a_job: Callable[[str], bool], scheduler: Scheduler, is_pack_worker: bool):
+    while not scheduler.stopping:
+        if scheduler.draining:
+            scheduler.park()
+            continue
+
+        generation = scheduler.generation
+        try:
+            did_work = execute_a_job(name)
+        except storage.InsufficientSpace as ex:
+            logging.warning(f'{ex}, waiting for space to be freed')
+            # Woken up earlier by changes to the queues, e.g. when another job finishes
+            scheduler.wait(generation, until=datetime.now() + timedelta(seconds=STORAGE_RETRY_INTERVAL))
+            continue
+        except Exception:
+            logging.exception(f'Unhandled exception in worker {name}')
+            # Back off instead of immediately retrying whatever caused it
+            scheduler.wait(generation, until=datetime.now() + timedelta(seconds=SLEEP_IN_LOOP))
+            continue
+
+        if did_work:
+            logging.info('Listening for jobs')
+        elif is_pack_worker:
+            scheduler.invalidate()
+            scheduler.wait(generation, until=scheduler.next_pack_time())
+        else:
+            scheduler.wait(generation)
+
+
+def service_gauges() -> list[metrics.Gauge]:
+    queues = store.count_queues(datetime.now().strftime(DATETIME_FORMAT))
+    gauges = [
+        ('spotifetch_queue_depth', {'queue': queue.split('_', 1)[0], 'state': queue.split('_', 1)[1]}, depth)
+        for queue, depth in queues.items()
+    ]
+    gauges.append(('spotifetch_download_threads', {}, get_controller().state()['threads']))
+    spotify_cache = cache_stats(str(SPOTIFY_CACHE_FILE))
+    gauges += [
+        (f'spotifetch_spotify_cache_{name}', {}, spotify_cache[name])
+        for name in ('entries', 'bytes', 'hits', 'misses') if name in spotify_cache
+    ]
+    # Free space left for new jobs, after what the jobs in flight reserved
+    gauges += [
+        ('spotifetch_storage_available_bytes', {'directory': directory}, storage.available_bytes(path))
+        for directory, path in (('out', OUT_DIR), ('music', MUSIC_DIR), ('products', consts.PRODUCTS_DIR))
+    ]
+    gauges.append(('spotifetch_storage_reserved_bytes', {}, storage.reserved_bytes()))
+    return gauges
+
+
+def start_workers(scheduler: Scheduler, fetch_workers: int, pack_workers: int) -> list[threading.Thread]:
+    pools = [
+        ('fetch', fetch_workers, fetch_a_pending_artist, False),
+        ('pack', pack_workers, execute_a_packer_job, True),
+    ]
+
+    workers = []
+    for kind, count, execute_a_job, is_pack_worker in pools:
+        for idx in range(count):
+            name = f'{kind}-{idx + 1}'
+            # Daemon threads, so a second interrupt can still abandon in-flight jobs
+            worker = threading.Thread(
+                target=run_worker,
+                args=(name, execute_a_job, scheduler, is_pack_worker),
+                name=name,
+                daemon=True
+            )
+            worker.start()
+            workers.append(worker)
+
+    return workers
+
+
+def main(fetch_workers: int = FETCH_WORKERS, pack_workers: int = PACK_WORKERS):
     # build_product(
     #     'the_plot_in_you.tar.gz',
     #     '/home/user/products/the_plot_in_you.tar',
@@ -33,18 +125,34 @@ def main():
     # )
 
     logging.basicConfig(
-        level="NOTSET", format="%(message)s", datefmt="[%X]", handlers=[RichHandler()]
+        level="NOTSET", format="[%(threadName)s] %(message)s", datefmt="[%X]", handlers=[RichHandler()]
     )
 
-    logging.info('Listening for jobs')
-    try:
-        while not should_stop_running():
-            if execute_a_packer_job() or fetch_a_pending_artist():
-                logging.info('Listening for jobs')
+    store.release_all_claims()
+
+    if METRICS_PORT:
+        metrics.register_gauges(service_gauges)
+        metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
 
-            time.sleep(SLEEP_IN_LOOP)
+    logging.info(f'Listening for jobs with {fetch_workers} fetch worker(s) and {pack_workers} pack worker(s)')
+    scheduler = Scheduler()
+    scheduler.start_watching(should_stop_running)
+    workers = start_workers(scheduler, fetch_workers, pack_workers)
+    control_server = serve_control_socket(scheduler, {'fetch': fetch_workers, 'pack': pack_workers})
+    threading.Thread(target=ReadinessChecker().run, args=(scheduler,), name='swing', daemon=True).start()
+    threading.Thread(target=run_scheduled_image_packing, args=(scheduler,), name='images', daemon=True).start()
+    if TOOLCHAIN_CHECK_INTERVAL:
+        threading.Thread(target=run_toolchain_updates, args=(scheduler,), name='toolchain', daemon=True).start()
+    threading.Thread(target=storage.run_storage_gc, args=(scheduler,), name='storage', daemon=True).start()
+    try:
+        scheduler.wait_until_drained(len(workers))
+        for worker in workers:
+            worker.join()
     except KeyboardInterrupt:
-        pass
+        scheduler.stop()
+
+    if control_server:
+        control_server.server_close()
 
     logging.info('heppi lisenin')
 
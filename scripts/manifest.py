@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterator
+
+from consts import STATE_DIR
+
+MANIFEST_FILE_NAME = 'manifest.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+ID3V2_HEADER_SIZE = 10
+ID3V1_TAG_SIZE = 128
+
+
+def manifest_path(url_hash: str) -> Path:
+    return STATE_DIR / url_hash / MANIFEST_FILE_NAME
+
+
+def load_manifest(url_hash: str) -> dict | None:
+    path = manifest_path(url_hash)
+    if not path.is_file():
+        return None
+    return json.loads(path.read_text())
+
+
+def save_manifest(url_hash: str, manifest: dict):
+    path = manifest_path(url_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'{path.name}.tmp')
+    temp_path.write_text(json.dumps(manifest, indent=2, ensure_ascii=False))
+    os.replace(temp_path, path)
+
+
+def _mp3_audio_range(file, size: int) -> tuple[int, int]:
+    start, end = 0, size
+
+    header = file.read(ID3V2_HEADER_SIZE)
+    if len(header) == ID3V2_HEADER_SIZE and header[:3] == b'ID3':
+        # Syncsafe integer, 7 bits per byte, excluding the header and optional footer
+        tag_size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f)
+        start = ID3V2_HEADER_SIZE + tag_size + (ID3V2_HEADER_SIZE if header[5] & 0x10 else 0)
+
+    if end - start >= ID3V1_TAG_SIZE:
+        file.seek(end - ID3V1_TAG_SIZE)
+        if file.read(3) == b'TAG':
+            end -= ID3V1_TAG_SIZE
+
+    return min(start, end), end
+
+
+# Tracks are re-tagged by beets on every import, so MP3s are hashed by their audio frames only
+def content_hash(path: Path) -> str:
+    file_hash = hashlib.blake2b(digest_size=16)
+    size = path.stat().st_size
+
+    with open(path, 'rb') as file:
+        start, end = _mp3_audio_range(file, size) if path.suffix.lower() == '.mp3' else (0, size)
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0 and (chunk := file.read(min(HASH_CHUNK_SIZE, remaining))):
+            file_hash.update(chunk)
+            remaining -= len(chunk)
+
+    return file_hash.hexdigest()
+
+
+def file_entry(path: Path) -> dict:
+    return {'size': path.stat().st_size, 'hash': content_hash(path)}
+
+
+# Yields every directory and file below `directory` as (path, arcname), arcnames rooted at the directory's name
+def walk_entries(directory: Path) -> Iterator[tuple[Path, str]]:
+    for root, dir_names, file_names in os.walk(directory):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        root = Path(root)
+        arc_root = root.relative_to(directory.parent).as_posix()
+        if root != directory:
+            yield root, arc_root
+        for name in sorted(file_names):
+            if not name.startswith('.'):
+                yield root / name, f'{arc_root}/{name}'
+
+
+# Hashes files just before they're yielded to the packer, so they are still in the page cache when read again
+def record_entries(entries: Iterator[tuple[Path, str]], files: dict[str, dict]) -> Iterator[tuple[Path, str]]:
+    for path, arcname in entries:
+        if path.is_file():
+            files[arcname] = file_entry(path)
+        yield path, arcname
+
+
+def changed_entries(directory: Path, manifest: dict) -> tuple[list[tuple[Path, str]], dict[str, dict]]:
+    changed, files = [], {}
+    for path, arcname in walk_entries(directory):
+        if not path.is_file():
+            continue
+
+        files[arcname] = file_entry(path)
+        if manifest['files'].get(arcname, {}).get('hash') != files[arcname]['hash']:
+            changed.append((path, arcname))
+
+    return changed, files
@@ -0,0 +1,229 @@
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterator
+
+import progress
+from consts import TRACE_FILE, TRACE_MAX_BYTES
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600)
+
+# Gauges are read from the store when scraped, the callbacks return (name, labels, value) samples
+Gauge = tuple[str, dict[str, str], float]
+
+
+class Span:
+    def __init__(self, span_id: str, parent_id: str | None, stage: str, attributes: dict):
+        self.id = span_id
+        self.parent_id = parent_id
+        self.stage = stage
+        self.attributes = attributes
+        self.bytes: int | None = None
+        self.failed = False
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_span_ids = itertools.count(1)
+_stages: dict[str, dict] = {}
+_gauge_callbacks: list[Callable[[], list[Gauge]]] = []
+
+
+def _span_stack() -> list[Span]:
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+def directory_size(path: Path) -> int:
+    size = 0
+    for root, _, file_names in os.walk(path):
+        for name in file_names:
+            with contextlib.suppress(FileNotFoundError):
+                size += os.stat(os.path.join(root, name)).st_size
+    return size
+
+
+def _write_trace(record: dict):
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    with _lock:
+        try:
+            TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            if TRACE_FILE.is_file() and TRACE_FILE.stat().st_size > TRACE_MAX_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE.with_name(f'{TRACE_FILE.name}.1'))
+            with open(TRACE_FILE, 'a', encoding='utf-8') as file:
+                file.write(line)
+        except OSError:
+            logging.exception('Could not write to the trace file')
+
+
+# Aggregates a finished stage for the metrics endpoint, and appends it to the trace file
+def record(
+        stage: str,
+        seconds: float,
+        byte_count: int | None = None,
+        error: str | None = None,
+        attributes: dict | None = None,
+        started_at: float | None = None,
+        span_id: str | None = None,
+        parent_id: str | None = None
+):
+    with _lock:
+        stats = _stages.setdefault(stage, {
+            'buckets': [0] * len(DURATION_BUCKETS), 'count': 0, 'seconds': 0.0, 'bytes': 0, 'failures': 0
+        })
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += byte_count or 0
+        stats['failures'] += error is not None
+        for idx, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][idx] += 1
+
+    trace = {
+        'span': span_id,
+        'parent': parent_id,
+        'stage': stage,
+        'thread': threading.current_thread().name,
+        'start': datetime.fromtimestamp(started_at if started_at is not None else time.time() - seconds).isoformat(),
+        'seconds': round(seconds, 6),
+        'bytes': byte_count,
+        'mb_per_s': round(byte_count / seconds / 1e6, 3) if byte_count and seconds > 0 else None,
+        'error': error,
+        **(attributes or {})
+    }
+    _write_trace(trace)
+
+
+# Times a stage of a job. Nested spans inherit the attributes of the span around them, so every span of a job carries
+# its artist. The yielded span takes the number of bytes processed, and can be marked failed without raising.
+# The job's live progress follows the innermost span.
+@contextlib.contextmanager
+def span(stage: str, **attributes) -> Iterator[Span]:
+    stack = _span_stack()
+    parent = stack[-1] if stack else None
+    current = Span(
+        f'{os.getpid():x}-{next(_span_ids)}',
+        parent.id if parent else None,
+        stage,
+        {**(parent.attributes if parent else {}), **attributes}
+    )
+
+    stack.append(current)
+    if parent:
+        progress.update(stage=stage)
+    else:
+        progress.start(stage, **attributes)
+    started_at, start = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as ex:
+        error = type(ex).__name__
+        raise
+    finally:
+        stack.pop()
+        if parent:
+            progress.update(stage=parent.stage)
+        else:
+            progress.finish()
+        if error is None and current.failed:
+            error = 'failed'
+        record(
+            stage,
+            time.perf_counter() - start,
+            current.bytes,
+            error,
+            current.attributes,
+            started_at,
+            current.id,
+            current.parent_id
+        )
+
+
+def register_gauges(callback: Callable[[], list[Gauge]]):
+    _gauge_callbacks.append(callback)
+
+
+def _labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"') for key, value in labels.items()}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+
+# Prometheus text exposition format
+def render_metrics() -> str:
+    with _lock:
+        stages = {stage: {**stats, 'buckets': list(stats['buckets'])} for stage, stats in sorted(_stages.items())}
+
+    lines = [
+        '# HELP spotifetch_stage_duration_seconds Time spent in each stage of the jobs',
+        '# TYPE spotifetch_stage_duration_seconds histogram',
+    ]
+    for stage, stats in stages.items():
+        for bound, count in zip(DURATION_BUCKETS, stats['buckets']):
+            lines.append(f'spotifetch_stage_duration_seconds_bucket{_labels({"stage": stage, "le": str(bound)})} {count}')
+        lines.append(f'spotifetch_stage_duration_seconds_bucket{_labels({"stage": stage, "le": "+Inf"})} {stats["count"]}')
+        lines.append(f'spotifetch_stage_duration_seconds_sum{_labels({"stage": stage})} {stats["seconds"]}')
+        lines.append(f'spotifetch_stage_duration_seconds_count{_labels({"stage": stage})} {stats["count"]}')
+
+    lines += [
+        '# HELP spotifetch_stage_bytes_total Bytes processed by each stage',
+        '# TYPE spotifetch_stage_bytes_total counter',
+    ]
+    lines += [f'spotifetch_stage_bytes_total{_labels({"stage": stage})} {stats["bytes"]}' for stage, stats in stages.items()]
+
+    lines += [
+        '# HELP spotifetch_stage_failures_total Runs of each stage that failed',
+        '# TYPE spotifetch_stage_failures_total counter',
+    ]
+    lines += [f'spotifetch_stage_failures_total{_labels({"stage": stage})} {stats["failures"]}' for stage, stats in stages.items()]
+
+    gauges: dict[str, list[str]] = {}
+    for callback in _gauge_callbacks:
+        try:
+            samples = callback()
+        except Exception:
+            logging.exception('Could not collect gauges')
+            continue
+        for name, labels, value in samples:
+            gauges.setdefault(name, []).append(f'{name}{_labels(labels)} {value}')
+    for name, samples in gauges.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines += samples
+
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(host: str, port: int):
+    # Only the service serves metrics, the spans are recorded by the CLI commands too
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f'Serving metrics on http://{host}:{server.server_port}/metrics')
+    return server
@@ -16,13 +16,18 @@ class ArtistFetch(BaseModel):
     status: Optional[Literal['FAILED']] = None
     error_log: Optional[str] = None
     ignore_errors: Optional[bool] = None
+    priority: Literal['low', 'normal', 'high', 'urgent'] = 'normal'
+    # Whoever queued the fetch, the queue takes turns between requesters
+    requester: Optional[str] = None
+    # Tracks left to download, from the artist's last song list or its failed tracks
+    estimated_tracks: Optional[int] = None
 
     class Config:
         ignored_types = (cached_property,)
         json_encoders = {PurePath: lambda path: str(path)}
 
     def generate_error_file(self) -> Path:
-        return self.state_dir / f'error_{datetime.now().strftime("%Y%m%d-%H%M%S")}.log'
+        return self.state_dir / f'error_{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}.log'
 
     def get_latest_error_file(self) -> Optional[Path]:
         return first(sorted(self.state_dir.glob('error*'), reverse=True), None)
@@ -0,0 +1,37 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class CorruptChunk(BaseModel):
+    index: int
+    # Byte range within the product file, to be transferred again
+    offset: int
+    size: int
+
+
+class ProductVerification(BaseModel):
+    product: str
+    payload: Optional[str] = None
+    size: Optional[int] = None
+    chunk_size: Optional[int] = None
+    chunks: Optional[int] = None
+    corrupt_chunks: list[CorruptChunk] = []
+    # Only checked for products without a chunk manifest
+    md5_matches: Optional[bool] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.corrupt_chunks and self.md5_matches is not False
+
+    def summary(self) -> str:
+        if self.error:
+            return f'{self.product}: {self.error}'
+        if self.chunks is None:
+            return f'{self.product}: {"md5sum matches" if self.md5_matches else "md5sum does not match"} (no chunk manifest)'
+        if not self.corrupt_chunks:
+            return f'{self.product}: all {self.chunks} chunk(s) intact'
+
+        ranges = ', '.join(f'#{chunk.index} (bytes {chunk.offset}-{chunk.offset + chunk.size - 1})' for chunk in self.corrupt_chunks)
+        return f'{self.product}: {len(self.corrupt_chunks)}/{self.chunks} chunk(s) corrupt: {ranges}'
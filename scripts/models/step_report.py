@@ -0,0 +1,22 @@
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+
+class StepReport(BaseModel):
+    step: str
+    return_code: int
+    wall_seconds: float
+    user_seconds: float
+    system_seconds: float
+    max_rss_kb: int
+    output_bytes: int
+    killed_reason: Optional[Literal['timeout', 'stalled', 'interrupted']] = None
+
+    def summary(self) -> str:
+        outcome = f'killed ({self.killed_reason})' if self.killed_reason else f'exited with {self.return_code}'
+        return (
+            f'{self.step} {outcome} after {self.wall_seconds:.1f}s, '
+            f'cpu {self.user_seconds:.1f}s user / {self.system_seconds:.1f}s system, '
+            f'max RSS {self.max_rss_kb / 1024:.0f} MiB, {self.output_bytes} bytes of output'
+        )
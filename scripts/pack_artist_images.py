@@ -1,22 +1,80 @@
-import os
+import logging
 from datetime import datetime
+from pathlib import Path
 
-from consts import PRODUCTS_DIR, PACK_IMAGES_SCRIPT, MAIN_DIR
+import store
+from compression import CODEC_EXTENSIONS, pack_entries
+from consts import PRODUCTS_DIR, SWING_IMAGES_DIR, PACK_CODECS, DATETIME_FORMAT, IMAGES_PACK_MIN_NEW, \
+    IMAGES_PACK_CHECK_INTERVAL
+from manifest import walk_entries, content_hash
 from products import build_product
-from processes import execute_script
 
-TEMP_DESTINATION_PATH = '/tmp/artist_images.tar.gz'
 
-def pack_artist_images() -> str:
-    execute_script(f'{PACK_IMAGES_SCRIPT} {TEMP_DESTINATION_PATH}')
+# Splits the images into the ones that are new or changed since they were last shipped, and the ones that were only
+# touched. Images are only hashed again when their size or modification time changed.
+def find_new_images() -> tuple[list[tuple[Path, str]], dict[str, dict], dict[str, dict]]:
+    shipped = store.read_shipped_images()
+    new_entries, new_images, touched_images = [], {}, {}
 
-    product_name = f'artist_images_{datetime.now().strftime('%Y%m%d%H%M%S')}.tar'
+    for path, arcname in walk_entries(SWING_IMAGES_DIR / 'artists'):
+        if not path.is_file():
+            continue
+
+        stat = path.stat()
+        image = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if (previous := shipped.get(arcname)) and previous['size'] == image['size'] and \
+                previous['mtime_ns'] == image['mtime_ns']:
+            continue
+
+        image['hash'] = content_hash(path)
+        if previous and previous['hash'] == image['hash']:
+            touched_images[arcname] = image
+        else:
+            new_entries.append((path, arcname))
+            new_images[arcname] = image
+
+    return new_entries, new_images, touched_images
+
+
+# Packs the artist images that were not shipped yet, if there are at least `min_new` of them.
+# Returns the product's name, or None if nothing was packed.
+def pack_artist_images(min_new: int = 1) -> str | None:
+    new_entries, new_images, touched_images = find_new_images()
+    now = datetime.now()
+    if touched_images:
+        store.record_shipped_images(touched_images, None, now.strftime(DATETIME_FORMAT))
+
+    if not new_entries:
+        logging.info('No new artist images to pack')
+        return None
+    if len(new_entries) < min_new:
+        logging.info(f'Only {len(new_entries)} new artist image(s), waiting for {min_new} before packing them')
+        return None
+
+    codec, level = PACK_CODECS['artist-images']
+    product_name = f'artist_images_{now.strftime('%Y%m%d%H%M%S')}.tar'
+    logging.info(f'Packing {len(new_entries)} new artist image(s) into {product_name}')
     build_product(
-        file_path=TEMP_DESTINATION_PATH,
+        file_path=None,
         output_path=PRODUCTS_DIR / product_name,
-        product_type='artist-images'
+        product_type='artist-images',
+        payload_name=f'artist_images.tar{CODEC_EXTENSIONS[codec]}',
+        write_payload=lambda payload: pack_entries(new_entries, payload, codec, level, recursive=False),
+        codec=codec
     )
 
-    os.system(f'find {MAIN_DIR}/swingmusic/images/artists -type f -delete')
+    store.record_shipped_images(new_images, product_name, now.strftime(DATETIME_FORMAT))
 
     return product_name
+
+
+def run_scheduled_image_packing(scheduler):
+    while not scheduler.stopping:
+        scheduler.wait_for_stop(timeout=IMAGES_PACK_CHECK_INTERVAL.total_seconds())
+        if scheduler.stopping:
+            break
+
+        try:
+            pack_artist_images(min_new=IMAGES_PACK_MIN_NEW)
+        except Exception:
+            logging.exception('Exception occurred while packing artist images')
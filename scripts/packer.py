@@ -1,16 +1,20 @@
-import contextlib
-import json
 import logging
 import os
 from datetime import datetime
-
-from consts import OUT_DIR, MUSIC_FILE_GLOB, PRODUCTS_DIR, PACKER_QUEUE_FILE, IMPORT_SCRIPT, PACK_SCRIPT, MUSIC_DIR
+from pathlib import Path
+
+import importer
+import manifest
+import metrics
+import storage
+import store
+from compression import CODEC_EXTENSIONS, pack_entries
+from consts import OUT_DIR, PRODUCTS_DIR, MUSIC_DIR, DATETIME_FORMAT, PACKER_RETRY_DELAY, PACK_CODECS
 from models.packer_job import PackerJob
-from processes import execute_script
 from products import build_product
 
 
-def execute_packer_job(job: PackerJob):
+def execute_packer_job(job: PackerJob) -> bool:
     logging.info(f"Importing artist with hash '{job.url_hash}'")
 
     out_dir = OUT_DIR / job.url_hash
@@ -18,76 +22,133 @@ def execute_packer_job(job: PackerJob):
     music_dir = MUSIC_DIR / job.url_hash / 'music'
     music_dir.mkdir(parents=True, exist_ok=True)
 
-    out_dir_has_files = any(out_dir.rglob(MUSIC_FILE_GLOB))
-    music_dir_has_files = any(music_dir.rglob(MUSIC_FILE_GLOB))
+    albums = importer.find_albums(out_dir)
+    pending_albums = importer.pending_albums(job.url_hash, albums)
+    has_imported_music = importer.has_imported_music(job.url_hash)
 
-    if not out_dir_has_files and not music_dir_has_files:
+    if not albums and not has_imported_music:
         logging.info('Artist directory does not have any music files, skipping')
-        # Send to end of queue
+        # Send to end of queue, it is not due again until the retry delay has passed
+        store.requeue_packer_job(job.url_hash, (datetime.now() + PACKER_RETRY_DELAY).strftime(DATETIME_FORMAT))
+        return False
+
+    if pending_albums:
+        if has_imported_music:
+            logging.info('Found some imported music of the artist, trying to continue where we left off')
+        if skipped := len(albums) - len(pending_albums):
+            logging.info(f'Skipping {skipped} album(s) that were already imported')
+
+        with metrics.span('import', albums=len(pending_albums)) as import_span:
+            import_span.bytes = sum(metrics.directory_size(album_dir) for album_dir in pending_albums.values())
+            importer.import_albums(job.url_hash, pending_albums, music_dir)
+    elif has_imported_music:
+        logging.info('All artist music has already been imported, skipping to packing')
+    else:
+        logging.info('All albums of the artist were already imported and packed, nothing to pack')
         remove_packer_job(job)
-        queue_packer_job(job)
-        return
+        return True
 
-    if out_dir_has_files:
-        if music_dir_has_files:
-            logging.info('Found some music files in the artist\'s import folder, trying to continue where we left off')
+    if (artist_manifest := manifest.load_manifest(job.url_hash)) is None:
+        pack_full_product(job, music_dir)
+    else:
+        pack_delta_product(job, music_dir, artist_manifest)
 
-        execute_script(f'{IMPORT_SCRIPT} {job.url_hash}')
-    elif music_dir_has_files:
-        logging.info('All artist music has already been imported, skipping to packing')
+    finish_packer_job(job, music_dir)
+    return True
 
-    gzip_name = f'{job.product_name}.gz'
 
-    logging.info(f'Packing songs into {gzip_name}')
-    with contextlib.chdir(music_dir.parent):
-        execute_script(f'{PACK_SCRIPT} {gzip_name}')
+# The imported music was shipped, so the artist's music directory is emptied for its next fetch
+def finish_packer_job(job: PackerJob, music_dir: Path):
+    os.system(f'rm -rfv {music_dir}/*')
+    remove_packer_job(job)
 
-        logging.info(f'Building product into {PRODUCTS_DIR / job.product_name}')
-        build_product(
-            file_path=gzip_name,
-            output_path=PRODUCTS_DIR / job.product_name,
-            product_type='music',
-            attributes=job.attributes
-        )
 
-    os.system(f'rm -rfv {music_dir}/* {gzip_name}')
-    remove_packer_job(job)
+def pack_songs(product_name: str, attributes: dict[str, str], entries):
+    codec, level = PACK_CODECS['music']
 
+    # Songs are packed straight into the product, without an intermediate archive
+    logging.info(f'Packing songs into product {PRODUCTS_DIR / product_name}')
+    build_product(
+        file_path=None,
+        output_path=PRODUCTS_DIR / product_name,
+        product_type='music',
+        attributes=attributes,
+        payload_name=f'{product_name}{CODEC_EXTENSIONS[codec]}',
+        write_payload=lambda payload: pack_entries(entries, payload, codec, level, recursive=False),
+        codec=codec
+    )
 
-def read_packer_queue() -> list[PackerJob]:
-    if not PACKER_QUEUE_FILE.is_file():
-        return []
 
-    return [PackerJob(**packer) for packer in json.loads(PACKER_QUEUE_FILE.read_text())]
+# Name and attributes of the artist's next product, a full one or a delta on top of its last full product
+def next_product(job: PackerJob, artist_manifest: dict | None) -> tuple[str, dict[str, str]]:
+    if artist_manifest is None:
+        return job.product_name, {**job.attributes, 'sequence': '0'}
+
+    sequence = artist_manifest['sequence'] + 1
+    return (
+        f'{Path(job.product_name).stem}.delta{sequence:03}.tar',
+        {**job.attributes, 'base': artist_manifest['base'], 'sequence': str(sequence)}
+    )
+
 
+def pack_full_product(job: PackerJob, music_dir: Path):
+    files = {}
+    pack_songs(*next_product(job, None), manifest.record_entries(manifest.walk_entries(music_dir), files))
 
-def set_packer_queue(queue: list[PackerJob]):
-    PACKER_QUEUE_FILE.write_text(json.dumps([job.model_dump() for job in queue], indent=2))
+    manifest.save_manifest(job.url_hash, {'base': job.product_name, 'sequence': 0, 'files': files})
 
 
-def queue_packer_job(new_job: PackerJob):
-    queue = read_packer_queue()
-    if any(new_job.url_hash == job.url_hash for job in queue):
+# Only ships files that are new or changed since the artist's last product, on top of its last full product
+def pack_delta_product(job: PackerJob, music_dir: Path, artist_manifest: dict):
+    changed, files = manifest.changed_entries(music_dir, artist_manifest)
+    if not changed:
+        logging.info('No new or changed songs since the last product, skipping')
         return
 
-    queue.append(new_job)
-    set_packer_queue(queue)
+    product_name, attributes = next_product(job, artist_manifest)
+    logging.info(
+        f'Packing {len(changed)} new or changed file(s) as delta #{attributes["sequence"]} of {artist_manifest["base"]}'
+    )
+    pack_songs(product_name, attributes, changed)
 
+    artist_manifest['files'].update(files)
+    artist_manifest['sequence'] = int(attributes['sequence'])
+    manifest.save_manifest(job.url_hash, artist_manifest)
 
-def get_packer_job() -> PackerJob | None:
-    for job in read_packer_queue():
-        if datetime.now() >= job.time_to_pack:
-            return job
-    return None
 
+def read_packer_queue() -> list[PackerJob]:
+    return [PackerJob(**job) for job in store.read_packer_jobs()]
 
-def remove_packer_job(job_to_remove: PackerJob):
-    set_packer_queue([job for job in read_packer_queue() if job.url_hash != job_to_remove.url_hash])
 
+def queue_packer_job(new_job: PackerJob, await_swing: bool = False) -> bool:
+    return store.insert_packer_job(
+        new_job.model_dump(),
+        awaiting_swing_since=datetime.now().strftime(DATETIME_FORMAT) if await_swing else None
+    )
 
-def execute_a_packer_job() -> bool:
-    if job := get_packer_job():
-        execute_packer_job(job)
-        return True
 
-    return False
+def get_packer_job() -> PackerJob | None:
+    if job := store.get_due_packer_job(datetime.now().strftime(DATETIME_FORMAT)):
+        return PackerJob(**job)
+    return None
+
+
+def remove_packer_job(job_to_remove: PackerJob):
+    store.delete_packer_job(job_to_remove.url_hash)
+
+
+def execute_a_packer_job(worker: str = 'main') -> bool:
+    if not (claimed := store.claim_due_packer_job(worker, datetime.now().strftime(DATETIME_FORMAT))):
+        return False
+
+    job = PackerJob(**claimed)
+    try:
+        with storage.reserved(worker, storage.pack_footprint(job.url_hash)), \
+                metrics.span('pack_job', url_hash=job.url_hash, artist=job.attributes.get('artist')):
+            return execute_packer_job(job)
+    except storage.InsufficientSpace as ex:
+        logging.warning(f'{ex}, packing the artist later')
+        store.requeue_packer_job(job.url_hash, (datetime.now() + PACKER_RETRY_DELAY).strftime(DATETIME_FORMAT))
+        return False
+    finally:
+        store.release_packer_job(job.url_hash)
@@ -0,0 +1,228 @@
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import importer
+import manifest
+import metrics
+import store
+from consts import MUSIC_DIR, IMPORT_WORKERS, PACKER_LEEWAY_SINCE_FETCH, PIPELINE_QUEUE_SIZE, PIPELINE_POLL_INTERVAL, \
+    DATETIME_FORMAT, FetcherException
+from models.packer_job import PackerJob
+from packer import queue_packer_job, next_product, pack_songs, finish_packer_job
+
+
+# Imports and packs the albums of an artist while the rest of it is still downloading. Every downloaded album is
+# imported by beets as soon as Swing Music has picked up the artist, and streamed into the artist's product right after.
+# The product is finished once the last album is imported. The artist's packer job is queued along with the first
+# album, it takes over whatever the pipeline didn't get to: before Swing Music was ready, after failed imports, or
+# after a crash.
+class AlbumPipeline:
+    def __init__(self, job: PackerJob):
+        self.job = job
+        self.music_dir = MUSIC_DIR / job.url_hash / 'music'
+        self.name = threading.current_thread().name
+
+        self._downloaded: queue.Queue[dict[str, Path] | None] = queue.Queue()
+        # Bounded, the imports wait while the packing is behind
+        self._imported: queue.Queue[str | None] = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self._closed = threading.Event()
+        self._aborted = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._queued_job = False
+        self._swing_ready = False
+        self._imports_done = False
+        self._failed_imports: list[str] = []
+        self._packed = False
+
+    @property
+    def started(self) -> bool:
+        return bool(self._threads)
+
+    def add_albums(self, albums: dict[str, Path]):
+        if not self.started:
+            self._start()
+        logging.info(f'{len(albums)} album(s) downloaded: {", ".join(albums)}')
+        self._downloaded.put(albums)
+
+    def _start(self):
+        self.music_dir.mkdir(parents=True, exist_ok=True)
+        self.job.time_to_pack = datetime.now() + PACKER_LEEWAY_SINCE_FETCH
+        self._queued_job = queue_packer_job(self.job, await_swing=True)
+
+        self._threads = [
+            threading.Thread(target=self._run_imports, name=f'{self.name}-import', daemon=True),
+            threading.Thread(target=self._run_packing, name=f'{self.name}-pack', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _close(self):
+        self._closed.set()
+        self._downloaded.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    # Waits for the imports and the packing of the downloaded albums. Returns whether all of them were shipped,
+    # otherwise the artist's packer job ships the rest.
+    def finish(self) -> bool:
+        if not self.started:
+            return False
+        self._close()
+
+        if not self._swing_ready:
+            logging.info('Swing Music has not picked up the artist yet, leaving its albums to the packer job')
+            return False
+        if self._failed_imports or not self._packed:
+            logging.warning('Not all albums of the artist were packed, leaving the rest to the packer job')
+            return False
+
+        finish_packer_job(self.job, self.music_dir)
+        return True
+
+    # Nothing of a failed fetch is shipped, the albums imported so far are packed along with its retry
+    def abort(self):
+        if not self.started or self._closed.is_set():
+            return
+        self._aborted.set()
+        self._close()
+
+        if self._queued_job:
+            store.delete_packer_job(self.job.url_hash)
+
+    # Albums are only moved out of the download directory once Swing Music has picked up the artist from there, or
+    # once the leeway ran out. Returns whether that happened before the download was done.
+    def _wait_for_swing(self) -> bool:
+        while not self._aborted.is_set():
+            job = store.get_packer_job(self.job.url_hash)
+            if job is None or job['awaiting_swing_since'] is None \
+                    or job['time_to_pack'] <= datetime.now().strftime(DATETIME_FORMAT):
+                return True
+            if self._closed.is_set():
+                return False
+            self._closed.wait(PIPELINE_POLL_INTERVAL)
+        return False
+
+    def _run_imports(self):
+        try:
+            self._swing_ready = self._wait_for_swing()
+            if not self._swing_ready:
+                return
+
+            importer.prepare_library()
+            config_path = importer.write_config(self.job.url_hash, self.music_dir)
+            imports: dict[str, Future] = {}
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix=f'{self.name}-import') as executor:
+                while (albums := self._downloaded.get()) is not None:
+                    if self._aborted.is_set():
+                        continue
+                    for source, album_dir in albums.items():
+                        imports[source] = executor.submit(
+                            self._import_album, config_path, source, album_dir, imports.get(source)
+                        )
+        except Exception:
+            logging.exception('Exception occurred while importing albums')
+            self._failed_imports.append('all')
+        finally:
+            self._imported.put(None)
+
+    def _import_album(self, config_path: Path, source: str, album_dir: Path, previous: Future | None):
+        # Tracks added to an album that is still being imported are imported after it
+        if previous:
+            previous.result()
+
+        try:
+            with metrics.span('import_album', url_hash=self.job.url_hash, artist=self.job.attributes.get('artist'),
+                              source=source) as import_span:
+                import_span.bytes = metrics.directory_size(album_dir)
+                report = importer.import_album(self.job.url_hash, config_path, source, album_dir, self.music_dir)
+                import_span.failed = bool(report.killed_reason or report.return_code != 0)
+        except Exception:
+            logging.exception(f'Exception occurred while importing album {source}')
+            self._failed_imports.append(source)
+            return
+
+        if import_span.failed:
+            logging.warning(f'Importing album {source} failed: {report.summary()}')
+            self._failed_imports.append(source)
+        elif not self._aborted.is_set():
+            self._imported.put(source)
+
+    def _run_packing(self):
+        artist_manifest = manifest.load_manifest(self.job.url_hash)
+        files = {}
+        entries = self._new_entries(self._imported_entries(), artist_manifest, files)
+        try:
+            if (first := next(entries, None)) is None:
+                self._packed = not self._aborted.is_set()
+                return
+
+            product_name, attributes = next_product(self.job, artist_manifest)
+            with metrics.span('pack_stream', url_hash=self.job.url_hash, artist=self.job.attributes.get('artist')):
+                pack_songs(product_name, attributes, itertools.chain([first], entries))
+
+            if artist_manifest is None:
+                artist_manifest = {'base': product_name, 'sequence': 0, 'files': files}
+            else:
+                artist_manifest['files'].update(files)
+                artist_manifest['sequence'] = int(attributes['sequence'])
+            manifest.save_manifest(self.job.url_hash, artist_manifest)
+            self._packed = True
+        except Exception:
+            if not self._aborted.is_set():
+                logging.exception('Exception occurred while packing albums')
+        finally:
+            # The imports must not wait on a packing that gave up
+            while not self._imports_done:
+                self._imports_done = self._imported.get() is None
+
+    def _imported_entries(self) -> Iterator[tuple[Path, str]]:
+        while (source := self._imported.get()) is not None:
+            for album_dir in importer.imported_album_dirs(self.job.url_hash, source):
+                if album_dir.is_relative_to(self.music_dir):
+                    yield from self._album_entries(album_dir)
+        self._imports_done = True
+
+        if not self._swing_ready:
+            return
+        if self._aborted.is_set():
+            raise FetcherException('The fetch of the artist failed, not shipping its albums')
+        # Anything else in the music directory, e.g. albums imported by an earlier fetch that failed
+        yield from manifest.walk_entries(self.music_dir)
+
+    # The album's directories come first, with arcnames rooted at the music directory's name like a full walk
+    def _album_entries(self, album_dir: Path) -> Iterator[tuple[Path, str]]:
+        parts = album_dir.relative_to(self.music_dir).parts
+        for depth in range(1, len(parts) + 1):
+            directory = self.music_dir.joinpath(*parts[:depth])
+            yield directory, directory.relative_to(self.music_dir.parent).as_posix()
+        for path in sorted(album_dir.iterdir()):
+            if path.is_file() and not path.name.startswith('.'):
+                yield path, path.relative_to(self.music_dir.parent).as_posix()
+
+    # Every entry is packed once, a delta only ships the files that are new or changed since the last product
+    @staticmethod
+    def _new_entries(
+            entries: Iterable[tuple[Path, str]],
+            artist_manifest: dict | None,
+            files: dict[str, dict]
+    ) -> Iterator[tuple[Path, str]]:
+        seen = set()
+        for path, arcname in entries:
+            if arcname in seen:
+                continue
+            seen.add(arcname)
+
+            if not path.is_file():
+                if artist_manifest is None:
+                    yield path, arcname
+                continue
+
+            files[arcname] = manifest.file_entry(path)
+            if artist_manifest is None or artist_manifest['files'].get(arcname, {}).get('hash') != files[arcname]['hash']:
+                yield path, arcname
@@ -1,32 +1,197 @@
+import contextlib
+import logging
 import os
+import shlex
+import shutil
 import signal
 import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable
 
+from consts import JOB_NICENESS, JOB_IONICE_LEVEL, JOB_MEMORY_LIMIT, JOB_CPU_TIME_LIMIT
+from models.step_report import StepReport
 
-def execute_script(command: str | list[str], timeout: float | None = None, raise_on_statuscode: bool = True) -> int:
-    # Start the process in a new process group
+EXIT_POLL_INTERVAL = 0.2
+SUPERVISION_INTERVAL = 5
+# Scanning the progress directories is comparatively expensive, so it's done less often
+PROGRESS_SCAN_INTERVAL = 30
+
+
+def _limits_prefix() -> list[str]:
+    prefix = []
+    if JOB_NICENESS and (nice := shutil.which('nice')):
+        prefix += [nice, '-n', str(JOB_NICENESS)]
+    if JOB_IONICE_LEVEL is not None and (ionice := shutil.which('ionice')):
+        prefix += [ionice, '-c', '2', '-n', str(JOB_IONICE_LEVEL)]
+    if (JOB_MEMORY_LIMIT or JOB_CPU_TIME_LIMIT) and (prlimit := shutil.which('prlimit')):
+        prefix.append(prlimit)
+        if JOB_MEMORY_LIMIT:
+            prefix.append(f'--as={JOB_MEMORY_LIMIT}')
+        if JOB_CPU_TIME_LIMIT:
+            prefix.append(f'--cpu={JOB_CPU_TIME_LIMIT}')
+        prefix.append('--')
+    return prefix
+
+
+def _limited_command(command: str | list[str]) -> list[str]:
+    # The limit tools exec into the next program, so the job keeps the pid that is waited on
+    if isinstance(command, str):
+        command = ['/bin/sh', '-c', command]
+    return _limits_prefix() + command
+
+
+def _directories_signature(paths: list[Path]) -> tuple[int, int]:
+    count, size = 0, 0
+    for path in paths:
+        for root, _, file_names in os.walk(path):
+            for name in file_names:
+                try:
+                    size += os.stat(os.path.join(root, name)).st_size
+                    count += 1
+                except FileNotFoundError:
+                    pass
+    return count, size
+
+
+def _kill_and_reap(process: subprocess.Popen) -> tuple[int, object]:
+    # First try to terminate the whole process group
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+
+    # Give it some time to shut down cleanly
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            return wait_status, rusage
+        time.sleep(0.1)
+
+    logging.warning('Process group did not exit, sending SIGKILL..')
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGKILL)
+    _, wait_status, rusage = os.wait4(process.pid, 0)
+    return wait_status, rusage
+
+
+def _forward_output(process: subprocess.Popen, counter: list[int], on_output_line: Callable[[str], None] | None):
+    pending = b''
+    while chunk := os.read(process.stdout.fileno(), 64 * 1024):
+        counter[0] += len(chunk)
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+
+        if on_output_line:
+            *lines, pending = (pending + chunk).split(b'\n')
+            for line in lines:
+                try:
+                    on_output_line(line.decode(errors='replace').rstrip('\r'))
+                except Exception:
+                    logging.exception('Exception occurred while following the output')
+
+
+# Runs an external job step in its own process group, with niceness and resource limits applied.
+# The step is killed once it exceeds `timeout`, or when neither its output nor the files under `progress_paths`
+# have changed for `stall_timeout`. Resource usage is reported once it ends. `on_output_line` is called with every
+# line of output, from the thread forwarding it.
+def run_supervised(
+        step: str,
+        command: str | list[str],
+        timeout: timedelta | None = None,
+        stall_timeout: timedelta | None = None,
+        progress_paths: list[Path] | None = None,
+        cwd: str | os.PathLike | None = None,
+        on_output_line: Callable[[str], None] | None = None,
+        env: dict[str, str] | None = None
+) -> StepReport:
+    progress_paths = progress_paths or []
+    start = time.monotonic()
     process = subprocess.Popen(
-        command,
-        shell=isinstance(command, str),
-        preexec_fn=os.setsid
+        _limited_command(command),
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True
     )
 
+    output_bytes = [0]
+    forwarder = threading.Thread(target=_forward_output, args=(process, output_bytes, on_output_line), name=f'{step}-output', daemon=True)
+    forwarder.start()
+
+    killed_reason = None
+    last_progress = (output_bytes[0], _directories_signature(progress_paths))
+    last_progress_time = last_scan_time = last_check_time = start
     try:
-        # Wait for completion or timeout
-        process.wait(timeout=timeout)
-    except (KeyboardInterrupt, subprocess.TimeoutExpired):
-        # First try to terminate the whole process group
-        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-
-        try:
-            # Give it some time to shut down cleanly
-            process.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            print("Process group did not exit, sending SIGKILL..")
-            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-            process.wait()
-
-    if raise_on_statuscode and process.returncode != 0:
-        raise ValueError(f'Process returned non-zero exit code ({process.returncode})')
-
-    return process.returncode
+        while True:
+            pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+
+            time.sleep(EXIT_POLL_INTERVAL)
+            now = time.monotonic()
+            if now - last_check_time < SUPERVISION_INTERVAL:
+                continue
+            last_check_time = now
+
+            if timeout is not None and now - start > timeout.total_seconds():
+                killed_reason = 'timeout'
+            elif stall_timeout is not None:
+                progress = last_progress
+                if now - last_scan_time >= PROGRESS_SCAN_INTERVAL or output_bytes[0] != last_progress[0]:
+                    progress = (output_bytes[0], _directories_signature(progress_paths))
+                    last_scan_time = now
+                if progress != last_progress:
+                    last_progress, last_progress_time = progress, now
+                elif now - last_progress_time > stall_timeout.total_seconds():
+                    killed_reason = 'stalled'
+
+            if killed_reason:
+                logging.warning(f'{step} {"timed out" if killed_reason == "timeout" else "stalled"}, killing it')
+                wait_status, rusage = _kill_and_reap(process)
+                break
+    except KeyboardInterrupt:
+        wait_status, rusage = _kill_and_reap(process)
+        killed_reason = 'interrupted'
+
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    forwarder.join(timeout=5)
+
+    report = StepReport(
+        step=step,
+        return_code=process.returncode,
+        wall_seconds=time.monotonic() - start,
+        user_seconds=rusage.ru_utime,
+        system_seconds=rusage.ru_stime,
+        max_rss_kb=rusage.ru_maxrss,
+        output_bytes=output_bytes[0],
+        killed_reason=killed_reason
+    )
+    logging.info(report.summary())
+
+    if killed_reason == 'interrupted':
+        raise KeyboardInterrupt
+    return report
+
+
+def execute_script(
+        command: str | list[str],
+        timeout: float | None = None,
+        raise_on_statuscode: bool = True,
+        cwd: str | os.PathLike | None = None
+) -> int:
+    step = command if isinstance(command, str) else shlex.join(command)
+    report = run_supervised(
+        step.split(' ', 1)[0],
+        command,
+        timeout=timedelta(seconds=timeout) if timeout is not None else None,
+        cwd=cwd
+    )
+
+    if raise_on_statuscode and report.return_code != 0:
+        raise ValueError(f'Process returned non-zero exit code ({report.return_code})')
+
+    return report.return_code
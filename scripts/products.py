@@ -1,13 +1,26 @@
+import json
+import os
+import shutil
 import tarfile
+import time
 from base64 import b64encode
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
 from os import PathLike
 import hashlib
 from pathlib import Path
-from tarfile import TarInfo
+from tarfile import TarInfo, NUL
+from typing import BinaryIO, Callable
+
+import metrics
+from consts import PACK_THREADS
 
 ATTRIBUTE_FILE_FORMAT = '__{}__.txt'
+COPY_CHUNK_SIZE = 1024 * 1024
+# The payload is hashed in chunks too, so a corrupt transfer can be repaired chunk by chunk
+INTEGRITY_CHUNK_SIZE = 4 * 1024 * 1024
+INTEGRITY_ALGORITHM = 'blake2b-256'
 
 
 def calculate_md5(text: str) -> str:
@@ -23,33 +36,257 @@ def calculate_file_md5(file_path: PathLike, chunk_size: int = 65536) -> str:
     return file_hash.hexdigest()
 
 
+def _hash_chunk(pieces: list[bytes]) -> str:
+    chunk_hash = hashlib.blake2b(digest_size=32)
+    for piece in pieces:
+        chunk_hash.update(piece)
+    return chunk_hash.hexdigest()
+
+
+class _ChunkHasher:
+    # Hashes fixed-size chunks on a thread pool, hashlib releases the GIL while hashing them.
+    # The pending chunks are bounded, like the compressed blocks of ParallelGzipWriter.
+    def __init__(self, threads: int = PACK_THREADS, chunk_size: int = INTEGRITY_CHUNK_SIZE):
+        self._chunk_size = chunk_size
+        self._max_pending = threads * 2
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='chunk-hash')
+        self._pending: deque[Future] = deque()
+        self._pieces: list[bytes] = []
+        self._filled = 0
+        self.digests: list[str] = []
+
+    def update(self, data: bytes):
+        # Kept until hashed, so buffers that the caller might reuse are copied
+        data = data if isinstance(data, bytes) else bytes(data)
+        offset = 0
+        while offset < len(data):
+            take = min(self._chunk_size - self._filled, len(data) - offset)
+            self._pieces.append(data if take == len(data) else data[offset:offset + take])
+            self._filled += take
+            offset += take
+            if self._filled == self._chunk_size:
+                self._submit()
+
+    def _submit(self):
+        while len(self._pending) >= self._max_pending:
+            self.digests.append(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(_hash_chunk, self._pieces))
+        self._pieces, self._filled = [], 0
+
+    def finish(self) -> list[str]:
+        if self._filled:
+            self._submit()
+        while self._pending:
+            self.digests.append(self._pending.popleft().result())
+        self._executor.shutdown()
+        return self.digests
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+class _HashingWriter:
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self.md5 = hashlib.md5()
+        self.chunks = _ChunkHasher()
+        self.size = 0
+        # Hashing happens inline with writing the payload, its share of the time is measured separately
+        self.hash_seconds = 0.0
+        self.chunk_hash_seconds = 0.0
+
+    def write(self, data: bytes) -> int:
+        start = time.perf_counter()
+        self.md5.update(data)
+        md5_end = time.perf_counter()
+        self.chunks.update(data)
+        self.hash_seconds += md5_end - start
+        self.chunk_hash_seconds += time.perf_counter() - md5_end
+        self.size += len(data)
+        return self._file.write(data)
+
+
+def _write_padding(file: BinaryIO, size: int):
+    if remainder := size % tarfile.BLOCKSIZE:
+        file.write(NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def _write_attribute(file: BinaryIO, attr_name: str, value: str):
+    tar_info = TarInfo(ATTRIBUTE_FILE_FORMAT.format(attr_name))
+    content = value.encode('utf-8')
+    tar_info.size = len(content)
+    file.write(tar_info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+    file.write(content)
+    _write_padding(file, len(content))
+
+
+def _write_padding_to_record(file: BinaryIO):
+    if remainder := file.tell() % tarfile.RECORDSIZE:
+        file.write(NUL * (tarfile.RECORDSIZE - remainder))
+
+
+def _copy_file(file_path: Path) -> Callable[[BinaryIO], None]:
+    def copy(destination: BinaryIO):
+        with open(file_path, 'rb') as file:
+            shutil.copyfileobj(file, destination, COPY_CHUNK_SIZE)
+    return copy
+
+
+# Writes the product in a single pass: the attributes, the payload streamed from `write_payload` (or copied from
+# `file_path`) while being hashed, and lastly the md5sum and chunks attributes once the digests are known.
 def build_product(
-        file_path: str | Path,
+        file_path: str | Path | None,
         output_path: str | Path,
         product_type: str,
         custom_date: datetime | None = None,
         attributes: dict[str, str] | None = None,
+        payload_name: str | None = None,
+        write_payload: Callable[[BinaryIO], None] | None = None,
         **kwargs
 ):
-    file_path = Path(file_path)
     output_path = Path(output_path)
-    attributes = attributes or {}
+    if write_payload is None:
+        file_path = Path(file_path)
+        payload_name = payload_name or file_path.name
+        write_payload = _copy_file(file_path)
 
-    attributes.update({
+    attributes = {
+        **(attributes or {}),
         'date': (custom_date or datetime.now()).isoformat(sep=' ', timespec='seconds'),
-        'md5sum': calculate_file_md5(file_path),
         'type': product_type,
         **{k: str(v) for k, v in kwargs.items()}
-    })
+    }
+
+    partial_path = output_path.with_name(f'{output_path.name}.partial')
+    try:
+        with metrics.span('build_product', product=output_path.name, product_type=product_type) as product_span, \
+                open(partial_path, 'wb') as file:
+            for attr_name, value in attributes.items():
+                _write_attribute(file, attr_name, value)
+
+            # The payload's size is only known at the end, so its header is rewritten then.
+            # GNU headers encode large sizes in place, so both headers have the same length.
+            payload_info = TarInfo(payload_name)
+            payload_info.mtime = int(time.time())
+            payload_info.mode = 0o644
+            header_offset = file.tell()
+            placeholder_header = payload_info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+            file.write(placeholder_header)
+
+            payload = _HashingWriter(file)
+            try:
+                with metrics.span('write_payload') as payload_span:
+                    write_payload(payload)
+                    payload_span.bytes = payload.size
+                start = time.perf_counter()
+                chunk_digests = payload.chunks.finish()
+                payload.chunk_hash_seconds += time.perf_counter() - start
+            finally:
+                payload.chunks.close()
+            metrics.record(
+                'md5', payload.hash_seconds, payload.size,
+                attributes=product_span.attributes, parent_id=product_span.id
+            )
+            metrics.record(
+                'chunk_hash', payload.chunk_hash_seconds, payload.size,
+                attributes=product_span.attributes, parent_id=product_span.id
+            )
+            _write_padding(file, payload.size)
+
+            payload_info.size = payload.size
+            header = payload_info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+            assert len(header) == len(placeholder_header)
+            file.seek(header_offset)
+            file.write(header)
+            file.seek(0, os.SEEK_END)
+
+            _write_attribute(file, 'md5sum', payload.md5.hexdigest())
+            _write_attribute(file, 'chunks', json.dumps({
+                'algorithm': INTEGRITY_ALGORITHM,
+                'chunk_size': INTEGRITY_CHUNK_SIZE,
+                'size': payload.size,
+                'digests': chunk_digests,
+            }))
+
+            # End of archive marker, padded to a full record like tarfile does
+            file.write(NUL * tarfile.BLOCKSIZE * 2)
+            _write_padding_to_record(file)
+            product_span.bytes = file.tell()
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(partial_path, output_path)
+
+
+def _read_attribute(product: tarfile.TarFile, member: TarInfo) -> str:
+    return product.extractfile(member).read().decode('utf-8')
+
+
+def _verify_chunk(path: Path, offset: int, size: int, digest: str) -> bool:
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(size)
+    return len(data) == size and _hash_chunk([data]) == digest
+
+
+# Checks the payload of a product against its chunk manifest, on a thread pool. Products built before the chunk
+# manifests were added are checked against their md5sum instead.
+def verify_product(path: str | Path, threads: int = PACK_THREADS):
+    # Imported here, the store imports this module and shouldn't load pydantic
+    from models.product_verification import ProductVerification, CorruptChunk
+
+    path = Path(path)
+    try:
+        with tarfile.open(path, 'r:') as product:
+            members = product.getmembers()
+            attributes = {
+                member.name: _read_attribute(product, member)
+                for member in members if member.name.startswith('__') and member.name.endswith('__.txt')
+            }
+    except (OSError, tarfile.TarError, UnicodeDecodeError) as ex:
+        return ProductVerification(product=str(path), error=f'Could not read the product: {ex}')
+
+    payloads = [member for member in members if member.name not in attributes]
+    if len(payloads) != 1:
+        return ProductVerification(product=str(path), error=f'Expected a single payload, found {len(payloads)}')
+    payload = payloads[0]
+    verification = ProductVerification(product=str(path), payload=payload.name, size=payload.size)
+
+    if (manifest := attributes.get(ATTRIBUTE_FILE_FORMAT.format('chunks'))) is None:
+        if (md5sum := attributes.get(ATTRIBUTE_FILE_FORMAT.format('md5sum'))) is None:
+            verification.error = 'The product has neither a chunk manifest nor an md5sum'
+            return verification
+
+        md5 = hashlib.md5()
+        with open(path, 'rb') as file:
+            file.seek(payload.offset_data)
+            remaining = payload.size
+            while remaining and (data := file.read(min(COPY_CHUNK_SIZE, remaining))):
+                md5.update(data)
+                remaining -= len(data)
+        verification.md5_matches = md5.hexdigest() == md5sum.strip()
+        return verification
 
-    with tarfile.open(output_path, mode='w') as tar:
-        for attr_name, value in attributes.items():
-            tar_info = TarInfo(ATTRIBUTE_FILE_FORMAT.format(attr_name))
-            content = value.encode('utf-8')
-            tar_info.size = len(content)
-            tar.addfile(tarinfo=tar_info, fileobj=BytesIO(content))
+    manifest = json.loads(manifest)
+    if manifest['algorithm'] != INTEGRITY_ALGORITHM or manifest['size'] != payload.size:
+        verification.error = f"Unsupported chunk manifest ({manifest['algorithm']}, {manifest['size']} bytes)"
+        return verification
 
-        tar.add(file_path, arcname=file_path.name)
+    chunk_size = manifest['chunk_size']
+    verification.chunk_size = chunk_size
+    verification.chunks = len(manifest['digests'])
+    chunks = [
+        (payload.offset_data + idx * chunk_size, min(chunk_size, payload.size - idx * chunk_size), digest)
+        for idx, digest in enumerate(manifest['digests'])
+    ]
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='verify') as executor:
+        results = executor.map(lambda chunk: _verify_chunk(path, *chunk), chunks)
+        verification.corrupt_chunks = [
+            CorruptChunk(index=idx, offset=offset, size=size)
+            for idx, ((offset, size, _), matches) in enumerate(zip(chunks, results)) if not matches
+        ]
+    return verification
 
 
 if __name__ == '__main__':
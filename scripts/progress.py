@@ -0,0 +1,49 @@
+import threading
+from datetime import datetime
+
+# Live progress of the jobs in flight, per worker thread. Only kept in the service's memory, the CLI reads it
+# through the control socket.
+_condition = threading.Condition()
+_jobs: dict[str, dict] = {}
+_version = 0
+
+
+def _changed():
+    global _version
+    _version += 1
+    _condition.notify_all()
+
+
+def start(stage: str, job: str | None = None, **fields):
+    job = job or threading.current_thread().name
+    with _condition:
+        _jobs[job] = {'stage': stage, 'started_at': datetime.now().isoformat(timespec='seconds'), **fields}
+        _changed()
+
+
+# Fields of jobs that were not started are dropped, e.g. spans recorded outside of a worker's job
+def update(job: str | None = None, **fields):
+    job = job or threading.current_thread().name
+    with _condition:
+        if job in _jobs:
+            _jobs[job].update(fields)
+            _changed()
+
+
+def finish(job: str | None = None):
+    job = job or threading.current_thread().name
+    with _condition:
+        if _jobs.pop(job, None) is not None:
+            _changed()
+
+
+def snapshot() -> tuple[int, dict[str, dict]]:
+    with _condition:
+        return _version, {job: dict(fields) for job, fields in _jobs.items()}
+
+
+# Blocks until the progress changed since `version`, or until `timeout` has passed
+def wait_for_change(version: int, timeout: float | None = None) -> tuple[int, dict[str, dict]]:
+    with _condition:
+        _condition.wait_for(lambda: _version != version, timeout)
+    return snapshot()
@@ -0,0 +1,228 @@
+import logging
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import store
+from consts import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, ARTIST_NAME_CACHE_TTL, DATETIME_FORMAT, \
+    RESOLVER_CONCURRENCY
+
+SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
+SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+SPOTIFY_ARTISTS_BATCH_SIZE = 50
+REQUEST_TIMEOUT = 15
+
+# Share links come with tracking parameters, localized paths and the odd trailing dot after the domain, which must not
+# end up as separate fetches of the same artist
+SPOTIFY_URL_PATTERN = re.compile(
+    r'^(?:spotify:(?:user:[^:]+:)?(?P<uri_kind>artist|album|playlist):(?P<uri_id>[A-Za-z0-9]+)'
+    r'|(?:https?://)?(?:open|play)\.spotify\.com\.?(?::\d+)?/(?:intl-[A-Za-z_-]+/)?(?:embed/)?(?:user/[^/]+/)?'
+    r'(?P<kind>artist|album|playlist)/(?P<id>[A-Za-z0-9]+))(?:[/?#].*)?$'
+)
+# Spotify has no label pages, labels are given as `label:<name>` and looked up with the search API
+LABEL_PREFIX = 'label:'
+
+PLAYLIST_PAGE_SIZE = 100
+SEARCH_PAGE_SIZE = 50
+# The search API doesn't page past this many results
+SEARCH_MAX_RESULTS = 1000
+PAGE_SIZES = {'album': 1, 'playlist': PLAYLIST_PAGE_SIZE, 'label': SEARCH_PAGE_SIZE}
+
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=RESOLVER_CONCURRENCY))
+
+_token_lock = threading.Lock()
+_token: tuple[str, float] | None = None
+
+
+# Returns the kind ('artist', 'album', 'playlist' or 'label') and ID of a Spotify URL, URI or label
+def parse_spotify_reference(reference: str) -> tuple[str, str] | None:
+    reference = reference.strip()
+    if reference.lower().startswith(LABEL_PREFIX):
+        label = reference[len(LABEL_PREFIX):].strip()
+        return ('label', label) if label else None
+    if not (match := SPOTIFY_URL_PATTERN.match(reference)):
+        return None
+    return match.group('kind') or match.group('uri_kind'), match.group('id') or match.group('uri_id')
+
+
+def canonical_url(kind: str, spotify_id: str) -> str:
+    return f'https://open.spotify.com/{kind}/{spotify_id}'
+
+
+# Artist URLs are hashed into the fetch's directories, so they're canonicalized before being queued
+def canonicalize_artist_url(url: str) -> str:
+    reference = parse_spotify_reference(url)
+    return canonical_url(*reference) if reference and reference[0] == 'artist' else url
+
+
+def spotify_id(url: str) -> str | None:
+    reference = parse_spotify_reference(url)
+    return reference[1] if reference and reference[0] == 'artist' else None
+
+
+def spotify_access_token() -> str:
+    global _token
+    with _token_lock:
+        if _token is None or _token[1] <= time.monotonic():
+            response = _session.post(
+                SPOTIFY_TOKEN_URL,
+                data={'grant_type': 'client_credentials'},
+                auth=(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET),
+                timeout=REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+            token = response.json()
+            # Refreshed a minute early, so a token never expires mid-request
+            _token = (token['access_token'], time.monotonic() + token['expires_in'] - 60)
+
+        return _token[0]
+
+
+def spotify_api_get(path: str, **params) -> dict:
+    response = _session.get(
+        f'{SPOTIFY_API_URL}/{path}',
+        params=params,
+        headers={'Authorization': f'Bearer {spotify_access_token()}'},
+        timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def extract_artist_name_from_page(content: str) -> str:
+    # Only needed when the API could not resolve a name
+    from bs4 import BeautifulSoup
+
+    page = BeautifulSoup(content, 'html.parser')
+    if (title := page.find('meta', property='og:title')) and title.get('content'):
+        return title['content']
+    return page.title.text.removesuffix(' | Spotify')
+
+
+def _resolve_with_api(ids: list[str]) -> dict[str, str]:
+    names = {}
+    for artist in spotify_api_get('artists', ids=','.join(ids))['artists']:
+        if artist is not None:
+            names[artist['id']] = artist['name']
+    return names
+
+
+def _resolve_with_page(url: str) -> str | None:
+    response = _session.get(url, timeout=REQUEST_TIMEOUT, headers={'User-Agent': 'Mozilla/5.0'})
+    response.raise_for_status()
+    name = extract_artist_name_from_page(response.text)
+    # Pages that are rendered client-side only carry the generic title
+    return name if name and name != 'Spotify' else None
+
+
+def _resolve_with_browser(url: str) -> str:
+    page_content = subprocess.check_output(
+        f'chromium-browser --disable-gpu --headless --dump-dom {url} 2>/dev/null',
+        shell=True
+    ).decode()
+    return extract_artist_name_from_page(page_content)
+
+
+def _try(resolve, *args):
+    try:
+        return resolve(*args)
+    except Exception as ex:
+        logging.debug(f'{resolve.__name__} failed: {ex}')
+        return None
+
+
+# Resolves artist names through the cache, then the Spotify Web API in batches, then the artist pages.
+# Headless Chromium is only started for whatever is still unresolved, and only if allowed.
+def resolve_artist_names(urls: list[str], allow_browser: bool = True) -> dict[str, str]:
+    fresh_since = (datetime.now() - ARTIST_NAME_CACHE_TTL).strftime(DATETIME_FORMAT)
+    names = store.get_cached_artist_names(urls, fresh_since)
+    resolved = {}
+
+    missing = [url for url in dict.fromkeys(urls) if url not in names]
+    ids = {url: artist_id for url in missing if (artist_id := spotify_id(url))}
+    unique_ids = list(dict.fromkeys(ids.values()))
+    batches = [unique_ids[i:i + SPOTIFY_ARTISTS_BATCH_SIZE] for i in range(0, len(unique_ids), SPOTIFY_ARTISTS_BATCH_SIZE)]
+
+    with ThreadPoolExecutor(max_workers=RESOLVER_CONCURRENCY, thread_name_prefix='resolver') as executor:
+        names_by_id = {}
+        for batch_names in executor.map(lambda batch: _try(_resolve_with_api, batch), batches):
+            names_by_id.update(batch_names or {})
+        resolved.update({url: names_by_id[artist_id] for url, artist_id in ids.items() if artist_id in names_by_id})
+
+        missing = [url for url in missing if url not in resolved]
+        for url, name in zip(missing, executor.map(lambda url: _try(_resolve_with_page, url), missing)):
+            if name:
+                resolved[url] = name
+
+    if allow_browser:
+        for url in [url for url in missing if url not in resolved]:
+            logging.info(f'Falling back to a headless browser for the name of {url}')
+            if name := _try(_resolve_with_browser, url):
+                resolved[url] = name
+
+    if resolved:
+        store.cache_artist_names(resolved, datetime.now().strftime(DATETIME_FORMAT))
+
+    return {**names, **resolved}
+
+
+def _artists_credited_on(items: list[dict]) -> dict[str, str]:
+    # Local files in playlists have artists without an ID
+    return {artist['id']: artist['name'] for item in items for artist in item['artists'] if artist.get('id')}
+
+
+# Returns the artists of a page of an album, playlist or label, with the total number of items to page through
+def _expansion_page(kind: str, source_id: str, offset: int) -> tuple[dict[str, str], int]:
+    if kind == 'album':
+        return _artists_credited_on([spotify_api_get(f'albums/{source_id}')]), 1
+
+    if kind == 'playlist':
+        page = spotify_api_get(
+            f'playlists/{source_id}/tracks',
+            offset=offset,
+            limit=PLAYLIST_PAGE_SIZE,
+            fields='total,items(track(artists(id,name)))'
+        )
+        return _artists_credited_on([item['track'] for item in page['items'] if item.get('track')]), page['total']
+
+    page = spotify_api_get('search', q=f'label:"{source_id}"', type='album', offset=offset, limit=SEARCH_PAGE_SIZE)
+    return _artists_credited_on(page['albums']['items']), min(page['albums']['total'], SEARCH_MAX_RESULTS)
+
+
+# Expands albums, playlists and labels into the artists credited on them, by canonical artist URL with their names.
+# The first page of every source is fetched concurrently, then the rest of their pages. Also returns the sources that
+# could not be expanded completely.
+def expand_to_artists(sources: list[tuple[str, str]]) -> tuple[dict[str, str], list[tuple[str, str]]]:
+    def fetch_page(page: tuple[str, str, int]) -> tuple[dict[str, str], int] | None:
+        return _try(_expansion_page, *page)
+
+    with ThreadPoolExecutor(max_workers=RESOLVER_CONCURRENCY, thread_name_prefix='resolver') as executor:
+        first_pages = list(executor.map(fetch_page, [(kind, source_id, 0) for kind, source_id in sources]))
+        remaining_pages = [
+            (kind, source_id, offset)
+            for (kind, source_id), first_page in zip(sources, first_pages) if first_page
+            for offset in range(PAGE_SIZES[kind], first_page[1], PAGE_SIZES[kind])
+        ]
+        pages = [*first_pages, *executor.map(fetch_page, remaining_pages)]
+
+    names_by_id = {}
+    for page in pages:
+        names_by_id.update(page[0] if page else {})
+    names = {canonical_url('artist', artist_id): name for artist_id, name in names_by_id.items()}
+    if names:
+        store.cache_artist_names(names, datetime.now().strftime(DATETIME_FORMAT))
+
+    failed = {source for source, first_page in zip(sources, first_pages) if not first_page}
+    failed |= {page[:2] for page, result in zip(remaining_pages, pages[len(first_pages):]) if not result}
+    return names, [source for source in sources if source in failed]
+
+
+def resolve_artist_name(url: str, allow_browser: bool = True) -> str | None:
+    return resolve_artist_names([url], allow_browser=allow_browser).get(url)
@@ -0,0 +1,140 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+import store
+from consts import DATETIME_FORMAT, RUNTIME_DIR, STORE_FILE, SHOULD_STOP_FILE, SLEEP_IN_LOOP
+from watcher import open_inotify, watch_directory
+
+STORE_FILE_NAMES = {STORE_FILE.name, f'{STORE_FILE.name}-wal'}
+
+
+class Scheduler:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._stopping = False
+        # A requested stop lets the in-flight jobs finish first, and can be cancelled until they have
+        self._draining = False
+        self._parked = 0
+        self._pack_times: list[tuple[datetime, str]] = []
+        self._pack_times_stale = True
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping
+
+    @property
+    def draining(self) -> bool:
+        return self._draining
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._pack_times_stale = True
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def request_stop(self):
+        with self._condition:
+            if not self._draining and not self._stopping:
+                logging.info('Stop requested, waiting for in-flight jobs to finish')
+            self._draining = True
+            self._condition.notify_all()
+
+    # Returns whether the stop could still be cancelled
+    def cancel_stop(self) -> bool:
+        with self._condition:
+            if self._stopping:
+                return False
+            if self._draining:
+                logging.info('Stop cancelled, listening for jobs')
+            self._draining = False
+            self._generation += 1
+            self._condition.notify_all()
+            return True
+
+    # Idles a worker that finished its job while draining, until the stop is cancelled or the service stops
+    def park(self):
+        with self._condition:
+            self._parked += 1
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._draining or self._stopping)
+            self._parked -= 1
+
+    def wait_until_drained(self, worker_count: int):
+        with self._condition:
+            self._condition.wait_for(lambda: self._stopping or (self._draining and self._parked == worker_count))
+            self._stopping = True
+            self._condition.notify_all()
+
+    def next_pack_time(self) -> datetime | None:
+        with self._condition:
+            if self._pack_times_stale:
+                self._pack_times = [
+                    (datetime.strptime(time_to_pack, DATETIME_FORMAT), url_hash)
+                    for time_to_pack, url_hash in store.read_unclaimed_packer_times()
+                ]
+                heapq.heapify(self._pack_times)
+                self._pack_times_stale = False
+
+            return self._pack_times[0][0] if self._pack_times else None
+
+    # Sleeps until something changes since `generation` was read, or until `until` has passed
+    def wait(self, generation: int, until: datetime | None = None):
+        with self._condition:
+            if until is not None:
+                # Jobs are only due at second resolution, avoid waking up just before that
+                timeout = max((until - datetime.now()).total_seconds(), 0) + 0.1
+            else:
+                timeout = None
+
+            self._condition.wait_for(
+                lambda: self._generation != generation or self._stopping or self._draining, timeout
+            )
+
+    # A failed claim means the in-memory view is behind the store
+    def invalidate(self):
+        with self._condition:
+            self._pack_times_stale = True
+
+    def wait_for_stop(self, timeout: float | None = None):
+        with self._condition:
+            self._condition.wait_for(lambda: self._stopping, timeout)
+
+    def start_watching(self, should_stop_running):
+        if should_stop_running():
+            self.stop()
+            return
+
+        try:
+            fd = open_inotify(RUNTIME_DIR)
+        except OSError:
+            logging.warning(f'Could not watch {RUNTIME_DIR}, falling back to polling every {SLEEP_IN_LOOP}s')
+            threading.Thread(target=self._poll, args=(should_stop_running,), name='watcher', daemon=True).start()
+            return
+
+        def on_change(names: set[str]):
+            if SHOULD_STOP_FILE.name in names and should_stop_running():
+                self.request_stop()
+            if names & STORE_FILE_NAMES:
+                self.notify()
+
+        threading.Thread(target=watch_directory, args=(fd, on_change), name='watcher', daemon=True).start()
+
+    def _poll(self, should_stop_running):
+        while not self._stopping:
+            time.sleep(SLEEP_IN_LOOP)
+            if should_stop_running():
+                self.request_stop()
+            self.notify()
@@ -0,0 +1,8 @@
+# Imported by Python at startup when this directory is on the PYTHONPATH, which it only is for spotdl
+try:
+    import spotify_cache
+
+    spotify_cache.install()
+except Exception:
+    # spotdl works without the cache, just slower
+    pass
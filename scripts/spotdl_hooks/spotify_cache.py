@@ -0,0 +1,246 @@
+# Cache of Spotify Web API responses, shared by all spotdl processes across artists and runs. It's loaded into spotdl's
+# interpreter by the sitecustomize module next to it, and only uses the standard library, since spotdl runs from its
+# own virtualenv. Responses are keyed by their endpoint, which holds the Spotify ID. Lookups of several IDs at once are
+# cached per ID, so they are shared with the lookups of single IDs.
+import atexit
+import importlib.abc
+import importlib.machinery
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+CACHE_FILE_VARIABLE = 'SPOTIFETCH_SPOTIFY_CACHE'
+TTL_VARIABLE = 'SPOTIFETCH_SPOTIFY_CACHE_TTL'
+LISTING_TTL_VARIABLE = 'SPOTIFETCH_SPOTIFY_CACHE_LISTING_TTL'
+MAX_BYTES_VARIABLE = 'SPOTIFETCH_SPOTIFY_CACHE_MAX_BYTES'
+
+API_URL = 'https://api.spotify.com/v1/'
+# Endpoints taking several IDs, answered with a list of objects under the endpoint's name
+BULK_ENDPOINTS = {'tracks', 'albums', 'artists'}
+# Albums, their tracks and artists don't change once released. Everything else, like an artist's albums or searches,
+# changes with new releases and is cached for the listing TTL.
+ENTITY_ENDPOINT_PATTERN = re.compile(r'^(?:tracks/[^/]+|albums/[^/]+(?:/tracks)?|artists/[^/]+)$')
+
+# Seconds to wait for another process writing to the cache
+LOCK_TIMEOUT = 30
+# Last use is only written back this often, so reads don't contend for the lock
+TOUCH_INTERVAL = 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+
+def _endpoint(url: str, params: dict | None) -> tuple[str, dict[str, str]]:
+    parts = urlsplit(url)
+    path = parts.path.split('/v1/', 1)[-1].strip('/')
+    query = dict(parse_qsl(parts.query))
+    query.update({name: str(value) for name, value in (params or {}).items() if value is not None})
+    return path, query
+
+
+def _key(path: str, query: dict[str, str]) -> str:
+    return f'{path}?{urlencode(sorted(query.items()))}' if query else path
+
+
+class MetadataCache:
+    def __init__(self, path: str, ttl: float, listing_ttl: float, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.listing_ttl = listing_ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stored': 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        if (connection := getattr(self._local, 'connection', None)) is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, key: str) -> object | None:
+        now = time.time()
+        try:
+            row = self._connection().execute(
+                'SELECT body, used_at FROM responses WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row and now - row[1] > TOUCH_INTERVAL:
+                self._connection().execute('UPDATE responses SET used_at = ? WHERE key = ?', (now, key))
+        except sqlite3.Error:
+            logging.debug(f'Could not read {key} from the Spotify cache', exc_info=True)
+            row = None
+
+        self._count('hits' if row else 'misses')
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, response: object):
+        if response is None:
+            return
+
+        path = key.split('?', 1)[0]
+        body = json.dumps(response, separators=(',', ':'))
+        now = time.time()
+        try:
+            self._connection().execute(
+                '''
+                INSERT INTO responses (key, body, size, expires_at, used_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET body = excluded.body, size = excluded.size,
+                                                expires_at = excluded.expires_at, used_at = excluded.used_at
+                ''',
+                (key, body, len(key) + len(body), now + (self.ttl if ENTITY_ENDPOINT_PATTERN.match(path) else self.listing_ttl), now)
+            )
+            self._count('stored')
+        except sqlite3.Error:
+            logging.debug(f'Could not write {key} to the Spotify cache', exc_info=True)
+
+    # `call(url, params)` makes the actual request
+    def cached_get(self, url: str, params: dict | None, call) -> object:
+        path, query = _endpoint(url, params)
+        if path in BULK_ENDPOINTS and 'ids' in query:
+            return self._cached_bulk_get(path, query, call)
+
+        key = _key(path, query)
+        if (response := self.get(key)) is None:
+            response = call(url, params)
+            self.put(key, response)
+        return response
+
+    def _cached_bulk_get(self, path: str, query: dict[str, str], call) -> dict:
+        ids = query.pop('ids').split(',')
+        keys = {spotify_id: _key(f'{path}/{spotify_id}', query) for spotify_id in ids}
+        objects = {spotify_id: self.get(key) for spotify_id, key in keys.items()}
+
+        if missing := [spotify_id for spotify_id, cached in objects.items() if cached is None]:
+            response = call(path, {**query, 'ids': ','.join(missing)})
+            # In the order they were asked for, relinked tracks can come back with another ID
+            for spotify_id, fetched in zip(missing, (response or {}).get(path) or []):
+                objects[spotify_id] = fetched
+                self.put(keys[spotify_id], fetched)
+
+        return {path: [objects[spotify_id] for spotify_id in ids]}
+
+    # Evicts the expired responses, then the least recently used ones until the cache fits its size limit
+    def evict(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+        connection.execute(
+            '''
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used_at DESC, key) AS total FROM responses)
+                WHERE total > ?
+            )
+            ''',
+            (self.max_bytes,)
+        )
+
+    # Adds this process's counters to the shared ones, and evicts if it stored anything
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, dict.fromkeys(self._counters, 0)
+        try:
+            self._connection().executemany(
+                '''
+                INSERT INTO counters (name, value) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+                ''',
+                counters.items()
+            )
+            if counters['stored']:
+                self.evict()
+        except sqlite3.Error:
+            logging.debug('Could not update the Spotify cache', exc_info=True)
+
+
+def cache_stats(path: str) -> dict[str, int]:
+    if not os.path.isfile(path):
+        return {}
+
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=LOCK_TIMEOUT)
+    try:
+        entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'entries': entries, 'bytes': size, **dict(connection.execute('SELECT name, value FROM counters'))}
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        connection.close()
+
+
+def patch_spotipy(spotify_class: type, cache: MetadataCache):
+    # spotdl overrides Spotify._get, every request still goes through _internal_call
+    internal_call = spotify_class._internal_call
+
+    def _internal_call(self, method, url, payload, params):
+        full_url = url if url.startswith('http') else f'{self.prefix}{url}'
+        if method != 'GET' or not full_url.startswith(API_URL):
+            return internal_call(self, method, url, payload, params)
+        return cache.cached_get(full_url, params, lambda url, params: internal_call(self, method, url, payload, params))
+
+    spotify_class._internal_call = _internal_call
+
+
+class _PatchingLoader(importlib.abc.Loader):
+    def __init__(self, loader: importlib.abc.Loader, cache: MetadataCache):
+        self.loader = loader
+        self.cache = cache
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        patch_spotipy(module.Spotify, self.cache)
+
+
+# Patches spotipy once spotdl imports it, processes that never do don't pay for importing it
+class _SpotipyFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, cache: MetadataCache):
+        self.cache = cache
+
+    def find_spec(self, name, path, target=None):
+        if name != 'spotipy.client':
+            return None
+
+        sys.meta_path.remove(self)
+        spec = importlib.machinery.PathFinder.find_spec(name, path)
+        if spec and spec.loader:
+            spec.loader = _PatchingLoader(spec.loader, self.cache)
+        return spec
+
+
+def install():
+    if not (path := os.environ.get(CACHE_FILE_VARIABLE)):
+        return
+
+    cache = MetadataCache(
+        path,
+        float(os.environ.get(TTL_VARIABLE, 0)),
+        float(os.environ.get(LISTING_TTL_VARIABLE, 0)),
+        int(os.environ.get(MAX_BYTES_VARIABLE, 0))
+    )
+    sys.meta_path.insert(0, _SpotipyFinder(cache))
+    atexit.register(cache.flush)
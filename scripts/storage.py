@@ -0,0 +1,199 @@
+import contextlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import consts
+import metrics
+import store
+from consts import OUT_DIR, MUSIC_DIR, STATE_DIR, ALBUM_PIPELINE, STORAGE_MIN_FREE, STORAGE_TRACK_BYTES, \
+    STORAGE_RETENTION, STORAGE_GC_INTERVAL, STORAGE_ERROR_LOGS_KEPT, STORAGE_PARTIAL_RETENTION, FetcherException
+from downloader import SONG_LIST_FILE_NAME, BATCH_FILE_NAME
+
+URL_HASH_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# Per-artist state files that are only needed while the artist is queued or waiting to be packed, its manifest is kept
+ARTIST_STATE_FILE_NAMES = (SONG_LIST_FILE_NAME, BATCH_FILE_NAME, 'beets.yaml', 'import.log')
+
+
+class InsufficientSpace(FetcherException):
+    pass
+
+
+# Space the jobs in flight may still write, per device, by job. Jobs are admitted against the free space minus these.
+_lock = threading.Lock()
+_reservations: dict[str, dict[int, int]] = {}
+
+
+# The data directories are only created by the first jobs
+def _existing(path: Path) -> Path:
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def _device(path: Path) -> int:
+    return os.stat(_existing(path)).st_dev
+
+
+def _by_device(footprint: dict[Path, int]) -> dict[int, tuple[Path, int]]:
+    devices = {}
+    for path, size in footprint.items():
+        device = _device(path)
+        first_path, total = devices.get(device, (path, 0))
+        devices[device] = (first_path, total + size)
+    return devices
+
+
+def _reserved(device: int) -> int:
+    return sum(reservation.get(device, 0) for reservation in _reservations.values())
+
+
+def free_bytes(path: Path) -> int:
+    return shutil.disk_usage(_existing(path)).free
+
+
+def available_bytes(path: Path) -> int:
+    with _lock:
+        return free_bytes(path) - _reserved(_device(path)) - STORAGE_MIN_FREE
+
+
+def fetch_footprint(tracks: int) -> dict[Path, int]:
+    footprint = {OUT_DIR: tracks * STORAGE_TRACK_BYTES}
+    if ALBUM_PIPELINE:
+        # The albums are packed while the artist is still downloading
+        footprint[consts.PRODUCTS_DIR] = tracks * STORAGE_TRACK_BYTES
+    return footprint
+
+
+# Most tracks a fetch may download to fit on the disk now
+def admissible_tracks() -> int:
+    return min(available_bytes(path) // size for path, size in _by_device(fetch_footprint(1)).values())
+
+
+# The import moves the downloaded albums into the music directory, then the product is written from there
+def pack_footprint(url_hash: str) -> dict[Path, int]:
+    downloaded = metrics.directory_size(OUT_DIR / url_hash)
+    footprint = {consts.PRODUCTS_DIR: downloaded + metrics.directory_size(MUSIC_DIR / url_hash)}
+    if _device(OUT_DIR) != _device(MUSIC_DIR):
+        footprint[MUSIC_DIR] = downloaded
+    return footprint
+
+
+def reserve(job: str, footprint: dict[Path, int]):
+    with _lock:
+        devices = _by_device(footprint)
+        for device, (path, size) in devices.items():
+            available = free_bytes(path) - _reserved(device) - STORAGE_MIN_FREE
+            if size > available:
+                raise InsufficientSpace(
+                    f'Not enough space for {job} in {path}: needs {size / 1e9:.1f} GB, '
+                    f'{max(available, 0) / 1e9:.1f} GB available'
+                )
+        _reservations[job] = {device: size for device, (_, size) in devices.items()}
+
+
+def release(job: str):
+    with _lock:
+        _reservations.pop(job, None)
+
+
+@contextlib.contextmanager
+def reserved(job: str, footprint: dict[Path, int]) -> Iterator[None]:
+    reserve(job, footprint)
+    try:
+        yield
+    finally:
+        release(job)
+
+
+def reserved_bytes() -> int:
+    with _lock:
+        return sum(sum(reservation.values()) for reservation in _reservations.values())
+
+
+def _last_modified(path: Path) -> float:
+    last_modified = path.lstat().st_mtime
+    for root, directories, file_names in os.walk(path):
+        for name in directories + file_names:
+            with contextlib.suppress(FileNotFoundError):
+                last_modified = max(last_modified, os.lstat(os.path.join(root, name)).st_mtime)
+    return last_modified
+
+
+def _remove(path: Path, dry_run: bool) -> int:
+    size = metrics.directory_size(path) if path.is_dir() else path.stat().st_size
+    if not dry_run:
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+    return size
+
+
+def _garbage(now: float) -> Iterator[Path]:
+    expired = now - STORAGE_RETENTION.total_seconds()
+    active = store.read_active_url_hashes()
+
+    for artist_dir in sorted(STATE_DIR.iterdir()) if STATE_DIR.is_dir() else []:
+        if not artist_dir.is_dir() or not URL_HASH_PATTERN.match(artist_dir.name):
+            continue
+        # The latest error logs tell what went wrong with an artist that's still queued
+        error_logs = sorted(artist_dir.glob('error*'), reverse=True)
+        for error_log in error_logs[STORAGE_ERROR_LOGS_KEPT if artist_dir.name in active else 0:]:
+            if error_log.stat().st_mtime < expired:
+                yield error_log
+        if artist_dir.name in active:
+            continue
+        for name in ARTIST_STATE_FILE_NAMES:
+            if (path := artist_dir / name).is_file() and path.stat().st_mtime < expired:
+                yield path
+
+    # Downloads and imports of artists that are no longer queued, e.g. removed while they were failing
+    for data_dir in (OUT_DIR, MUSIC_DIR):
+        for artist_dir in sorted(data_dir.iterdir()) if data_dir.is_dir() else []:
+            if URL_HASH_PATTERN.match(artist_dir.name) and artist_dir.name not in active \
+                    and _last_modified(artist_dir) < expired:
+                yield artist_dir
+
+    products_dir = consts.PRODUCTS_DIR
+    for partial in sorted(products_dir.glob('*.partial')) if products_dir.is_dir() else []:
+        if partial.stat().st_mtime < now - STORAGE_PARTIAL_RETENTION.total_seconds():
+            yield partial
+
+
+# Returns the removed paths with their sizes
+def collect_garbage(dry_run: bool = False) -> list[tuple[Path, int]]:
+    removed = []
+    for path in _garbage(time.time()):
+        try:
+            removed.append((path, _remove(path, dry_run)))
+        except FileNotFoundError:
+            pass
+
+    if removed and not dry_run:
+        logging.info(f'Removed {len(removed)} leftover(s), {sum(size for _, size in removed) / 1e6:.1f} MB')
+    return removed
+
+
+def artist_disk_usage(url_hash: str) -> dict[str, int]:
+    return {
+        'downloaded': metrics.directory_size(OUT_DIR / url_hash),
+        'imported': metrics.directory_size(MUSIC_DIR / url_hash),
+        'state': metrics.directory_size(STATE_DIR / url_hash),
+    }
+
+
+def run_storage_gc(scheduler):
+    while not scheduler.stopping:
+        try:
+            with metrics.span('storage_gc'):
+                collect_garbage()
+        except Exception:
+            logging.exception('Exception occurred while collecting garbage')
+
+        scheduler.wait_for_stop(timeout=STORAGE_GC_INTERVAL.total_seconds())
@@ -0,0 +1,795 @@
+import contextlib
+import json
+import logging
+import math
+import sqlite3
+import threading
+from typing import Iterator
+
+from consts import STORE_FILE, FETCH_QUEUE_FILE, PACKER_QUEUE_FILE, FETCH_AGING_HOURS, FETCH_DEFAULT_TRACK_ESTIMATE, \
+    FETCH_PRIORITY_HOURS, FETCH_FAIRNESS_HOURS, FETCH_FAIRNESS_HALF_LIFE
+
+ARTIST_FETCH_COLUMNS = ('url', 'name', 'status', 'error_log', 'ignore_errors', 'priority', 'requester', 'estimated_tracks')
+PACKER_JOB_COLUMNS = ('url_hash', 'product_name', 'time_to_pack', 'attributes')
+# The albums of an artist that is being fetched are imported and packed by the fetch itself, its packer job only
+# becomes available to the pack workers once the fetch is done
+NOT_FETCHING = 'url_hash NOT IN (SELECT url_hash FROM artist_fetches WHERE claimed_by IS NOT NULL)'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artist_fetches (
+    url TEXT PRIMARY KEY,
+    url_hash TEXT NOT NULL,
+    name TEXT,
+    status TEXT,
+    error_log TEXT,
+    ignore_errors INTEGER,
+    priority TEXT NOT NULL DEFAULT 'normal',
+    requester TEXT,
+    estimated_tracks INTEGER,
+    queued_at TEXT,
+    schedule_key REAL,
+    position INTEGER NOT NULL,
+    claimed_by TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS artist_fetches_url_hash ON artist_fetches (url_hash);
+CREATE INDEX IF NOT EXISTS artist_fetches_status ON artist_fetches (status, position);
+CREATE INDEX IF NOT EXISTS artist_fetches_position ON artist_fetches (position);
+
+-- Case-insensitive substring search on the names and URLs of the queued fetches, kept in sync by the triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS artist_fetches_search USING fts5(name, url, tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS artist_fetches_search_insert AFTER INSERT ON artist_fetches BEGIN
+    INSERT INTO artist_fetches_search (rowid, name, url) VALUES (new.rowid, new.name, new.url);
+END;
+CREATE TRIGGER IF NOT EXISTS artist_fetches_search_update AFTER UPDATE OF name, url ON artist_fetches BEGIN
+    UPDATE artist_fetches_search SET name = new.name, url = new.url WHERE rowid = new.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS artist_fetches_search_delete AFTER DELETE ON artist_fetches BEGIN
+    DELETE FROM artist_fetches_search WHERE rowid = old.rowid;
+END;
+
+-- Fetches every requester started recently, decaying over time
+CREATE TABLE IF NOT EXISTS fetch_requesters (
+    requester TEXT PRIMARY KEY,
+    recent_fetches REAL NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+-- Track counts of the artists' discographies, kept after their fetches are done for when they are queued again
+CREATE TABLE IF NOT EXISTS artist_sizes (
+    url_hash TEXT PRIMARY KEY,
+    tracks INTEGER NOT NULL,
+    measured_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS packer_jobs (
+    url_hash TEXT PRIMARY KEY,
+    product_name TEXT NOT NULL,
+    time_to_pack TEXT NOT NULL,
+    attributes TEXT NOT NULL DEFAULT '{}',
+    position INTEGER NOT NULL,
+    claimed_by TEXT,
+    awaiting_swing_since TEXT
+);
+CREATE INDEX IF NOT EXISTS packer_jobs_time_to_pack ON packer_jobs (time_to_pack);
+
+CREATE TABLE IF NOT EXISTS track_failures (
+    url_hash TEXT NOT NULL,
+    track_url TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    audio_providers TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (url_hash, track_url)
+);
+
+CREATE TABLE IF NOT EXISTS service_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS artist_names (
+    url TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    resolved_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS shipped_images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    product_name TEXT,
+    shipped_at TEXT NOT NULL
+);
+'''
+
+# States of the queued fetches, as shown by the CLI and the metrics
+FETCH_STATES = {
+    'pending': 'claimed_by IS NULL AND (status IS NULL OR ignore_errors)',
+    'running': 'claimed_by IS NOT NULL',
+    'failed': "claimed_by IS NULL AND status = 'FAILED' AND NOT COALESCE(ignore_errors, 0)",
+}
+# Ranks of the priority classes, normal is the default
+FETCH_PRIORITIES = {'low': -1, 'normal': 0, 'high': 1, 'urgent': 2}
+# The trigram index only matches searches of at least three characters, shorter ones scan the queue
+SEARCH_MIN_INDEXED_LENGTH = 3
+
+# Columns added after a table was first created, applied to existing stores on connect
+ADDED_COLUMNS = {
+    'artist_fetches': {
+        'claimed_by': 'TEXT',
+        'priority': "TEXT NOT NULL DEFAULT 'normal'",
+        'requester': 'TEXT',
+        'estimated_tracks': 'INTEGER',
+        'queued_at': 'TEXT',
+        'schedule_key': 'REAL',
+    },
+    'packer_jobs': {'claimed_by': 'TEXT', 'awaiting_swing_since': 'TEXT'},
+}
+# Values of added columns for the rows that existed before, fetches queued earlier start waiting from the upgrade
+ADDED_COLUMN_VALUES = {
+    ('artist_fetches', 'queued_at'): "datetime('now', 'localtime')",
+}
+# Fetches without a requester are grouped as the requester ''
+REQUESTER = "COALESCE(requester, '')"
+# Indexes on added columns, created once the columns exist
+ADDED_INDEXES = f'''
+CREATE INDEX IF NOT EXISTS artist_fetches_schedule ON artist_fetches ({REQUESTER}, schedule_key, position)
+    WHERE {FETCH_STATES['pending']};
+CREATE INDEX IF NOT EXISTS artist_fetches_running ON artist_fetches (url_hash) WHERE {FETCH_STATES['running']};
+'''
+
+# Recent fetches of a requester, halved every half-life
+DECAYED_RECENT_FETCHES = '''
+    fetch_requesters.recent_fetches * pow(
+        0.5, (julianday('now', 'localtime') - julianday(fetch_requesters.updated_at)) * 24 / :half_life_hours
+    )
+'''
+# Shortest job first in hours: the fetches are ordered by the logarithm of their size, less the hours they waited and the
+# boost of their priority, plus a penalty for requesters that started fetches recently. The lowest score runs first.
+# The time waited shifts all fetches alike, so the part of the score that depends on the fetch alone is stored as its
+# schedule key, counting from when it was queued instead of from now.
+SCHEDULE_KEY = f'''
+    :aging_hours * log2(COALESCE(estimated_tracks, :default_tracks) + 1)
+    + julianday(queued_at) * 24
+    - CASE priority {' '.join(f"WHEN '{name}' THEN {rank}" for name, rank in FETCH_PRIORITIES.items())} ELSE 0 END
+      * :priority_hours
+'''
+REQUESTER_PENALTY = f'COALESCE({DECAYED_RECENT_FETCHES}, 0) * :fairness_hours'
+SCHEDULE_PARAMETERS = {
+    'aging_hours': FETCH_AGING_HOURS,
+    'default_tracks': FETCH_DEFAULT_TRACK_ESTIMATE,
+    'priority_hours': FETCH_PRIORITY_HOURS,
+    'fairness_hours': FETCH_FAIRNESS_HOURS,
+    'half_life_hours': FETCH_FAIRNESS_HALF_LIFE.total_seconds() / 3600,
+}
+SCHEDULE_JOIN = "LEFT JOIN fetch_requesters ON fetch_requesters.requester = COALESCE(artist_fetches.requester, '')"
+FETCH_ORDERS = {
+    'queue': 'artist_fetches.position',
+    'schedule': f'artist_fetches.schedule_key + {REQUESTER_PENALTY}, artist_fetches.position',
+}
+
+_local = threading.local()
+_migrated_lock = threading.Lock()
+_migrated = False
+
+
+def connect() -> sqlite3.Connection:
+    if (connection := getattr(_local, 'connection', None)) is not None:
+        return connection
+
+    # Autocommit mode, transactions are opened explicitly with `transaction()`
+    connection = sqlite3.connect(STORE_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    _add_math_functions(connection)
+    connection.executescript(SCHEMA)
+    _add_missing_columns(connection)
+    connection.executescript(ADDED_INDEXES)
+    _update_schedule_keys(connection)
+    _build_search_index(connection)
+    _local.connection = connection
+
+    _migrate_json_queues(connection)
+    return connection
+
+
+@contextlib.contextmanager
+def transaction():
+    connection = connect()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+# SQLite only has math functions when it was built with them
+def _add_math_functions(connection: sqlite3.Connection):
+    try:
+        connection.execute('SELECT log2(1), pow(1, 1)')
+    except sqlite3.OperationalError:
+        connection.create_function('log2', 1, lambda x: math.log2(x) if x and x > 0 else None, deterministic=True)
+        connection.create_function('pow', 2, lambda x, y: math.pow(x, y) if x is not None and y is not None else None,
+                                   deterministic=True)
+
+
+def _add_missing_columns(connection: sqlite3.Connection):
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row['name'] for row in connection.execute(f'PRAGMA table_info({table})')}
+        for column, definition in columns.items():
+            if column not in existing:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                if value := ADDED_COLUMN_VALUES.get((table, column)):
+                    connection.execute(f'UPDATE {table} SET {column} = {value}')
+
+
+# Computes the schedule keys of the given fetches, or of all of them when the schedule's settings changed
+def _update_schedule_keys(connection: sqlite3.Connection, where: str | None = None, params: dict | None = None):
+    if where is None:
+        settings = json.dumps(SCHEDULE_PARAMETERS, sort_keys=True)
+        if connection.execute(
+                "SELECT 1 FROM service_state WHERE key = 'schedule_parameters' AND value = ?", (settings,)
+        ).fetchone():
+            return
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(f'UPDATE artist_fetches SET schedule_key = {SCHEDULE_KEY}', SCHEDULE_PARAMETERS)
+            connection.execute(
+                "INSERT OR REPLACE INTO service_state (key, value) VALUES ('schedule_parameters', ?)", (settings,)
+            )
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return
+
+    connection.execute(
+        f'UPDATE artist_fetches SET schedule_key = {SCHEDULE_KEY} WHERE {where}', {**(params or {}), **SCHEDULE_PARAMETERS}
+    )
+
+
+# Stores created before the search index get their queue indexed once
+def _build_search_index(connection: sqlite3.Connection):
+    if connection.execute("SELECT 1 FROM service_state WHERE key = 'artist_search_index'").fetchone():
+        return
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM artist_fetches_search')
+        connection.execute(
+            'INSERT INTO artist_fetches_search (rowid, name, url) SELECT rowid, name, url FROM artist_fetches'
+        )
+        connection.execute("INSERT OR REPLACE INTO service_state (key, value) VALUES ('artist_search_index', '1')")
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def _migrate_json_queues(connection: sqlite3.Connection):
+    global _migrated
+    with _migrated_lock:
+        if _migrated:
+            return
+        _migrated = True
+
+    if not FETCH_QUEUE_FILE.is_file() and not PACKER_QUEUE_FILE.is_file():
+        return
+
+    # The file checks are repeated inside the transaction, in case another process migrated them meanwhile
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if FETCH_QUEUE_FILE.is_file():
+            fetches = json.loads(FETCH_QUEUE_FILE.read_text() or '[]')
+            logging.info(f'Migrating {len(fetches)} queued artists from {FETCH_QUEUE_FILE.name}')
+            for fetch in fetches:
+                _insert_artist_fetch(connection, fetch, replace=False)
+
+        if PACKER_QUEUE_FILE.is_file():
+            jobs = json.loads(PACKER_QUEUE_FILE.read_text() or '[]')
+            logging.info(f'Migrating {len(jobs)} packer jobs from {PACKER_QUEUE_FILE.name}')
+            for job in jobs:
+                insert_packer_job(job, connection=connection)
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+    for queue_file in (FETCH_QUEUE_FILE, PACKER_QUEUE_FILE):
+        if queue_file.is_file():
+            queue_file.rename(queue_file.with_name(f'{queue_file.name}.migrated'))
+
+
+def _artist_fetch_from_row(row: sqlite3.Row) -> dict:
+    fetch = {column: row[column] for column in ARTIST_FETCH_COLUMNS if row[column] is not None}
+    if 'ignore_errors' in fetch:
+        fetch['ignore_errors'] = bool(fetch['ignore_errors'])
+    return fetch
+
+
+def _packer_job_from_row(row: sqlite3.Row) -> dict:
+    job = {column: row[column] for column in PACKER_JOB_COLUMNS}
+    job['attributes'] = json.loads(job['attributes'])
+    return job
+
+
+def _insert_artist_fetch(connection: sqlite3.Connection, fetch: dict, replace: bool = True):
+    # Imported here, so reading the queues doesn't load the product builder
+    from products import calculate_md5
+
+    # Requeued fetches start waiting anew, and keep what's known of their size and requester
+    conflict_clause = '''
+        DO UPDATE SET name = excluded.name, status = excluded.status, error_log = excluded.error_log,
+                      ignore_errors = excluded.ignore_errors, priority = excluded.priority,
+                      requester = COALESCE(excluded.requester, requester),
+                      estimated_tracks = COALESCE(excluded.estimated_tracks, estimated_tracks),
+                      queued_at = excluded.queued_at, position = excluded.position
+    ''' if replace else 'DO NOTHING'
+
+    connection.execute(
+        f'''
+        INSERT INTO artist_fetches (
+            url, url_hash, name, status, error_log, ignore_errors, priority, requester, estimated_tracks, queued_at,
+            position
+        )
+        VALUES (:url, :url_hash, :name, :status, :error_log, :ignore_errors, COALESCE(:priority, 'normal'), :requester,
+                COALESCE(:estimated_tracks, (SELECT tracks FROM artist_sizes WHERE url_hash = :url_hash)),
+                datetime('now', 'localtime'), (SELECT COALESCE(MAX(position), 0) + 1 FROM artist_fetches))
+        ON CONFLICT (url) {conflict_clause}
+        ''',
+        {
+            **{column: fetch.get(column) for column in ARTIST_FETCH_COLUMNS},
+            'url_hash': calculate_md5(fetch['url']),
+        }
+    )
+    _update_schedule_keys(connection, 'url = :url', {'url': fetch['url']})
+
+
+def read_artist_fetches() -> list[dict]:
+    rows = connect().execute(
+        f'SELECT {", ".join(ARTIST_FETCH_COLUMNS)} FROM artist_fetches ORDER BY position'
+    )
+    return [_artist_fetch_from_row(row) for row in rows]
+
+
+def _escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _search_condition(search: str, columns: tuple[str, ...], params: dict) -> str:
+    if len(search) >= SEARCH_MIN_INDEXED_LENGTH:
+        # Quoted as a phrase, the trigrams then have to follow each other like in the searched text
+        phrase = search.replace('"', '""')
+        params['match'] = f'{{{" ".join(columns)}}} : "{phrase}"'
+        return 'artist_fetches.rowid IN (SELECT rowid FROM artist_fetches_search WHERE artist_fetches_search MATCH :match)'
+
+    params['like'] = f'%{_escape_like(search)}%'
+    return '(' + ' OR '.join(f"{column} LIKE :like ESCAPE '\\'" for column in columns) + ')'
+
+
+# Streams the queued fetches in queue order, or in the order they would be run in, optionally only those whose name or URL
+# contains `search` and that match the filters, without reading the whole queue into memory
+def iter_artist_fetches(
+        search: str | None = None,
+        state: str | None = None,
+        ignore_errors: bool | None = None,
+        has_error_log: bool | None = None,
+        limit: int | None = None,
+        offset: int = 0,
+        order: str = 'queue'
+) -> Iterator[dict]:
+    conditions, params = [], {}
+    if search:
+        conditions.append(_search_condition(search, ('name', 'url'), params))
+    if state:
+        conditions.append(FETCH_STATES[state])
+    if ignore_errors is not None:
+        conditions.append('COALESCE(ignore_errors, 0) = :ignore_errors')
+        params['ignore_errors'] = int(ignore_errors)
+    if has_error_log is not None:
+        conditions.append(f'error_log IS {"NOT " if has_error_log else ""}NULL')
+
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    rows = connect().execute(
+        f'''
+        SELECT {_qualified_columns()} FROM artist_fetches {SCHEDULE_JOIN if order == 'schedule' else ''} {where}
+        ORDER BY {FETCH_ORDERS[order]} LIMIT :limit OFFSET :offset
+        ''',
+        {**params, **SCHEDULE_PARAMETERS, 'limit': -1 if limit is None else limit, 'offset': offset}
+    )
+    for row in rows:
+        yield _artist_fetch_from_row(row)
+
+
+# Finds a fetch by its URL, or else by a part of its name or URL. Names starting with it are preferred, then the first
+# name alphabetically.
+def find_artist_fetch(url_or_name: str) -> dict | None:
+    if fetch := get_artist_fetch(url_or_name):
+        return fetch
+
+    params = {'prefix': f'{_escape_like(url_or_name)}%'}
+    row = connect().execute(
+        f'''
+        SELECT {", ".join(ARTIST_FETCH_COLUMNS)} FROM artist_fetches
+        WHERE {_search_condition(url_or_name, ('name', 'url'), params)}
+        ORDER BY name LIKE :prefix ESCAPE '\\' DESC, name LIMIT 1
+        ''',
+        params
+    ).fetchone()
+    return _artist_fetch_from_row(row) if row else None
+
+
+def get_artist_fetch(url: str) -> dict | None:
+    row = connect().execute(
+        f'SELECT {", ".join(ARTIST_FETCH_COLUMNS)} FROM artist_fetches WHERE url = ?', (url,)
+    ).fetchone()
+    return _artist_fetch_from_row(row) if row else None
+
+
+def _qualified_columns() -> str:
+    return ', '.join(f'artist_fetches.{column}' for column in ARTIST_FETCH_COLUMNS)
+
+
+# Atomically takes the runnable fetch that is due first according to the schedule, and that no other worker is handling
+# With `max_tracks`, only fetches estimated to download at most that many tracks are claimed
+def claim_artist_fetch(worker: str, max_tracks: int | None = None) -> dict | None:
+    with transaction() as connection:
+        penalties = {
+            requester['requester']: requester['penalty'] for requester in connection.execute(
+                f'SELECT requester, {REQUESTER_PENALTY} AS penalty FROM fetch_requesters', SCHEDULE_PARAMETERS
+            )
+        }
+
+        # The penalty is the same for all fetches of a requester, so only each requester's first fetch is compared.
+        # The requesters are enumerated by jumping through the index, there are few of them but many fetches.
+        pending = FETCH_STATES['pending']
+        fits = 'COALESCE(estimated_tracks, :default_tracks) <= :max_tracks' if max_tracks is not None else '1'
+        row, score = None, None
+        requester = connection.execute(f'SELECT MIN({REQUESTER}) FROM artist_fetches WHERE {pending}').fetchone()[0]
+        while requester is not None:
+            candidate = connection.execute(
+                f'''
+                SELECT {", ".join(ARTIST_FETCH_COLUMNS)}, schedule_key FROM artist_fetches
+                WHERE {pending} AND {REQUESTER} = :requester AND {fits} ORDER BY schedule_key, position LIMIT 1
+                ''',
+                {**SCHEDULE_PARAMETERS, 'requester': requester, 'max_tracks': max_tracks}
+            ).fetchone()
+            if candidate is None:
+                pass
+            elif row is None or candidate['schedule_key'] + penalties.get(requester, 0) < score:
+                row, score = candidate, candidate['schedule_key'] + penalties.get(requester, 0)
+            requester = connection.execute(
+                f'SELECT MIN({REQUESTER}) FROM artist_fetches WHERE {pending} AND {REQUESTER} > ?', (requester,)
+            ).fetchone()[0]
+        if not row:
+            return None
+
+        connection.execute('UPDATE artist_fetches SET claimed_by = ? WHERE url = ?', (worker, row['url']))
+        connection.execute(
+            f'''
+            INSERT INTO fetch_requesters (requester, recent_fetches, updated_at)
+            VALUES (:requester, 1, datetime('now', 'localtime'))
+            ON CONFLICT (requester) DO UPDATE SET recent_fetches = {DECAYED_RECENT_FETCHES} + 1,
+                                                  updated_at = excluded.updated_at
+            ''',
+            {'requester': row['requester'] or '', **SCHEDULE_PARAMETERS}
+        )
+        return _artist_fetch_from_row(row)
+
+
+def has_pending_artist_fetches() -> bool:
+    return bool(connect().execute(f"SELECT EXISTS (SELECT 1 FROM artist_fetches WHERE {FETCH_STATES['pending']})").fetchone()[0])
+
+
+# Artists whose files are still needed: queued, failed with tracks to retry, or waiting to be packed
+def read_active_url_hashes() -> set[str]:
+    rows = connect().execute(
+        '''
+        SELECT url_hash FROM artist_fetches UNION SELECT url_hash FROM packer_jobs
+        UNION SELECT url_hash FROM track_failures
+        '''
+    )
+    return {row['url_hash'] for row in rows}
+
+
+def release_artist_fetch(url: str):
+    with transaction() as connection:
+        connection.execute('UPDATE artist_fetches SET claimed_by = NULL WHERE url = ?', (url,))
+
+
+# Inserts or replaces an artist fetch, moving it to the end of the queue
+def upsert_artist_fetch(fetch: dict):
+    with transaction() as connection:
+        _insert_artist_fetch(connection, fetch)
+
+
+# Queues many fetches in a single transaction, in their order. Without `replace`, fetches that are queued already
+# are left as they are.
+def upsert_artist_fetches(fetches: list[dict], replace: bool = True):
+    with transaction() as connection:
+        for fetch in fetches:
+            _insert_artist_fetch(connection, fetch, replace=replace)
+
+
+# Updates only the given columns, so concurrent changes to other columns (e.g. from the CLI) are kept
+def update_artist_fetch_fields(url: str, fields: dict):
+    if not fields:
+        return
+
+    assignments = ', '.join(f'{column} = :{column}' for column in fields)
+    with transaction() as connection:
+        connection.execute(f'UPDATE artist_fetches SET {assignments} WHERE url = :url', {**fields, 'url': url})
+        if fields.keys() & {'priority', 'estimated_tracks'}:
+            _update_schedule_keys(connection, 'url = :url', {'url': url})
+
+
+# Remembers the size of an artist's discography, and updates the estimate of its queued fetch
+def set_artist_size(url_hash: str, tracks: int):
+    with transaction() as connection:
+        connection.execute(
+            '''
+            INSERT INTO artist_sizes (url_hash, tracks, measured_at) VALUES (?, ?, datetime('now', 'localtime'))
+            ON CONFLICT (url_hash) DO UPDATE SET tracks = excluded.tracks, measured_at = excluded.measured_at
+            ''',
+            (url_hash, tracks)
+        )
+        connection.execute('UPDATE artist_fetches SET estimated_tracks = ? WHERE url_hash = ?', (tracks, url_hash))
+        _update_schedule_keys(connection, 'url_hash = :url_hash', {'url_hash': url_hash})
+
+
+def delete_artist_fetch(url: str):
+    with transaction() as connection:
+        connection.execute('DELETE FROM artist_fetches WHERE url = ?', (url,))
+
+
+def read_track_failures(url_hash: str) -> list[dict]:
+    rows = connect().execute(
+        '''
+        SELECT track_url, attempts, last_error, audio_providers, updated_at FROM track_failures
+        WHERE url_hash = ? ORDER BY track_url
+        ''',
+        (url_hash,)
+    )
+    return [dict(row) for row in rows]
+
+
+# Records the outcome of a download of `attempted` tracks, or of the whole discography if `attempted` is None
+def set_track_failures(
+        url_hash: str,
+        attempted: list[str] | None,
+        failures: dict[str, str],
+        audio_providers: tuple[str, ...]
+):
+    with transaction() as connection:
+        if attempted is None:
+            connection.execute('DELETE FROM track_failures WHERE url_hash = ?', (url_hash,))
+        else:
+            connection.executemany(
+                'DELETE FROM track_failures WHERE url_hash = ? AND track_url = ?',
+                [(url_hash, track_url) for track_url in attempted if track_url not in failures]
+            )
+
+        connection.executemany(
+            '''
+            INSERT INTO track_failures (url_hash, track_url, attempts, last_error, audio_providers, updated_at)
+            VALUES (?, ?, 1, ?, ?, datetime('now', 'localtime'))
+            ON CONFLICT (url_hash, track_url) DO UPDATE SET
+                attempts = attempts + 1, last_error = excluded.last_error,
+                audio_providers = excluded.audio_providers, updated_at = excluded.updated_at
+            ''',
+            [(url_hash, track_url, error, ' '.join(audio_providers)) for track_url, error in failures.items()]
+        )
+
+
+def clear_track_failures(url_hash: str):
+    with transaction() as connection:
+        connection.execute('DELETE FROM track_failures WHERE url_hash = ?', (url_hash,))
+
+
+def get_state(key: str) -> str | None:
+    row = connect().execute('SELECT value FROM service_state WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else None
+
+
+def set_state(key: str, value: str):
+    with transaction() as connection:
+        connection.execute('INSERT OR REPLACE INTO service_state (key, value) VALUES (?, ?)', (key, value))
+
+
+def get_cached_artist_names(urls: list[str], fresh_since: str) -> dict[str, str]:
+    names = {}
+    # Chunked to stay below SQLite's limit on bound parameters
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows = connect().execute(
+            f'SELECT url, name FROM artist_names WHERE resolved_at >= ? AND url IN ({", ".join("?" * len(chunk))})',
+            (fresh_since, *chunk)
+        )
+        names.update({row['url']: row['name'] for row in rows})
+    return names
+
+
+def cache_artist_names(names: dict[str, str], resolved_at: str):
+    with transaction() as connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO artist_names (url, name, resolved_at) VALUES (?, ?, ?)',
+            [(url, name, resolved_at) for url, name in names.items()]
+        )
+
+
+def read_shipped_images() -> dict[str, dict]:
+    rows = connect().execute('SELECT path, size, mtime_ns, content_hash FROM shipped_images')
+    return {row['path']: {'size': row['size'], 'mtime_ns': row['mtime_ns'], 'hash': row['content_hash']} for row in rows}
+
+
+# Records images as shipped in `product_name`, or only refreshes their stats when the product is None
+def record_shipped_images(images: dict[str, dict], product_name: str | None, shipped_at: str):
+    with transaction() as connection:
+        connection.executemany(
+            '''
+            INSERT INTO shipped_images (path, size, mtime_ns, content_hash, product_name, shipped_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns,
+                content_hash = excluded.content_hash,
+                product_name = COALESCE(excluded.product_name, product_name),
+                shipped_at = CASE WHEN excluded.product_name IS NULL THEN shipped_at ELSE excluded.shipped_at END
+            ''',
+            [
+                (path, image['size'], image['mtime_ns'], image['hash'], product_name, shipped_at)
+                for path, image in images.items()
+            ]
+        )
+
+
+def count_queues(now: str) -> dict[str, int]:
+    connection = connect()
+    counts = ', '.join(f'COUNT(*) FILTER (WHERE {condition}) AS {state}' for state, condition in FETCH_STATES.items())
+    fetches = connection.execute(f'SELECT {counts} FROM artist_fetches').fetchone()
+    packer_jobs = connection.execute(
+        '''
+        SELECT COUNT(*) FILTER (WHERE claimed_by IS NULL AND time_to_pack <= :now) AS due,
+               COUNT(*) FILTER (WHERE claimed_by IS NULL AND time_to_pack > :now) AS scheduled,
+               COUNT(*) FILTER (WHERE claimed_by IS NOT NULL) AS running,
+               COUNT(*) FILTER (WHERE claimed_by IS NULL AND awaiting_swing_since IS NOT NULL) AS awaiting_swing
+        FROM packer_jobs
+        ''',
+        {'now': now}
+    ).fetchone()
+    return {
+        **{f'fetch_{key}': fetches[key] for key in fetches.keys()},
+        **{f'pack_{key}': packer_jobs[key] for key in packer_jobs.keys()},
+    }
+
+
+def read_packer_jobs() -> list[dict]:
+    rows = connect().execute(f'SELECT {", ".join(PACKER_JOB_COLUMNS)} FROM packer_jobs ORDER BY position')
+    return [_packer_job_from_row(row) for row in rows]
+
+
+# Queues a packer job unless one already exists for the artist, returns whether it was inserted.
+# With `awaiting_swing_since`, the job is packed as soon as Swing Music has picked up the artist, or at `time_to_pack`.
+def insert_packer_job(
+        job: dict,
+        connection: sqlite3.Connection | None = None,
+        awaiting_swing_since: str | None = None
+) -> bool:
+    statement = '''
+        INSERT INTO packer_jobs (url_hash, product_name, time_to_pack, attributes, position, awaiting_swing_since)
+        VALUES (:url_hash, :product_name, :time_to_pack, :attributes,
+                (SELECT COALESCE(MAX(position), 0) + 1 FROM packer_jobs), :awaiting_swing_since)
+        ON CONFLICT (url_hash) DO NOTHING
+    '''
+    parameters = {
+        **job,
+        'attributes': json.dumps(job.get('attributes', {})),
+        'awaiting_swing_since': awaiting_swing_since
+    }
+
+    if connection is not None:
+        return connection.execute(statement, parameters).rowcount > 0
+
+    with transaction() as connection:
+        return connection.execute(statement, parameters).rowcount > 0
+
+
+def get_packer_job(url_hash: str) -> dict | None:
+    row = connect().execute(
+        f'SELECT {", ".join(PACKER_JOB_COLUMNS)}, awaiting_swing_since FROM packer_jobs WHERE url_hash = ?',
+        (url_hash,)
+    ).fetchone()
+    return {**_packer_job_from_row(row), 'awaiting_swing_since': row['awaiting_swing_since']} if row else None
+
+
+def get_due_packer_job(now: str) -> dict | None:
+    row = connect().execute(
+        f'''
+        SELECT {", ".join(PACKER_JOB_COLUMNS)} FROM packer_jobs
+        WHERE time_to_pack <= ? ORDER BY position LIMIT 1
+        ''',
+        (now,)
+    ).fetchone()
+    return _packer_job_from_row(row) if row else None
+
+
+def claim_due_packer_job(worker: str, now: str) -> dict | None:
+    with transaction() as connection:
+        row = connection.execute(
+            f'''
+            SELECT {", ".join(PACKER_JOB_COLUMNS)} FROM packer_jobs
+            WHERE claimed_by IS NULL AND time_to_pack <= ? AND {NOT_FETCHING} ORDER BY position LIMIT 1
+            ''',
+            (now,)
+        ).fetchone()
+        if not row:
+            return None
+
+        # A job packed once its leeway ran out is no longer waiting for Swing Music
+        connection.execute(
+            'UPDATE packer_jobs SET claimed_by = ?, awaiting_swing_since = NULL WHERE url_hash = ?',
+            (worker, row['url_hash'])
+        )
+        return _packer_job_from_row(row)
+
+
+def release_packer_job(url_hash: str):
+    with transaction() as connection:
+        connection.execute('UPDATE packer_jobs SET claimed_by = NULL WHERE url_hash = ?', (url_hash,))
+
+
+# Claims left behind by a service that did not shut down cleanly
+def release_all_claims():
+    with transaction() as connection:
+        connection.execute('UPDATE artist_fetches SET claimed_by = NULL WHERE claimed_by IS NOT NULL')
+        connection.execute('UPDATE packer_jobs SET claimed_by = NULL WHERE claimed_by IS NOT NULL')
+
+
+def read_unclaimed_packer_times() -> list[tuple[str, str]]:
+    rows = connect().execute(
+        f'SELECT time_to_pack, url_hash FROM packer_jobs WHERE claimed_by IS NULL AND {NOT_FETCHING} ORDER BY time_to_pack'
+    )
+    return [(row['time_to_pack'], row['url_hash']) for row in rows]
+
+
+def read_packer_jobs_awaiting_swing() -> list[dict]:
+    rows = connect().execute(
+        f'''
+        SELECT {", ".join(PACKER_JOB_COLUMNS)}, awaiting_swing_since FROM packer_jobs
+        WHERE claimed_by IS NULL AND awaiting_swing_since IS NOT NULL ORDER BY position
+        '''
+    )
+    return [{**_packer_job_from_row(row), 'awaiting_swing_since': row['awaiting_swing_since']} for row in rows]
+
+
+# Makes a job that was waiting for Swing Music due right away
+def mark_packer_job_ready(url_hash: str, now: str):
+    with transaction() as connection:
+        connection.execute(
+            '''
+            UPDATE packer_jobs SET time_to_pack = MIN(time_to_pack, ?), awaiting_swing_since = NULL
+            WHERE url_hash = ? AND claimed_by IS NULL AND awaiting_swing_since IS NOT NULL
+            ''',
+            (now, url_hash)
+        )
+
+
+# Sends a packer job to the end of the queue, to be retried no earlier than `time_to_pack`
+def requeue_packer_job(url_hash: str, time_to_pack: str):
+    with transaction() as connection:
+        connection.execute(
+            '''
+            UPDATE packer_jobs SET position = (SELECT COALESCE(MAX(position), 0) + 1 FROM packer_jobs),
+                                   time_to_pack = ?, claimed_by = NULL
+            WHERE url_hash = ?
+            ''',
+            (time_to_pack, url_hash)
+        )
+
+
+def delete_packer_job(url_hash: str):
+    with transaction() as connection:
+        connection.execute('DELETE FROM packer_jobs WHERE url_hash = ?', (url_hash,))
@@ -0,0 +1,87 @@
+import logging
+from datetime import datetime, timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import store
+from consts import SWING_URL, SWING_ACCESS_TOKEN, SWING_IMAGES_DIR, SWING_READINESS_INTERVAL, SWING_SCAN_DEBOUNCE, \
+    SWING_SCAN_MIN_INTERVAL, DATETIME_FORMAT
+
+REQUEST_TIMEOUT = 15
+ARTIST_SEARCH_LIMIT = 20
+ARTIST_IMAGE_SIZES = ('large', 'medium', 'small')
+
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+_session.cookies.set('access_token_cookie', SWING_ACCESS_TOKEN)
+_session.verify = False
+
+
+def swing_get(path: str, **params) -> requests.Response:
+    response = _session.get(f'{SWING_URL}{path}', params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+def trigger_scan():
+    swing_get('/notsettings/trigger-scan')
+
+
+def find_artist(name: str) -> dict | None:
+    results = swing_get('/search/', q=name, itemtype='artists', start=0, limit=ARTIST_SEARCH_LIMIT).json()['results']
+    return next((artist for artist in results if artist['name'].casefold() == name.casefold()), None)
+
+
+def has_artist_image(artist_hash: str) -> bool:
+    images_dir = SWING_IMAGES_DIR / 'artists'
+    candidates = [images_dir / f'{artist_hash}.webp'] + [images_dir / size / f'{artist_hash}.webp' for size in ARTIST_IMAGE_SIZES]
+    return any(candidate.is_file() for candidate in candidates)
+
+
+# An artist is ready once Swing has indexed it and fetched its image, which is what the products are waiting for
+def is_artist_ready(name: str) -> bool:
+    artist = find_artist(name)
+    return artist is not None and has_artist_image(artist['artisthash'])
+
+
+# Triggers Swing rescans for the fetched artists, coalescing the requests of artists that finish close together,
+# and makes their packer jobs due as soon as Swing has picked them up. Their leeway is only a timeout.
+class ReadinessChecker:
+    def __init__(self):
+        self._last_scan: datetime | None = None
+
+    def check(self):
+        if not (jobs := store.read_packer_jobs_awaiting_swing()):
+            return
+
+        now = datetime.now()
+        since = {job['url_hash']: datetime.strptime(job['awaiting_swing_since'], DATETIME_FORMAT) for job in jobs}
+
+        unscanned = [requested for requested in since.values() if self._last_scan is None or requested > self._last_scan]
+        if unscanned and now - min(unscanned) >= SWING_SCAN_DEBOUNCE and \
+                (self._last_scan is None or now - self._last_scan >= SWING_SCAN_MIN_INTERVAL):
+            logging.info(f'Triggering scan of Swing Music for {len(unscanned)} artist(s)')
+            trigger_scan()
+            # Stored times have second resolution, fetches finishing within this second get another scan
+            self._last_scan = now.replace(microsecond=0) - timedelta(seconds=1)
+
+        for job in jobs:
+            # Only a scan that started after the fetch finished can have picked up its songs
+            if self._last_scan is None or since[job['url_hash']] > self._last_scan:
+                continue
+
+            name = job['attributes'].get('artist')
+            if name and is_artist_ready(name):
+                logging.info(f"Swing Music picked up '{name}', packing it now")
+                store.mark_packer_job_ready(job['url_hash'], datetime.now().strftime(DATETIME_FORMAT))
+
+    def run(self, scheduler):
+        while not scheduler.stopping:
+            try:
+                self.check()
+            except Exception:
+                # Swing being unreachable only delays packing until the leeway runs out
+                logging.exception('Exception occurred while checking Swing Music')
+            scheduler.wait_for_stop(timeout=SWING_READINESS_INTERVAL)
@@ -0,0 +1,277 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import metrics
+import store
+from consts import TOOLCHAIN_DIR, TOOLCHAIN_PACKAGES, TOOLCHAIN_CHECK_INTERVAL, TOOLCHAIN_INSTALL_TIMEOUT, \
+    TOOLCHAIN_ROLLBACK_FAILURES, DATETIME_FORMAT, FetcherException
+from processes import run_supervised
+
+PYPI_URL = 'https://pypi.org/pypi/{package}/json'
+REQUEST_TIMEOUT = 15
+STATE_KEY = 'toolchain'
+# Versions that were rolled back are remembered, so they aren't installed again
+REJECTED_VERSIONS_LIMIT = 10
+
+ENVIRONMENTS_DIR = TOOLCHAIN_DIR / 'environments'
+CURRENT_LINK = TOOLCHAIN_DIR / 'current'
+PREVIOUS_LINK = TOOLCHAIN_DIR / 'previous'
+LOCK_FILE = TOOLCHAIN_DIR / '.lock'
+VERSIONS_FILE_NAME = 'versions.json'
+# A staged environment has to pass these before it's swapped in
+SMOKE_TESTS = [['spotdl', '--version'], ['yt-dlp', '--version']]
+
+# Environments used by jobs in flight, they are kept until the jobs are done even if a newer one was swapped in
+_lock = threading.Lock()
+_local = threading.local()
+_pinned: dict[Path, int] = {}
+
+
+def _read_state() -> dict:
+    state = json.loads(store.get_state(STATE_KEY) or '{}')
+    return {'latest': None, 'checked_at': None, 'rejected': [], 'probation': None, **state}
+
+
+def _write_state(state: dict):
+    store.set_state(STATE_KEY, json.dumps(state))
+
+
+def _linked(link: Path) -> Path | None:
+    if link.is_symlink() and (target := link.resolve()).is_dir():
+        return target
+    return None
+
+
+# Links are replaced in one rename, a job starting in between sees either the old or the new environment
+def _link(link: Path, environment: Path):
+    temporary = link.with_name(f'.{link.name}.tmp')
+    temporary.unlink(missing_ok=True)
+    temporary.symlink_to(environment.relative_to(TOOLCHAIN_DIR))
+    os.replace(temporary, link)
+
+
+def installed_versions(environment: Path | None) -> dict[str, str]:
+    if environment is None or not (versions_file := environment / VERSIONS_FILE_NAME).is_file():
+        return {}
+    return json.loads(versions_file.read_text())
+
+
+def current_environment() -> Path | None:
+    return _linked(CURRENT_LINK)
+
+
+# Jobs run every tool from the environment that was current when they started
+@contextlib.contextmanager
+def pin() -> Iterator[Path | None]:
+    with _lock:
+        environment = current_environment()
+        if environment:
+            _pinned[environment] = _pinned.get(environment, 0) + 1
+    _local.environment = environment
+    try:
+        yield environment
+    finally:
+        _local.environment = None
+        if environment:
+            with _lock:
+                if (count := _pinned.pop(environment) - 1) > 0:
+                    _pinned[environment] = count
+
+
+# Falls back to the tools on the PATH until an environment was installed
+def executable(name: str) -> str:
+    environment = getattr(_local, 'environment', None) or current_environment()
+    if environment and (path := environment / 'bin' / name).is_file():
+        return str(path)
+    return name
+
+
+def toolchain_status() -> dict:
+    state = _read_state()
+    current, previous = current_environment(), _linked(PREVIOUS_LINK)
+    return {
+        'current': current.name if current else None,
+        'current_versions': installed_versions(current),
+        'previous': previous.name if previous else None,
+        'previous_versions': installed_versions(previous),
+        'on_probation': bool(state['probation'] and current and state['probation']['environment'] == current.name),
+        'latest_versions': state['latest'],
+        'checked_at': state['checked_at'],
+        'rejected_versions': state['rejected'],
+    }
+
+
+def _rejected(state: dict, versions: dict[str, str]) -> bool:
+    return versions in state['rejected']
+
+
+def _roll_back(state: dict, reason: str) -> Path | None:
+    current = current_environment()
+    previous = _linked(PREVIOUS_LINK)
+    if current and (versions := installed_versions(current)) and not _rejected(state, versions):
+        state['rejected'] = (state['rejected'] + [versions])[-REJECTED_VERSIONS_LIMIT:]
+
+    if previous:
+        _link(CURRENT_LINK, previous)
+        PREVIOUS_LINK.unlink()
+    else:
+        CURRENT_LINK.unlink(missing_ok=True)
+    state['probation'] = None
+
+    logging.warning(
+        f'Rolled back the toolchain {current.name if current else ""} ({reason}), '
+        f'now using {previous.name if previous else "the tools on the PATH"}'
+    )
+    return previous
+
+
+def roll_back(reason: str = 'requested') -> Path | None:
+    with _lock:
+        state = _read_state()
+        previous = _roll_back(state, reason)
+        _write_state(state)
+    return previous
+
+
+# Called with the outcome of every run of the tools. A freshly swapped in environment is on probation until it had a
+# successful run, it's rolled back if its first runs all fail.
+def record_run(ok: bool):
+    environment = getattr(_local, 'environment', None) or current_environment()
+    if environment is None:
+        return
+
+    with _lock:
+        state = _read_state()
+        if not (probation := state['probation']) or probation['environment'] != environment.name:
+            return
+
+        if ok:
+            logging.info(f'Toolchain {environment.name} passed its first run')
+            state['probation'] = None
+        else:
+            probation['failures'] += 1
+            if probation['failures'] >= TOOLCHAIN_ROLLBACK_FAILURES and current_environment() == environment:
+                _roll_back(state, f'its first {probation["failures"]} run(s) failed')
+        _write_state(state)
+
+
+def latest_versions(force: bool = False) -> dict[str, str]:
+    import requests
+
+    state = _read_state()
+    if not force and state['latest'] and set(state['latest']) == set(TOOLCHAIN_PACKAGES) and \
+            datetime.now() - datetime.strptime(state['checked_at'], DATETIME_FORMAT) < TOOLCHAIN_CHECK_INTERVAL:
+        return state['latest']
+
+    versions = {}
+    for package in TOOLCHAIN_PACKAGES:
+        response = requests.get(PYPI_URL.format(package=package), timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        versions[package] = response.json()['info']['version']
+
+    with _lock:
+        state = _read_state()
+        state['latest'] = versions
+        state['checked_at'] = datetime.now().strftime(DATETIME_FORMAT)
+        _write_state(state)
+    return versions
+
+
+# Installs the versions into a new environment next to the current one, which is removed again if it fails to install
+# or to pass the smoke tests
+def stage_environment(versions: dict[str, str]) -> Path:
+    environment = ENVIRONMENTS_DIR / datetime.now().strftime('%Y%m%d-%H%M%S')
+    python = str(environment / 'bin' / 'python')
+    steps = [
+        ('venv', [sys.executable, '-m', 'venv', str(environment)]),
+        ('pip install', [python, '-m', 'pip', 'install', '--disable-pip-version-check',
+                         *[f'{package}=={version}' for package, version in versions.items()]]),
+        ('pip check', [python, '-m', 'pip', 'check']),
+        *[(' '.join(test), [str(environment / 'bin' / test[0]), *test[1:]]) for test in SMOKE_TESTS],
+    ]
+
+    ENVIRONMENTS_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        for step, command in steps:
+            report = run_supervised(step, command, timeout=TOOLCHAIN_INSTALL_TIMEOUT)
+            if report.killed_reason or report.return_code != 0:
+                raise FetcherException(f'Staging the toolchain failed: {report.summary()}')
+        (environment / VERSIONS_FILE_NAME).write_text(json.dumps(versions))
+    except BaseException:
+        shutil.rmtree(environment, ignore_errors=True)
+        raise
+
+    return environment
+
+
+def _collect_garbage():
+    with _lock:
+        keep = {current_environment(), _linked(PREVIOUS_LINK), *_pinned}
+    for environment in ENVIRONMENTS_DIR.iterdir():
+        if environment not in keep:
+            logging.info(f'Removing the unused toolchain {environment.name}')
+            shutil.rmtree(environment, ignore_errors=True)
+
+
+# Updates, and the garbage collection along with them, are serialized between the service and the CLI
+@contextlib.contextmanager
+def _update_lock() -> Iterator[bool]:
+    TOOLCHAIN_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LOCK_FILE, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+# Returns the versions that were swapped in, None when the toolchain was already up to date
+def update_toolchain(force: bool = False) -> dict[str, str] | None:
+    with _update_lock() as locked:
+        if not locked:
+            logging.info('The toolchain is already being updated')
+            return None
+
+        versions = latest_versions(force)
+        if versions == installed_versions(current_environment()):
+            return None
+        if _rejected(_read_state(), versions):
+            logging.info(f'Not updating the toolchain to {versions}, it was rolled back before')
+            return None
+
+        logging.info(f'Staging toolchain {versions}')
+        with metrics.span('toolchain_update', **versions):
+            environment = stage_environment(versions)
+
+        with _lock:
+            if current := current_environment():
+                _link(PREVIOUS_LINK, current)
+            _link(CURRENT_LINK, environment)
+            state = _read_state()
+            state['probation'] = {'environment': environment.name, 'failures': 0}
+            _write_state(state)
+        logging.info(f'Swapped in toolchain {environment.name}, jobs starting from now on use it')
+
+        _collect_garbage()
+        return versions
+
+
+def run_toolchain_updates(scheduler):
+    while not scheduler.stopping:
+        try:
+            update_toolchain()
+        except Exception:
+            # The current environment stays in use, the next check tries again
+            logging.exception('Exception occurred while updating the toolchain')
+
+        scheduler.wait_for_stop(timeout=TOOLCHAIN_CHECK_INTERVAL.total_seconds())
@@ -0,0 +1,49 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+from pathlib import Path
+from typing import Callable
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def open_inotify(directory: Path) -> int:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError('inotify is not supported on this platform')
+
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+    return fd
+
+
+def watch_directory(fd: int, on_change: Callable[[set[str]], None]):
+    while True:
+        data = os.read(fd, 64 * 1024)
+
+        # A single read holds a batch of events, the callback is invoked once per batch
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, _, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.add(data[offset:offset + name_length].rstrip(b'\0').decode(errors='replace'))
+            offset += name_length
+
+        on_change(names)